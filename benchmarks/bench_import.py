@@ -0,0 +1,111 @@
+"""
+Benchmark the startup cost of WindowsAuthTokenMiddleware.
+
+Every run starts a fresh Python process, which configures Django, then imports the middleware module and
+creates the middleware, like a worker process does when it starts. The time spent importing and creating
+it is measured inside that process, so the startup of the interpreter and of Django itself is left out.
+Results are printed, and can be written as JSON for comparison between releases.
+
+Usage:
+    python benchmarks/bench_import.py --runs 20 --json results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+import django
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+CHILD = """
+import json, sys, time
+import django
+from django.conf import settings
+
+settings.configure(
+    SECRET_KEY="django-insecure-benchmark-key",
+    INSTALLED_APPS=["django.contrib.contenttypes", "django.contrib.auth"],
+    WINDOWSAUTHTOKEN_RESOLVER={resolver!r},
+)
+django.setup()
+
+started = time.perf_counter()
+from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+imported = time.perf_counter()
+WindowsAuthTokenMiddleware(lambda request: None)
+created = time.perf_counter()
+
+json.dump(
+    {{
+        "import_ms": (imported - started) * 1000,
+        "init_ms": (created - imported) * 1000,
+        "pywin32_loaded": "win32security" in sys.modules,
+    }},
+    sys.stdout,
+)
+"""
+
+RESOLVERS = {
+    "pywin32": "django_windowsauthtoken.resolvers.Pywin32Resolver",
+    "fake": "django_windowsauthtoken.resolvers.FakeTokenResolver",
+}
+
+
+def run_once(resolver: str) -> dict[str, float]:
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([SRC, os.environ.get("PYTHONPATH", "")])}
+    # Let the benchmark run on platforms without pywin32
+    env.setdefault("WINDOWSAUTHTOKEN_IGNORE_PYWIN32_ERRORS", "true")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(resolver=resolver)], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    result: dict[str, float] = json.loads(output)
+    return result
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh processes per resolver.")
+    parser.add_argument("--resolver", choices=RESOLVERS, action="append", help="Resolver to use, default all.")
+    parser.add_argument("--json", metavar="PATH", help="Write machine-readable results to PATH, or - for stdout.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.resolver or RESOLVERS:
+        runs = [run_once(RESOLVERS[name]) for _ in range(args.runs)]
+        result = {
+            "resolver": name,
+            "runs": args.runs,
+            "import_ms": statistics.median(run["import_ms"] for run in runs),
+            "init_ms": statistics.median(run["init_ms"] for run in runs),
+            "pywin32_loaded": any(run["pywin32_loaded"] for run in runs),
+        }
+        results.append(result)
+        print(
+            f"{name:<8} import {result['import_ms']:>8.2f} ms  init {result['init_ms']:>8.2f} ms"
+            f"  pywin32 loaded: {'yes' if result['pywin32_loaded'] else 'no'}",
+            file=sys.stderr,
+        )
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "platform": platform.platform(),
+            "options": {key: value for key, value in vars(args).items() if key != "json"},
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Benchmark the cost per request of WindowsAuthTokenMiddleware.
+
+The middleware is driven through the Django test client (WSGI) and the async test client (ASGI),
+with the fake token resolver simulating the Windows API. Results are printed as a table, and can be
+written as JSON for comparison between releases.
+
+Usage:
+    python benchmarks/bench_middleware.py --requests 2000 --lookup-latency 0.002 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Any
+
+import django
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.urls import path
+
+SCENARIOS = {
+    # scenario name: value of the token header, or None to omit the header
+    "no-token": None,
+    "valid-token": "1a",
+    "invalid-token": "not-a-token",
+    "formatter-error": "2b",
+}
+
+MODES = ("sync", "async")
+
+
+def remote_user_view(request: HttpRequest) -> HttpResponse:
+    return HttpResponse(request.META.get("REMOTE_USER", ""))
+
+
+urlpatterns = [path("", remote_user_view)]
+
+
+def configure(args: argparse.Namespace) -> None:
+    settings.configure(
+        DEBUG=False,
+        ALLOWED_HOSTS=["*"],
+        ROOT_URLCONF=__name__,
+        SECRET_KEY="django-insecure-benchmark-key",
+        MIDDLEWARE=["django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware"],
+        # Keep the warnings for invalid tokens out of the results, while still paying for the log calls
+        LOGGING={
+            "version": 1,
+            "handlers": {"null": {"class": "logging.NullHandler"}},
+            "loggers": {"windowsauthtoken": {"handlers": ["null"], "propagate": False}},
+        },
+        WINDOWSAUTHTOKEN_CACHE_SIZE=args.cache_size,
+        WINDOWSAUTHTOKEN_RESOLVER="django_windowsauthtoken.resolvers.FakeTokenResolver",
+        WINDOWSAUTHTOKEN_RESOLVER_OPTIONS={
+            "tokens": {"1a": "S-1-5-21-1001", "2b": "S-1-5-21-1002"},
+            # The account without a domain makes the default formatter fail
+            "accounts": {"S-1-5-21-1001": ("testuser", "TESTDOMAIN"), "S-1-5-21-1002": ("testuser", "")},
+            "token_latency": args.token_latency,
+            "lookup_latency": args.lookup_latency,
+        },
+    )
+    django.setup()
+
+
+def summarize(durations: list[float], elapsed: float) -> dict[str, float]:
+    quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+    return {
+        "requests": len(durations),
+        "requests_per_second": len(durations) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+def run_sync(header: str | None, requests: int, warmup: int) -> dict[str, float]:
+    from django.test import Client
+
+    client = Client()
+    headers = {"X-IIS-WindowsAuthToken": header} if header else {}
+    for _ in range(warmup):
+        client.get("/", headers=headers)
+
+    durations = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        client.get("/", headers=headers)
+        durations.append(time.perf_counter() - request_started)
+    return summarize(durations, time.perf_counter() - started)
+
+
+async def run_async(header: str | None, requests: int, warmup: int) -> dict[str, float]:
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    headers = {"X-IIS-WindowsAuthToken": header} if header else {}
+    for _ in range(warmup):
+        await client.get("/", headers=headers)
+
+    durations = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        await client.get("/", headers=headers)
+        durations.append(time.perf_counter() - request_started)
+    return summarize(durations, time.perf_counter() - started)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="Measured requests per scenario and mode.")
+    parser.add_argument("--warmup", type=int, default=50, help="Unmeasured requests before each run.")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Simulated token inspection time (s).")
+    parser.add_argument("--lookup-latency", type=float, default=0.001, help="Simulated account lookup time (s).")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Identity cache size, 0 disables the cache.")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="Scenario to run, default all.")
+    parser.add_argument("--mode", choices=MODES, action="append", help="Mode to run, default all.")
+    parser.add_argument("--json", metavar="PATH", help="Write machine-readable results to PATH, or - for stdout.")
+    args = parser.parse_args(argv)
+
+    configure(args)
+
+    results: list[dict[str, Any]] = []
+    for scenario in args.scenario or SCENARIOS:
+        for mode in args.mode or MODES:
+            header = SCENARIOS[scenario]
+            if mode == "sync":
+                result = run_sync(header, args.requests, args.warmup)
+            else:
+                result = asyncio.run(run_async(header, args.requests, args.warmup))
+            results.append({"scenario": scenario, "mode": mode, **result})
+            print(
+                f"{scenario:<16} {mode:<6} {result['requests_per_second']:>10.1f} req/s"
+                f"  p50 {result['p50_ms']:>8.3f} ms  p99 {result['p99_ms']:>8.3f} ms",
+                file=sys.stderr,
+            )
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "platform": platform.platform(),
+            "options": {key: value for key, value in vars(args).items() if key != "json"},
+            "results": results,
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    # Make the benchmark work from a source checkout, without installing the package
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+    sys.exit(main())
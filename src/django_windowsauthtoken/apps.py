@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class WindowsAuthTokenConfig(AppConfig):
+    name = "django_windowsauthtoken"
+    verbose_name = "Windows Authentication Token"
+
+    def ready(self) -> None:
+        from . import checks  # noqa: F401
@@ -0,0 +1,125 @@
+import functools
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import RemoteUserBackend
+from django.contrib.auth.base_user import AbstractBaseUser
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from .cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, IdentityCache
+
+
+class WindowsAuthTokenBackend(RemoteUserBackend):
+    """
+    RemoteUserBackend that remembers users by the SID that `WindowsAuthTokenMiddleware` stores on the request.
+
+    After the first authentication of a SID, the user is fetched by its primary key instead of its username.
+    When `WINDOWSAUTHTOKEN_USER_CACHE_ROWS` is enabled, the user rows are cached as well, so authenticating
+    a known SID and loading the user from the session don't need any database queries. Cached rows are
+    dropped whenever a user is saved or deleted in this process.
+    """
+
+    # The signatures of RemoteUserBackend, which are incompatible with ModelBackend in django-stubs as well
+    def authenticate(  # type: ignore[override]
+        self, request: HttpRequest | None, remote_user: str
+    ) -> AbstractBaseUser | None:
+        sid_string = request.META.get("WINDOWSAUTHTOKEN_SID") if request is not None else None
+        if not remote_user or sid_string is None:
+            return super().authenticate(request, remote_user)
+
+        user_cache = get_user_cache()
+        user_pk = user_cache.get(sid_string)
+        if user_pk is not None:
+            user = self.get_user(user_pk)
+            # After a rename of the account, the user is found by its new username, just like RemoteUserBackend does
+            if user is not None and user.get_username() == self.clean_username(remote_user):
+                return user
+
+        user = super().authenticate(request, remote_user)
+        if user is not None:
+            user_cache.set(sid_string, user.pk)
+            cache_user(user)
+        return user
+
+    async def aauthenticate(  # type: ignore[override]
+        self, request: HttpRequest | None, remote_user: str
+    ) -> AbstractBaseUser | None:
+        return await sync_to_async(self.authenticate)(request, remote_user)
+
+    def get_user(self, user_id: Any) -> AbstractBaseUser | None:
+        user: AbstractBaseUser | None = get_cached_user(user_id)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache_user(user)
+        elif not self.user_can_authenticate(user):
+            user = None
+        return user
+
+
+@functools.cache
+def get_user_cache() -> IdentityCache[Any]:
+    """Return the process-wide cache that maps SID strings to the primary keys of users."""
+    return IdentityCache(
+        max_size=getattr(settings, "WINDOWSAUTHTOKEN_USER_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_USER_CACHE_TTL", DEFAULT_CACHE_TTL),
+    )
+
+
+@functools.cache
+def get_user_row_cache() -> IdentityCache[tuple[str | None, tuple[Any, ...]]] | None:
+    """Return the process-wide cache of user rows, or None if caching rows is disabled in the Django settings."""
+    if not getattr(settings, "WINDOWSAUTHTOKEN_USER_CACHE_ROWS", False):
+        return None
+    return IdentityCache(
+        max_size=getattr(settings, "WINDOWSAUTHTOKEN_USER_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_USER_CACHE_TTL", DEFAULT_CACHE_TTL),
+    )
+
+
+def cache_user(user: Any) -> None:
+    """Store the row of the user in the row cache, if enabled."""
+    row_cache = get_user_row_cache()
+    if row_cache is not None:
+        values = tuple(getattr(user, field.attname) for field in user._meta.concrete_fields)
+        row_cache.set(str(user.pk), (user._state.db, values))
+
+
+def get_cached_user(user_id: Any) -> Any:
+    """Return a user instance built from the row cache, or None when the row is not cached."""
+    row_cache = get_user_row_cache()
+    if row_cache is None:
+        return None
+    cached = row_cache.get(str(user_id))
+    if cached is None:
+        return None
+
+    db, values = cached
+    user_model = get_user_model()
+    field_names = [field.attname for field in user_model._meta.concrete_fields]
+    return user_model.from_db(db, field_names, values)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_cached_user(sender: Any, instance: Any, **kwargs: Any) -> None:
+    row_cache = get_user_row_cache()
+    if row_cache is not None and sender is get_user_model():
+        row_cache.delete(str(instance.pk))
+
+
+@receiver(setting_changed)
+def reset_user_cache(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_USER_CACHE_SIZE", "WINDOWSAUTHTOKEN_USER_CACHE_TTL"):
+        get_user_cache.cache_clear()
+    if setting in (
+        "WINDOWSAUTHTOKEN_USER_CACHE_SIZE",
+        "WINDOWSAUTHTOKEN_USER_CACHE_TTL",
+        "WINDOWSAUTHTOKEN_USER_CACHE_ROWS",
+    ):
+        get_user_row_cache.cache_clear()
@@ -0,0 +1,45 @@
+from collections.abc import Iterable
+
+_Node = dict[str, "_Node"]
+
+_TERMINAL = ""
+"""Key that marks the end of a prefix in a trie node. Safe, because every other key is a single character."""
+
+
+class PathPrefixTrie:
+    """
+    Set of path prefixes, compiled into a character trie.
+
+    Checking a path walks the trie once, so its cost depends on the length of the path,
+    and not on the number of prefixes.
+    """
+
+    def __init__(self, prefixes: Iterable[str] = ()) -> None:
+        self._root: _Node = {}
+        self.prefixes: list[str] = []
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix: str) -> None:
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[_TERMINAL] = {}
+        self.prefixes.append(prefix)
+
+    def matches(self, path: str) -> bool:
+        """Return whether the path starts with any of the prefixes."""
+        node = self._root
+        if _TERMINAL in node:
+            return True
+        for char in path:
+            next_node = node.get(char)
+            if next_node is None:
+                return False
+            if _TERMINAL in next_node:
+                return True
+            node = next_node
+        return False
+
+    def __bool__(self) -> bool:
+        return bool(self.prefixes)
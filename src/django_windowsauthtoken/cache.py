@@ -0,0 +1,523 @@
+import atexit
+import functools
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Generic, TypeVar
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULT_CACHE_SIZE = 1024
+"""Default maximum number of identities kept in the in-process cache."""
+
+DEFAULT_CACHE_TTL = 300
+"""Default number of seconds a resolved identity is kept in the in-process cache."""
+
+DEFAULT_NEGATIVE_CACHE_TTL = 30
+"""Default number of seconds a failed account lookup is remembered in the in-process cache."""
+
+DEFAULT_PERSISTENT_CACHE_FLUSH_INTERVAL = 1.0
+"""Default number of seconds between writes of newly resolved identities to the persistent store."""
+
+T = TypeVar("T")
+
+logger = logging.getLogger("windowsauthtoken")
+
+
+class IdentityCache(Generic[T]):
+    """
+    Bounded, thread-safe in-process cache with a time-to-live and LRU eviction.
+
+    Used to remember the results of `LookupAccountSid`, keyed by the string form of the SID.
+    A cache with a `max_size` or `ttl` of zero is disabled and never stores anything.
+    Expired entries are kept for another `stale_ttl` seconds, during which they are only
+    returned by `get_stale`.
+    """
+
+    def __init__(
+        self, max_size: int = DEFAULT_CACHE_SIZE, ttl: float = DEFAULT_CACHE_TTL, stale_ttl: float = 0
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entries: OrderedDict[str, tuple[float, T]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, key: str) -> T | None:
+        """
+        Return the cached value for the key, or None when it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                if expires_at + self.stale_ttl <= now:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key: str) -> T | None:
+        """
+        Return the value for the key when it has expired, but is still within the stale period, otherwise None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            now = time.monotonic()
+            if expires_at > now or expires_at + self.stale_ttl <= now:
+                return None
+
+            self.stale_hits += 1
+            return value
+
+    def set(self, key: str, value: T, ttl: float | None = None) -> None:
+        """
+        Store the value for the key, evicting the least recently used entries when full.
+
+        Args:
+            key (str): The key.
+            value (T): The value.
+            ttl (float | None): Keep the value for this number of seconds instead of the cache TTL, if shorter.
+        """
+        if not self.enabled:
+            return
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate: Callable[[str, T], bool]) -> int:
+        """
+        Delete all entries for which `predicate(key, value)` is true, also the expired ones.
+
+        Returns:
+            int: The number of deleted entries.
+        """
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.stale_hits = 0
+
+    def stats(self) -> dict[str, Any]:
+        """Return a snapshot of the cache counters and occupancy."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale_hits": self.stale_hits,
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SharedIdentityCache:
+    """
+    Identity cache shared between processes and hosts, backed by one of the caches in Django's `CACHES`.
+
+    Used as a second tier behind the in-process `IdentityCache`. Errors from the cache backend are logged
+    and treated as cache misses, so an unavailable cache server never breaks authentication.
+    Entries can't be enumerated in most cache backends, so all entries are invalidated at once by changing
+    the namespace that is part of the keys.
+    """
+
+    key_prefix = "windowsauthtoken:sid:"
+
+    namespace = 0
+    """Part of the keys, changed to invalidate all entries."""
+
+    def __init__(self, alias: str, ttl: float = DEFAULT_CACHE_TTL, key_prefix: str | None = None) -> None:
+        self.alias = alias
+        self.ttl = ttl
+        if key_prefix is not None:
+            self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self) -> BaseCache:
+        return caches[self.alias]
+
+    def make_key(self, key: str) -> str:
+        if self.namespace:
+            return f"{self.key_prefix}{self.namespace}:{key}"
+        return f"{self.key_prefix}{key}"
+
+    def get(self, key: str) -> tuple[str, str] | None:
+        """
+        Return the cached `(user, domain)` for the key, or None when it is missing.
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: list[str]) -> dict[str, tuple[str, str]]:
+        """
+        Return the cached `(user, domain)` for all keys that are present, in a single round trip.
+        """
+        try:
+            values = self.cache.get_many([self.make_key(key) for key in keys])
+        except Exception as err:
+            logger.warning("Cannot read from shared identity cache %r: %s", self.alias, err)
+            values = {}
+
+        found = {}
+        for key in keys:
+            value = values.get(self.make_key(key))
+            if value is not None:
+                # Some cache serializers return tuples as lists
+                found[key] = (value[0], value[1])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value: tuple[str, str]) -> None:
+        """
+        Store `(user, domain)` for the key.
+        """
+        self.set_many({key: value})
+
+    def set_many(self, mapping: dict[str, tuple[str, str]]) -> None:
+        """
+        Store `(user, domain)` for all keys, in a single round trip.
+        """
+        try:
+            self.cache.set_many({self.make_key(key): value for key, value in mapping.items()}, timeout=self.ttl)
+        except Exception as err:
+            logger.warning("Cannot write to shared identity cache %r: %s", self.alias, err)
+
+    def delete(self, key: str) -> None:
+        try:
+            self.cache.delete(self.make_key(key))
+        except Exception as err:
+            logger.warning("Cannot delete from shared identity cache %r: %s", self.alias, err)
+
+    def stats(self) -> dict[str, Any]:
+        """Return a snapshot of the cache counters."""
+        return {"alias": self.alias, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+
+class PersistentIdentityStore:
+    """
+    Identity store in a SQLite database on disk, to keep resolved identities across process restarts.
+
+    The store is read once, when the process starts, to fill the in-process cache. Newly resolved identities
+    are queued, and written in batches by a background thread, so the request path never waits for the disk.
+    Every entry records when it was resolved, and entries older than the TTL are ignored.
+    Several processes can share the same database file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = DEFAULT_CACHE_TTL,
+        flush_interval: float = DEFAULT_PERSISTENT_CACHE_FLUSH_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._pending: dict[str, tuple[str, str, float]] = {}
+        self._lock = threading.Lock()
+        self._writer: threading.Thread | None = None
+        self._loaded = False
+        _persistent_stores.add(self)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5)
+        # Let readers and the writers of other processes continue while a batch is written
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS identities "
+            "(sid TEXT PRIMARY KEY, user TEXT NOT NULL, domain TEXT NOT NULL, resolved_at REAL NOT NULL)"
+        )
+        return connection
+
+    def load(self) -> dict[str, tuple[str, str, float]]:
+        """
+        Return the identities that have not expired, and remove the expired ones.
+
+        Returns:
+            dict[str, tuple[str, str, float]]: Maps SID strings to `(user, domain, resolved_at)`, where
+                `resolved_at` is a Unix timestamp.
+        """
+        expired_before = time.time() - self.ttl
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM identities WHERE resolved_at <= ?", (expired_before,))
+                rows = connection.execute("SELECT sid, user, domain, resolved_at FROM identities").fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as err:
+            logger.warning("Cannot read from persistent identity store %r: %s", self.path, err)
+            return {}
+        return {sid: (user, domain, resolved_at) for sid, user, domain, resolved_at in rows}
+
+    def load_into(self, cache: IdentityCache[tuple[str, str]]) -> int:
+        """
+        Fill the cache with the stored identities, for the remainder of their TTL. Only done once per store.
+
+        Returns:
+            int: The number of identities that were loaded.
+        """
+        with self._lock:
+            if self._loaded:
+                return 0
+            self._loaded = True
+
+        now = time.time()
+        identities = self.load()
+        for sid, (user, domain, resolved_at) in identities.items():
+            cache.set(sid, (user, domain), ttl=resolved_at + self.ttl - now)
+        logger.debug("Loaded identities from persistent store: path=%r count=%d", self.path, len(identities))
+        return len(identities)
+
+    def set(self, key: str, value: tuple[str, str]) -> None:
+        """
+        Queue `(user, domain)` for the key to be written, and make sure the background writer is running.
+        """
+        with self._lock:
+            self._pending[key] = (value[0], value[1], time.time())
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, name="windowsauthtoken-store", daemon=True)
+                self._writer.start()
+
+    def _write_behind(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            with self._lock:
+                # Stop when idle, a new writer is started when the next identity is queued
+                if not self._pending:
+                    self._writer = None
+                    return
+
+    def flush(self) -> None:
+        """Write all queued identities in a single transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        rows = [(sid, user, domain, resolved_at) for sid, (user, domain, resolved_at) in pending.items()]
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany("INSERT OR REPLACE INTO identities VALUES (?, ?, ?, ?)", rows)
+            finally:
+                connection.close()
+        except sqlite3.Error as err:
+            logger.warning("Cannot write to persistent identity store %r: %s", self.path, err)
+
+    def get(self, key: str) -> tuple[str, str, float] | None:
+        """
+        Return the stored `(user, domain, resolved_at)` for the key, or None if it is missing or expired.
+        """
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT user, domain, resolved_at FROM identities WHERE sid = ? AND resolved_at > ?",
+                    (key, time.time() - self.ttl),
+                ).fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error as err:
+            logger.warning("Cannot read from persistent identity store %r: %s", self.path, err)
+            return None
+        return (row[0], row[1], row[2]) if row is not None else None
+
+    def delete(self, key: str | None = None, domain: str | None = None) -> int:
+        """
+        Delete the entry for the key, all entries of the domain, compared case-insensitively, or all entries
+        when neither is given. Identities that are still queued are discarded in the same way.
+
+        Returns:
+            int: The number of deleted entries.
+        Raises:
+            sqlite3.Error: If the store cannot be written.
+        """
+        with self._lock:
+            self._pending = {
+                sid: entry
+                for sid, entry in self._pending.items()
+                if (key is not None and sid != key) or (domain is not None and entry[1].casefold() != domain.casefold())
+            }
+
+        parameters: tuple[str, ...]
+        if key is not None:
+            query, parameters = "DELETE FROM identities WHERE sid = ?", (key,)
+        elif domain is not None:
+            query, parameters = "DELETE FROM identities WHERE domain = ? COLLATE NOCASE", (domain,)
+        else:
+            query, parameters = "DELETE FROM identities", ()
+        connection = self._connect()
+        try:
+            with connection:
+                deleted: int = connection.execute(query, parameters).rowcount
+        finally:
+            connection.close()
+        return deleted
+
+    def pending_count(self) -> int:
+        """Return the number of identities that are queued, but not written yet."""
+        with self._lock:
+            return len(self._pending)
+
+
+_persistent_stores: weakref.WeakSet[PersistentIdentityStore] = weakref.WeakSet()
+"""The persistent stores of this process, flushed when it exits. Stores that are no longer used are dropped."""
+
+
+@atexit.register
+def _flush_persistent_stores() -> None:
+    for store in list(_persistent_stores):
+        store.flush()
+
+
+class _Call(Generic[T]):
+    """A call in flight, shared by all callers for the same key."""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: T | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesce concurrent calls for the same key into a single call.
+
+    The first caller for a key runs the function, while other callers for that key wait for it
+    to finish and receive the same result or exception. This works across threads, which also
+    covers the async path, since its blocking calls run on executor threads.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[str, _Call[T]] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result  # type: ignore[return-value]
+
+        try:
+            result = call.result = func()
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return result
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+@functools.cache
+def get_identity_cache() -> IdentityCache[tuple[str, str]]:
+    """Return the process-wide identity cache, configured from the Django settings."""
+    return IdentityCache(
+        max_size=getattr(settings, "WINDOWSAUTHTOKEN_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_CACHE_TTL", DEFAULT_CACHE_TTL),
+        stale_ttl=getattr(settings, "WINDOWSAUTHTOKEN_STALE_TTL", 0),
+    )
+
+
+@functools.cache
+def get_negative_identity_cache() -> IdentityCache[str]:
+    """Return the process-wide cache of failed account lookups, mapping SIDs to the error message."""
+    return IdentityCache(
+        max_size=getattr(settings, "WINDOWSAUTHTOKEN_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL", DEFAULT_NEGATIVE_CACHE_TTL),
+    )
+
+
+@functools.cache
+def get_shared_identity_cache() -> SharedIdentityCache | None:
+    """Return the shared identity cache, or None if it is not configured in the Django settings."""
+    alias = getattr(settings, "WINDOWSAUTHTOKEN_SHARED_CACHE", None)
+    if alias is None:
+        return None
+    return SharedIdentityCache(
+        alias=alias,
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_SHARED_CACHE_TTL", DEFAULT_CACHE_TTL),
+    )
+
+
+@functools.cache
+def get_persistent_identity_store() -> PersistentIdentityStore | None:
+    """Return the persistent identity store, or None if it is not configured in the Django settings."""
+    path = getattr(settings, "WINDOWSAUTHTOKEN_PERSISTENT_CACHE", None)
+    if path is None:
+        return None
+    return PersistentIdentityStore(
+        path=str(path),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_PERSISTENT_CACHE_TTL", DEFAULT_CACHE_TTL),
+    )
+
+
+@receiver(setting_changed)
+def reset_identity_cache(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_CACHE_SIZE", "WINDOWSAUTHTOKEN_CACHE_TTL", "WINDOWSAUTHTOKEN_STALE_TTL"):
+        get_identity_cache.cache_clear()
+    if setting in ("WINDOWSAUTHTOKEN_CACHE_SIZE", "WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL"):
+        get_negative_identity_cache.cache_clear()
+    if setting in ("WINDOWSAUTHTOKEN_SHARED_CACHE", "WINDOWSAUTHTOKEN_SHARED_CACHE_TTL"):
+        get_shared_identity_cache.cache_clear()
+    if setting in ("WINDOWSAUTHTOKEN_PERSISTENT_CACHE", "WINDOWSAUTHTOKEN_PERSISTENT_CACHE_TTL"):
+        get_persistent_identity_store.cache_clear()
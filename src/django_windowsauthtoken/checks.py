@@ -0,0 +1,30 @@
+import importlib.util
+from typing import Any
+
+from django.conf import settings
+from django.core.checks import CheckMessage, Error, Tags, register
+
+from . import resolvers
+
+
+@register(Tags.compatibility)
+def check_pywin32(app_configs: Any = None, **kwargs: Any) -> list[CheckMessage]:
+    """
+    Check that pywin32 is installed when the default resolver is used.
+
+    The modules are only located, not imported, so the check doesn't load the DLLs of pywin32 at startup.
+    """
+    if getattr(settings, "WINDOWSAUTHTOKEN_RESOLVER", resolvers.DEFAULT_RESOLVER) != resolvers.DEFAULT_RESOLVER:
+        return []
+    if resolvers._IGNORE_PYWIN32_ERRORS:
+        return []
+    missing = [module for module in resolvers.PYWIN32_MODULES if importlib.util.find_spec(module) is None]
+    if not missing:
+        return []
+    return [
+        Error(
+            "pywin32 is required for Windows Authentication Token middleware.",
+            hint=f"Install pywin32, the modules {', '.join(missing)} cannot be found.",
+            id="windowsauthtoken.E001",
+        )
+    ]
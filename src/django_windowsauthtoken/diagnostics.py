@@ -0,0 +1,90 @@
+from typing import Any
+
+from django.conf import settings
+
+from .cache import get_identity_cache, get_negative_identity_cache, get_shared_identity_cache
+from .formatters import DEFAULT_FORMATTER
+from .groups import get_group_cache, get_shared_group_cache
+from .handles import get_handle_tracker
+from .invalidation import get_user_caches
+from .metrics import get_metrics, histogram_quantile
+from .resolvers import get_circuit_breaker, get_resolver
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+"""The quantiles of the stage durations included in the diagnostics."""
+
+
+def hit_ratio(stats: dict[str, Any]) -> float | None:
+    """Return the fraction of cache lookups that were hits, or None if there were no lookups yet."""
+    lookups = stats["hits"] + stats["misses"]
+    return stats["hits"] / lookups if lookups else None
+
+
+def cache_diagnostics() -> dict[str, Any]:
+    """
+    Return the counters, occupancy and hit ratio of every cache that is enabled.
+
+    The caches of the authentication backend are only included when the backend is loaded in this process.
+    """
+    caches: dict[str, Any] = {
+        "identities": get_identity_cache(),
+        "negative_identities": get_negative_identity_cache(),
+        "shared_identities": get_shared_identity_cache(),
+        "groups": get_group_cache(),
+        "shared_groups": get_shared_group_cache(),
+    }
+    user_caches = get_user_caches()
+    if user_caches is not None:
+        caches["users"], caches["user_rows"] = user_caches
+    diagnostics = {}
+    for name, cache in caches.items():
+        if cache is not None:
+            stats = cache.stats()
+            diagnostics[name] = {**stats, "hit_ratio": hit_ratio(stats)}
+    return diagnostics
+
+
+def latency_diagnostics(stages: dict[str, Any]) -> dict[str, Any]:
+    """Return the observation count and estimated quantiles of the duration of every stage, in seconds."""
+    return {
+        stage: {
+            "count": histogram["count"],
+            **{f"p{round(q * 100)}": histogram_quantile(histogram["buckets"], q) for q in LATENCY_QUANTILES},
+        }
+        for stage, histogram in stages.items()
+    }
+
+
+def collect_diagnostics() -> dict[str, Any]:
+    """
+    Collect a snapshot of the runtime state of the middleware.
+
+    Only counters that are maintained anyway are read, so collecting diagnostics costs nothing on the request
+    path, and its own cost doesn't depend on the number of requests handled.
+
+    Returns:
+        dict[str, Any]: The configured formatter, resolver and authentication backends, the outcome counts and
+            stage latencies if metrics are enabled, the state of the caches, the circuit breaker and the token
+            handles.
+    """
+    metrics = get_metrics()
+    snapshot = metrics.snapshot() if metrics is not None else None
+    circuit_breaker = get_circuit_breaker()
+    handle_tracker = get_handle_tracker()
+    resolver = type(get_resolver())
+
+    return {
+        "formatter": getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_FORMATTER", DEFAULT_FORMATTER),
+        "formatter_pipeline": getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_PIPELINE", None),
+        "resolver": f"{resolver.__module__}.{resolver.__qualname__}",
+        "authentication_backends": list(settings.AUTHENTICATION_BACKENDS),
+        "outcomes": snapshot["outcomes"] if snapshot is not None else None,
+        "latency": latency_diagnostics(snapshot["stages"]) if snapshot is not None else None,
+        "caches": cache_diagnostics(),
+        "circuit_breaker": (
+            {"open": circuit_breaker.is_open, "failures": circuit_breaker.failures}
+            if circuit_breaker is not None
+            else None
+        ),
+        "handles": handle_tracker.snapshot() if handle_tracker is not None else None,
+    }
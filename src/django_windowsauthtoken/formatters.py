@@ -1,3 +1,12 @@
+import functools
+import hashlib
+import json
+from collections.abc import Callable, Iterable, Mapping
+from typing import Any
+
+from django.core.exceptions import ImproperlyConfigured
+
+
 class FormattingError(Exception):
     """Custom exception for formatting errors."""
 
@@ -26,3 +35,112 @@ def format_email_like(user: str, domain: str) -> str:
 
 
 DEFAULT_FORMATTER = f"{__name__}.format_domain_user"
+
+
+DEFAULT_PIPELINE_CACHE_SIZE = 1024
+"""Default number of formatted usernames remembered by a formatter pipeline."""
+
+PIPELINE_CASES = {
+    "lower": str.lower,
+    "upper": str.upper,
+    "casefold": str.casefold,
+}
+"""The case conversions a formatter pipeline can apply to the username and domain."""
+
+
+class FormatterPipeline:
+    r"""
+    Username formatter that prepares the username and domain before passing them to another formatter.
+
+    The steps are applied in a fixed order: stripping a prefix from the username, replacing the domain by its
+    alias, and converting the case of both. The steps are compiled into a single function when the pipeline is
+    created, with the prefixes and domain aliases in precomputed lookup tables. Results are memoized per
+    `(user, domain)`, so a known user is formatted with a single dictionary lookup.
+
+    Args:
+        formatter (Callable[[str, str], str]): The formatter that produces the final username.
+        strip_prefixes (Iterable[str]): Prefixes to remove from the username, e.g. `adm-`, compared
+            case-insensitively. Only the longest matching prefix is removed.
+        domain_aliases (Mapping[str, str] | None): Maps domains to the name to use instead, e.g. the NetBIOS
+            name `CORP` to the DNS name `corp.example.com`. Domains are compared case-insensitively.
+        case (str | None): Case conversion for the username and domain: `lower`, `upper` or `casefold`.
+        cache_size (int): The maximum number of formatted usernames to remember, 0 disables memoization.
+    Raises:
+        ImproperlyConfigured: If an option is invalid.
+    """
+
+    def __init__(
+        self,
+        formatter: Callable[[str, str], str],
+        strip_prefixes: Iterable[str] = (),
+        domain_aliases: Mapping[str, str] | None = None,
+        case: str | None = None,
+        cache_size: int = DEFAULT_PIPELINE_CACHE_SIZE,
+    ) -> None:
+        if isinstance(strip_prefixes, str):
+            raise ImproperlyConfigured("strip_prefixes must be a list of prefixes, not a string.")
+        if case is not None and case not in PIPELINE_CASES:
+            raise ImproperlyConfigured(f"Unknown case conversion {case!r}, expected one of {sorted(PIPELINE_CASES)}.")
+
+        self.strip_prefixes = tuple(prefix for prefix in strip_prefixes if prefix)
+        self.domain_aliases = dict(domain_aliases or {})
+        self.case = case
+        self.cache_size = cache_size
+        # Identifies the options, e.g. to detect that a pinned identity was formatted differently
+        self.fingerprint = hashlib.sha256(
+            json.dumps([self.strip_prefixes, self.domain_aliases, case], sort_keys=True).encode()
+        ).hexdigest()[:16]
+
+        compiled = self._compile(formatter)
+        self._format = functools.lru_cache(maxsize=cache_size)(compiled) if cache_size else compiled
+
+    def _compile(self, formatter: Callable[[str, str], str]) -> Callable[[str, str], str]:
+        # Longest prefixes first, with their lengths, so the longest matching prefix is removed
+        prefixes = sorted(((prefix.casefold(), len(prefix)) for prefix in self.strip_prefixes), key=lambda p: -p[1])
+        aliases = {domain.casefold(): alias for domain, alias in self.domain_aliases.items()}
+        convert_case = PIPELINE_CASES[self.case] if self.case is not None else None
+
+        def format_username(user: str, domain: str) -> str:
+            for prefix, length in prefixes:
+                if user[:length].casefold() == prefix:
+                    user = user[length:]
+                    break
+            if aliases:
+                domain = aliases.get(domain.casefold(), domain)
+            if convert_case is not None:
+                user, domain = convert_case(user), convert_case(domain)
+            return formatter(user, domain)
+
+        return format_username
+
+    def __call__(self, user: str, domain: str) -> str:
+        """
+        Format the username.
+
+        Raises:
+            FormattingError: If the formatter raises an error, which is not memoized.
+        """
+        return self._format(user, domain)
+
+    def cache_clear(self) -> None:
+        """Forget all memoized usernames."""
+        if self.cache_size:
+            self._format.cache_clear()  # type: ignore[attr-defined]
+
+
+def compile_formatter_pipeline(formatter: Callable[[str, str], str], options: Mapping[str, Any]) -> FormatterPipeline:
+    """
+    Compile the pipeline configured in the Django settings around a formatter.
+
+    Args:
+        formatter (Callable[[str, str], str]): The formatter that produces the final username.
+        options (Mapping[str, Any]): The options of the pipeline, see `FormatterPipeline`.
+    Returns:
+        FormatterPipeline: The compiled pipeline.
+    Raises:
+        ImproperlyConfigured: If the options are invalid.
+    """
+    try:
+        return FormatterPipeline(formatter, **options)
+    except TypeError as err:
+        raise ImproperlyConfigured(f"Invalid username formatter pipeline: {err}")
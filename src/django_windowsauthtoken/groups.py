@@ -0,0 +1,208 @@
+import functools
+import logging
+import time
+from collections.abc import Iterable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from .cache import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CACHE_TTL,
+    DEFAULT_NEGATIVE_CACHE_TTL,
+    IdentityCache,
+    SharedIdentityCache,
+)
+from .resolvers import ERROR_NONE_MAPPED, ResolverError, get_circuit_breaker, get_resolver
+
+logger = logging.getLogger("windowsauthtoken")
+
+DEFAULT_GROUP_LOOKUP_CONCURRENCY = 4
+"""Default maximum number of group lookups of a single request that run at the same time."""
+
+_lookup_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="windowsauthtoken-groups")
+"""Looks up the groups missing from the caches. Threads are only started when the first lookup is submitted."""
+
+
+def format_group_name(name: str, domain: str) -> str:
+    r"""Format a group as `DOMAIN\name`, or only `name` for groups without a domain, such as `Everyone`."""
+    return rf"{domain}\{name}" if domain else name
+
+
+@functools.cache
+def get_group_cache() -> IdentityCache[tuple[str, str]]:
+    """Return the process-wide cache of group names, keyed by the string form of the group SID."""
+    return IdentityCache(
+        max_size=getattr(settings, "WINDOWSAUTHTOKEN_CACHE_SIZE", DEFAULT_CACHE_SIZE),
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_CACHE_TTL", DEFAULT_CACHE_TTL),
+    )
+
+
+@functools.cache
+def get_shared_group_cache() -> SharedIdentityCache | None:
+    """Return the shared cache of group names, or None if no shared cache is configured in the Django settings."""
+    alias = getattr(settings, "WINDOWSAUTHTOKEN_SHARED_CACHE", None)
+    if alias is None:
+        return None
+    return SharedIdentityCache(
+        alias=alias,
+        ttl=getattr(settings, "WINDOWSAUTHTOKEN_SHARED_CACHE_TTL", DEFAULT_CACHE_TTL),
+        key_prefix="windowsauthtoken:group:",
+    )
+
+
+def _lookup_group(security_id: Any, sid_string: str) -> tuple[str, str] | None:
+    """Look up the name and domain of a group, or return None if that fails."""
+    circuit_breaker = get_circuit_breaker()
+    if circuit_breaker is not None and not circuit_breaker.allow():
+        return None
+
+    started = time.perf_counter()
+    try:
+        name, domain, _ = get_resolver().lookup_account_sid(security_id)
+    except ResolverError as err:
+        if circuit_breaker is not None:
+            circuit_breaker.record_failure(err)
+        logger.debug("Cannot look up group: sid_string=%r error=%s", sid_string, err)
+        if err.winerror == ERROR_NONE_MAPPED:
+            # Groups without an account, such as deleted groups or capability SIDs, are remembered by their SID
+            # string for as long as failed account lookups
+            get_group_cache().set(
+                sid_string,
+                (sid_string, ""),
+                ttl=getattr(settings, "WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL", DEFAULT_NEGATIVE_CACHE_TTL),
+            )
+        return None
+    if circuit_breaker is not None:
+        circuit_breaker.record_success(time.perf_counter() - started)
+    return name, domain
+
+
+def _lookup_groups(security_ids: dict[str, Any]) -> dict[str, tuple[str, str] | None]:
+    """
+    Look up the names and domains of groups concurrently, keyed by SID string, with None for failed lookups.
+
+    At most `WINDOWSAUTHTOKEN_GROUP_LOOKUP_CONCURRENCY` lookups run at the same time, so a user in many
+    groups doesn't occupy all threads of the executor. A single group is looked up on the calling thread.
+    """
+    if len(security_ids) <= 1:
+        return {sid_string: _lookup_group(security_id, sid_string) for sid_string, security_id in security_ids.items()}
+
+    concurrency = getattr(settings, "WINDOWSAUTHTOKEN_GROUP_LOOKUP_CONCURRENCY", DEFAULT_GROUP_LOOKUP_CONCURRENCY)
+    lookups: dict[Future[tuple[str, str] | None], str] = {}
+    pending: set[Future[tuple[str, str] | None]] = set()
+    for sid_string, security_id in security_ids.items():
+        if len(pending) >= concurrency:
+            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        future = _lookup_executor.submit(_lookup_group, security_id, sid_string)
+        lookups[future] = sid_string
+        pending.add(future)
+    return {sid_string: future.result() for future, sid_string in lookups.items()}
+
+
+def resolve_group_names(group_sids: Iterable[Any]) -> frozenset[str]:
+    r"""
+    Resolve the security IDs of groups to their names, such as `DOMAIN\group`.
+
+    Group names are cached per SID, in the in-process cache and the shared cache if configured. All groups
+    missing from the in-process cache are fetched from the shared cache in a single round trip, and only
+    the remaining groups are looked up, concurrently. Groups that cannot be looked up are represented by their
+    SID string.
+    Groups that don't exist are remembered as such for the negative cache TTL, other failures are looked up
+    again on the next request.
+
+    Returns:
+        frozenset[str]: The names of the groups.
+    """
+    resolver = get_resolver()
+    security_ids = {}
+    for security_id in group_sids:
+        try:
+            security_ids[resolver.sid_to_string(security_id)] = security_id
+        except ResolverError as err:
+            logger.debug("Cannot convert group SID: security_id=%r error=%s", security_id, err)
+
+    group_cache = get_group_cache()
+    groups = {}
+    missing = []
+    for sid_string in security_ids:
+        cached = group_cache.get(sid_string)
+        if cached is None:
+            missing.append(sid_string)
+        else:
+            groups[sid_string] = cached
+
+    shared_cache = get_shared_group_cache()
+    if shared_cache is not None and missing:
+        found = shared_cache.get_many(missing)
+        for sid_string, group in found.items():
+            group_cache.set(sid_string, group)
+        groups.update(found)
+        missing = [sid_string for sid_string in missing if sid_string not in found]
+
+    looked_up = {}
+    results = _lookup_groups({sid_string: security_ids[sid_string] for sid_string in missing})
+    for sid_string, result in results.items():
+        if result is None:
+            groups[sid_string] = (sid_string, "")
+            continue
+        group_cache.set(sid_string, result)
+        looked_up[sid_string] = result
+    if shared_cache is not None and looked_up:
+        shared_cache.set_many(looked_up)
+    groups.update(looked_up)
+
+    return frozenset(format_group_name(name, domain) for name, domain in groups.values())
+
+
+def sync_user_groups(user: Any, group_names: Iterable[str]) -> None:
+    r"""
+    Update the Django groups of the user to match the Windows groups, as mapped in the Django settings.
+
+    Only the Django groups in `WINDOWSAUTHTOKEN_GROUP_MAPPING` are managed, other groups of the user are left
+    alone. Memberships are added and removed by difference, so unchanged memberships cause no writes.
+    Windows group names are compared case-insensitively.
+
+    Args:
+        user (Any): The Django user.
+        group_names (Iterable[str]): The names of the Windows groups of the user, such as `DOMAIN\group`.
+    """
+    from django.contrib.auth.models import Group
+
+    mapping = {
+        name.casefold(): group for name, group in getattr(settings, "WINDOWSAUTHTOKEN_GROUP_MAPPING", {}).items()
+    }
+    if not mapping:
+        return
+
+    wanted = {mapping[name.casefold()] for name in group_names if name.casefold() in mapping}
+    current = set(user.groups.filter(name__in=set(mapping.values())).values_list("name", flat=True))
+
+    to_add = wanted - current
+    if to_add:
+        user.groups.add(*(Group.objects.get_or_create(name=name)[0] for name in sorted(to_add)))
+    to_remove = current - wanted
+    if to_remove:
+        user.groups.remove(*Group.objects.filter(name__in=to_remove))
+    if to_add or to_remove:
+        logger.debug("Synced groups of user: user=%r added=%r removed=%r", user, to_add, to_remove)
+
+
+@receiver(user_logged_in)
+def sync_user_groups_on_login(sender: Any, request: HttpRequest | None, user: Any, **kwargs: Any) -> None:
+    group_names = getattr(request, "windowsauthtoken_groups", None)
+    if group_names is not None:
+        sync_user_groups(user, group_names)
+
+
+@receiver(setting_changed)
+def reset_group_cache(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_CACHE_SIZE", "WINDOWSAUTHTOKEN_CACHE_TTL"):
+        get_group_cache.cache_clear()
+    if setting in ("WINDOWSAUTHTOKEN_SHARED_CACHE", "WINDOWSAUTHTOKEN_SHARED_CACHE_TTL"):
+        get_shared_group_cache.cache_clear()
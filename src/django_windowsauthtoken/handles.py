@@ -0,0 +1,129 @@
+import functools
+import logging
+import threading
+import time
+from typing import Any
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger("windowsauthtoken")
+
+
+class HandleTracker:
+    """
+    Lifecycle accounting of the token handles passed by IIS, to detect handles that are never closed.
+
+    A handle is in flight from the moment the header is parsed until it is closed. Handles that failed to close
+    are counted separately, as they are most likely leaked. When the sum of both reaches the leak threshold, an
+    error is logged once, until the number drops below the threshold again.
+
+    Unlike the metrics collector, the handles in flight are shared by all threads, so they are kept under a lock.
+
+    Args:
+        leak_threshold (int | None): The number of handles in flight and failed closes that triggers the alarm,
+            or None to disable the alarm.
+    """
+
+    def __init__(self, leak_threshold: int | None = None) -> None:
+        self.leak_threshold = leak_threshold
+        self.opened = 0
+        self.closed = 0
+        self.close_failures = 0
+        self.held_seconds_sum = 0.0
+        self.held_seconds_max = 0.0
+        self._in_flight: dict[int, float] = {}
+        self._alarm_raised = False
+        self._lock = threading.Lock()
+
+    def track_opened(self, token_handle: int) -> None:
+        """Record that the middleware took responsibility for closing the handle."""
+        with self._lock:
+            self.opened += 1
+            self._in_flight[token_handle] = time.monotonic()
+            self._check_leaks()
+
+    def track_closed(self, token_handle: int, failed: bool = False) -> None:
+        """Record an attempt to close the handle, and whether it failed."""
+        with self._lock:
+            opened_at = self._in_flight.pop(token_handle, None)
+            if opened_at is not None:
+                held = time.monotonic() - opened_at
+                self.held_seconds_sum += held
+                self.held_seconds_max = max(self.held_seconds_max, held)
+            if failed:
+                self.close_failures += 1
+            else:
+                self.closed += 1
+            self._check_leaks()
+
+    def _check_leaks(self) -> None:
+        if self.leak_threshold is None:
+            return
+        suspected = len(self._in_flight) + self.close_failures
+        if suspected >= self.leak_threshold and not self._alarm_raised:
+            logger.error(
+                "Token handles may be leaking: in_flight=%d close_failures=%d threshold=%d",
+                len(self._in_flight),
+                self.close_failures,
+                self.leak_threshold,
+            )
+            self._alarm_raised = True
+        elif suspected < self.leak_threshold:
+            self._alarm_raised = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Return the current handle accounting.
+
+        Returns:
+            dict[str, Any]: The counts of opened and closed handles, failed closes and handles in flight,
+                the total and maximum time handles were held, the age of the oldest handle in flight in
+                seconds, and whether a leak is suspected.
+        """
+        with self._lock:
+            now = time.monotonic()
+            oldest = min(self._in_flight.values(), default=None)
+            return {
+                "opened": self.opened,
+                "closed": self.closed,
+                "close_failures": self.close_failures,
+                "in_flight": len(self._in_flight),
+                "held_seconds_sum": self.held_seconds_sum,
+                "held_seconds_max": self.held_seconds_max,
+                "oldest_in_flight_seconds": now - oldest if oldest is not None else 0.0,
+                "leak_suspected": self._alarm_raised,
+            }
+
+
+@functools.cache
+def get_handle_tracker() -> HandleTracker | None:
+    """Return the process-wide handle tracker, or None if handle tracking is disabled in the Django settings."""
+    if not getattr(settings, "WINDOWSAUTHTOKEN_HANDLE_TRACKING", False):
+        return None
+    return HandleTracker(leak_threshold=getattr(settings, "WINDOWSAUTHTOKEN_HANDLE_LEAK_THRESHOLD", None))
+
+
+def track_handle_opened(token_handle: int) -> None:
+    """Record that a token handle was received. Does nothing when handle tracking is disabled."""
+    tracker = get_handle_tracker()
+    if tracker is not None:
+        tracker.track_opened(token_handle)
+
+
+def track_handle_closed(token_handle: int, failed: bool = False) -> None:
+    """Record an attempt to close a token handle. Does nothing when handle tracking is disabled."""
+    tracker = get_handle_tracker()
+    if tracker is not None:
+        tracker.track_closed(token_handle, failed)
+
+
+@receiver(setting_changed)
+def reset_handle_tracker(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_HANDLE_TRACKING", "WINDOWSAUTHTOKEN_HANDLE_LEAK_THRESHOLD"):
+        get_handle_tracker.cache_clear()
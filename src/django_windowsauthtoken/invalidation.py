@@ -0,0 +1,247 @@
+import functools
+import logging
+import sys
+import threading
+import time
+from typing import Any
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .cache import IdentityCache, get_identity_cache, get_negative_identity_cache, get_shared_identity_cache
+from .groups import get_group_cache, get_shared_group_cache
+
+logger = logging.getLogger("windowsauthtoken")
+
+DEFAULT_INVALIDATION_CHECK_INTERVAL = 5.0
+"""Default number of seconds between checks of a worker for new invalidations."""
+
+INVALIDATION_LOG_SIZE = 100
+"""The number of recent invalidations kept in the shared cache. Workers that missed more clear all caches."""
+
+INVALIDATE_SID = "sid"
+INVALIDATE_DOMAIN = "domain"
+INVALIDATE_ALL = "all"
+
+GENERATION_KEY = "windowsauthtoken:generation"
+NAMESPACE_KEY = "windowsauthtoken:namespace"
+LOG_KEY = "windowsauthtoken:invalidations"
+
+
+class InvalidationLog:
+    """
+    Invalidations of cached identities, published through the shared cache to reach the workers of all hosts.
+
+    Every invalidation increments a generation counter, and is appended to a short log. Invalidations of a
+    domain or of everything also change the namespace of the shared cache keys, since the entries of a domain
+    can't be found in the shared cache.
+
+    Args:
+        alias (str): The alias of the shared cache in Django's `CACHES`.
+    """
+
+    def __init__(self, alias: str) -> None:
+        self.alias = alias
+
+    @property
+    def cache(self) -> BaseCache:
+        return caches[self.alias]
+
+    def publish(self, kind: str, value: str = "") -> int:
+        """
+        Publish an invalidation.
+
+        Args:
+            kind (str): What to invalidate: `sid`, `domain` or `all`.
+            value (str): The SID string or domain, empty when invalidating everything.
+        Returns:
+            int: The new generation.
+        """
+        self.cache.add(GENERATION_KEY, 0, timeout=None)
+        generation: int = self.cache.incr(GENERATION_KEY)
+        log = list(self.cache.get(LOG_KEY) or [])
+        log.append((generation, kind, value))
+        values: dict[str, Any] = {LOG_KEY: log[-INVALIDATION_LOG_SIZE:]}
+        if kind != INVALIDATE_SID:
+            values[NAMESPACE_KEY] = generation
+        self.cache.set_many(values, timeout=None)
+        return generation
+
+    def read(self) -> tuple[int, int, list[tuple[int, str, str]]]:
+        """
+        Return the current generation, the namespace and the recent invalidations, in a single round trip.
+        """
+        values = self.cache.get_many([GENERATION_KEY, NAMESPACE_KEY, LOG_KEY])
+        log = [(entry[0], entry[1], entry[2]) for entry in values.get(LOG_KEY) or []]
+        return values.get(GENERATION_KEY, 0), values.get(NAMESPACE_KEY, 0), log
+
+
+def get_user_caches() -> tuple[IdentityCache[Any], IdentityCache[Any] | None] | None:
+    """
+    Return the user cache and the user row cache of the authentication backend, or None if the backend is not
+    loaded in this process, so its caches are empty.
+
+    The backend is not imported here, since it requires `django.contrib.auth`, which the middleware doesn't.
+    """
+    backends = sys.modules.get(f"{__package__}.backends")
+    if backends is None:
+        return None
+    return backends.get_user_cache(), backends.get_user_row_cache()
+
+
+def invalidate_sid(sid_string: str) -> None:
+    """Remove the identity, group and user of a SID from the in-process caches."""
+    get_identity_cache().delete(sid_string)
+    get_negative_identity_cache().delete(sid_string)
+    get_group_cache().delete(sid_string)
+    user_caches = get_user_caches()
+    if user_caches is None:
+        return
+    user_cache, row_cache = user_caches
+    user_pk = user_cache.get(sid_string)
+    user_cache.delete(sid_string)
+    if row_cache is not None and user_pk is not None:
+        row_cache.delete(str(user_pk))
+
+
+def clear_user_caches() -> None:
+    user_caches = get_user_caches()
+    if user_caches is None:
+        return
+    user_cache, row_cache = user_caches
+    user_cache.clear()
+    if row_cache is not None:
+        row_cache.clear()
+
+
+def invalidate_domain(domain: str) -> None:
+    """Remove the identities and groups of a domain, compared case-insensitively, from the in-process caches."""
+    folded = domain.casefold()
+    get_identity_cache().delete_where(lambda key, value: value[1].casefold() == folded)
+    get_group_cache().delete_where(lambda key, value: value[1].casefold() == folded)
+    # These caches don't know the domain of their entries
+    get_negative_identity_cache().clear()
+    clear_user_caches()
+
+
+def invalidate_all() -> None:
+    """Remove all entries from the in-process caches."""
+    for cache in (get_identity_cache(), get_negative_identity_cache(), get_group_cache()):
+        cache.clear()
+    clear_user_caches()
+
+
+def set_shared_namespace(namespace: int) -> None:
+    """Use the namespace for the keys of the shared caches of this process."""
+    for shared_cache in (get_shared_identity_cache(), get_shared_group_cache()):
+        if shared_cache is not None:
+            shared_cache.namespace = namespace
+
+
+class InvalidationWatcher:
+    """
+    Apply the invalidations published in the shared cache to the in-process caches of this worker.
+
+    The shared cache is read at most once per `check_interval` seconds, by a single thread at a time, so the
+    request path only compares two numbers. When the log doesn't contain every invalidation the worker missed,
+    all in-process caches are cleared.
+
+    Args:
+        log (InvalidationLog): The published invalidations.
+        check_interval (float): The number of seconds between checks.
+    """
+
+    def __init__(self, log: InvalidationLog, check_interval: float = DEFAULT_INVALIDATION_CHECK_INTERVAL) -> None:
+        self.log = log
+        self.check_interval = check_interval
+        self.generation: int | None = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        return time.monotonic() >= self._next_check
+
+    def refresh(self) -> None:
+        """Apply the invalidations published since the last check."""
+        if not self._lock.acquire(blocking=False):
+            # Another thread is checking already
+            return
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                generation, namespace, log = self.log.read()
+            except Exception as err:
+                logger.warning("Cannot read invalidations from shared cache %r: %s", self.log.alias, err)
+                return
+            if self.generation is not None and generation != self.generation:
+                self.apply(generation, log)
+            self.generation = generation
+            set_shared_namespace(namespace)
+        finally:
+            self._lock.release()
+
+    def apply(self, generation: int, log: list[tuple[int, str, str]]) -> None:
+        assert self.generation is not None
+        missed = sorted(entry for entry in log if self.generation < entry[0] <= generation)
+        expected = list(range(self.generation + 1, generation + 1))
+        if not expected or [entry[0] for entry in missed] != expected:
+            # The shared cache was cleared, the log doesn't go back far enough, or concurrent publishes lost an
+            # entry of the log
+            logger.info("Clearing identity caches: generation=%d", generation)
+            invalidate_all()
+            return
+
+        for _, kind, value in missed:
+            logger.debug("Applying invalidation: kind=%r value=%r", kind, value)
+            if kind == INVALIDATE_SID:
+                invalidate_sid(value)
+            elif kind == INVALIDATE_DOMAIN:
+                invalidate_domain(value)
+            else:
+                invalidate_all()
+
+
+@functools.cache
+def get_invalidation_log() -> InvalidationLog | None:
+    """Return the log of invalidations, or None if no shared cache is configured in the Django settings."""
+    alias = getattr(settings, "WINDOWSAUTHTOKEN_SHARED_CACHE", None)
+    if alias is None:
+        return None
+    return InvalidationLog(alias)
+
+
+@functools.cache
+def get_invalidation_watcher() -> InvalidationWatcher | None:
+    """Return the process-wide invalidation watcher, or None if no shared cache is configured."""
+    log = get_invalidation_log()
+    if log is None:
+        return None
+    return InvalidationWatcher(
+        log,
+        check_interval=getattr(
+            settings, "WINDOWSAUTHTOKEN_INVALIDATION_CHECK_INTERVAL", DEFAULT_INVALIDATION_CHECK_INTERVAL
+        ),
+    )
+
+
+def get_invalidation_generation() -> int | None:
+    """Return the generation of the invalidations applied by this worker, or None if no shared cache is configured."""
+    watcher = get_invalidation_watcher()
+    return watcher.generation if watcher is not None else None
+
+
+def check_invalidations() -> None:
+    """Apply new invalidations, when it is time to check for them."""
+    watcher = get_invalidation_watcher()
+    if watcher is not None and watcher.due():
+        watcher.refresh()
+
+
+@receiver(setting_changed)
+def reset_invalidation_watcher(*, setting: str, **kwargs: Any) -> None:
+    if setting == "WINDOWSAUTHTOKEN_SHARED_CACHE":
+        get_invalidation_log.cache_clear()
+    if setting in ("WINDOWSAUTHTOKEN_SHARED_CACHE", "WINDOWSAUTHTOKEN_INVALIDATION_CHECK_INTERVAL"):
+        get_invalidation_watcher.cache_clear()
@@ -0,0 +1,153 @@
+import datetime
+import sqlite3
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from django_windowsauthtoken.cache import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_CACHE_TTL,
+    get_persistent_identity_store,
+    get_shared_identity_cache,
+)
+from django_windowsauthtoken.groups import get_shared_group_cache
+from django_windowsauthtoken.invalidation import (
+    INVALIDATE_ALL,
+    INVALIDATE_DOMAIN,
+    INVALIDATE_SID,
+    get_invalidation_log,
+    set_shared_namespace,
+)
+from django_windowsauthtoken.resolvers import ResolverError, get_resolver
+
+
+class Command(BaseCommand):
+    help = (
+        "Inspect and invalidate the cached identities. Invalidations are removed from the shared cache and the "
+        "persistent store, and reach the in-process caches of running workers through the shared cache."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        subparsers = parser.add_subparsers(dest="action", required=True)
+        subparsers.add_parser("stats", help="Show the cache configuration and the recent invalidations.")
+        lookup = subparsers.add_parser("lookup", help="Show the cached identity of a SID or account name.")
+        lookup.add_argument("account", help="A SID, such as S-1-5-21-..., or an account name, such as DOMAIN\\user.")
+        invalidate = subparsers.add_parser("invalidate", help="Remove a single identity or a whole domain.")
+        target = invalidate.add_mutually_exclusive_group(required=True)
+        target.add_argument("--sid", help="The SID to invalidate.")
+        target.add_argument("--account", help="The account name to invalidate, such as DOMAIN\\user.")
+        target.add_argument("--domain", help="The domain to invalidate, compared case-insensitively.")
+        subparsers.add_parser("flush", help="Remove all cached identities.")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        log = get_invalidation_log()
+        if log is not None:
+            # Use the same keys in the shared cache as the running workers
+            set_shared_namespace(log.read()[1])
+
+        action = options["action"]
+        if action == "stats":
+            self.show_stats()
+        elif action == "lookup":
+            self.show_identity(self.get_sid_string(options["account"]))
+        elif action == "invalidate":
+            if options["domain"]:
+                self.invalidate(INVALIDATE_DOMAIN, options["domain"])
+            else:
+                self.invalidate(INVALIDATE_SID, options["sid"] or self.get_sid_string(options["account"]))
+        else:
+            self.invalidate(INVALIDATE_ALL)
+
+    def get_sid_string(self, account: str) -> str:
+        """Return the SID string of a SID or account name."""
+        if account.upper().startswith("S-1-"):
+            return account
+        resolver = get_resolver()
+        try:
+            security_id, _, _ = resolver.lookup_account_name(account)
+            return resolver.sid_to_string(security_id)
+        except ResolverError as err:
+            raise CommandError(f"Cannot look up account {account!r}: {err}")
+
+    def show_stats(self) -> None:
+        self.stdout.write(
+            f"In-process cache size: {getattr(settings, 'WINDOWSAUTHTOKEN_CACHE_SIZE', DEFAULT_CACHE_SIZE)}"
+        )
+        self.stdout.write(
+            f"In-process cache TTL:  {getattr(settings, 'WINDOWSAUTHTOKEN_CACHE_TTL', DEFAULT_CACHE_TTL)}"
+        )
+
+        log = get_invalidation_log()
+        if log is None:
+            self.stdout.write("Shared cache:          not configured")
+        else:
+            generation, namespace, entries = log.read()
+            self.stdout.write(f"Shared cache:          {log.alias}")
+            self.stdout.write(f"Generation:            {generation}")
+            self.stdout.write(f"Namespace:             {namespace}")
+            for entry_generation, kind, value in entries[-10:]:
+                self.stdout.write(f"Invalidation {entry_generation}: {kind} {value}".rstrip())
+
+        store = get_persistent_identity_store()
+        if store is None:
+            self.stdout.write("Persistent store:      not configured")
+        else:
+            self.stdout.write(f"Persistent store:      {store.path} ({len(store.load())} identities)")
+
+    def show_identity(self, sid_string: str) -> None:
+        self.stdout.write(f"SID:              {sid_string}")
+        shared_cache = get_shared_identity_cache()
+        if shared_cache is not None:
+            cached = shared_cache.get(sid_string)
+            self.stdout.write(f"Shared cache:     {self.format_identity(cached)}")
+        store = get_persistent_identity_store()
+        if store is not None:
+            stored = store.get(sid_string)
+            if stored is None:
+                self.stdout.write("Persistent store: not found")
+            else:
+                resolved_at = datetime.datetime.fromtimestamp(stored[2], tz=datetime.timezone.utc)
+                identity = self.format_identity(stored[:2])
+                self.stdout.write(f"Persistent store: {identity}, resolved at {resolved_at.isoformat()}")
+
+    def format_identity(self, identity: tuple[str, str] | None) -> str:
+        if identity is None:
+            return "not found"
+        user, domain = identity
+        return rf"{domain}\{user}" if domain else user
+
+    def invalidate(self, kind: str, value: str = "") -> None:
+        """Remove the identities from the shared cache and the persistent store, and publish the invalidation."""
+        if kind == INVALIDATE_SID:
+            # Domain and flush invalidations change the namespace of the shared cache instead
+            for shared_cache in (get_shared_identity_cache(), get_shared_group_cache()):
+                if shared_cache is not None:
+                    shared_cache.delete(value)
+
+        store = get_persistent_identity_store()
+        if store is not None:
+            try:
+                deleted = store.delete(
+                    key=value if kind == INVALIDATE_SID else None,
+                    domain=value if kind == INVALIDATE_DOMAIN else None,
+                )
+            except sqlite3.Error as err:
+                raise CommandError(f"Cannot write to persistent identity store {store.path!r}: {err}")
+            self.stdout.write(f"Deleted {deleted} identities from the persistent store.")
+
+        log = get_invalidation_log()
+        if log is None:
+            self.stderr.write(
+                self.style.WARNING(
+                    "No shared cache is configured, running workers keep their cached identities until they expire."
+                )
+            )
+            return
+        try:
+            generation = log.publish(kind, value)
+        except Exception as err:
+            raise CommandError(f"Cannot publish invalidation to shared cache {log.alias!r}: {err}")
+        if kind != INVALIDATE_SID:
+            set_shared_namespace(generation)
+        self.stdout.write(self.style.SUCCESS(f"Published invalidation {generation}: {kind} {value}".rstrip()))
@@ -0,0 +1,48 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from django_windowsauthtoken.replay import REPLAY_MODES, replay_trace
+from django_windowsauthtoken.trace import read_trace
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a trace recorded with WINDOWSAUTHTOKEN_TRACE_FILE against the middleware, with a simulated Windows "
+        "API, and report the throughput and latencies."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("trace_file", help="The trace file to replay.")
+        parser.add_argument(
+            "--speed", type=float, default=1.0, help="Replay this many times faster than recorded, 0 for no pauses."
+        )
+        parser.add_argument("--workers", type=int, default=4, help="Number of concurrent threads or tasks.")
+        parser.add_argument("--mode", choices=REPLAY_MODES, default="threads", help="Use threads or asyncio tasks.")
+        parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per simulated token read.")
+        parser.add_argument("--lookup-latency", type=float, default=0.0, help="Seconds per simulated account lookup.")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        try:
+            entries = read_trace(options["trace_file"])
+        except (OSError, KeyError, ValueError) as err:
+            raise CommandError(f"Cannot read trace file {options['trace_file']!r}: {err}")
+        if not entries:
+            raise CommandError("The trace file contains no requests.")
+
+        report = replay_trace(
+            entries,
+            speed=options["speed"],
+            workers=options["workers"],
+            mode=options["mode"],
+            token_latency=options["token_latency"],
+            lookup_latency=options["lookup_latency"],
+        )
+        self.stdout.write(f"Requests:   {report.requests}")
+        self.stdout.write(f"Duration:   {report.elapsed:.3f} s")
+        self.stdout.write(f"Throughput: {report.throughput:.1f} requests/s")
+        for percent in (50, 90, 99):
+            self.stdout.write(f"{f'p{percent}:':<12}{report.percentile(percent) * 1000:.3f} ms")
+        self.stdout.write(f"Max:        {max(report.latencies) * 1000:.3f} ms")
+        for outcome, count in report.outcomes.items():
+            self.stdout.write(f"Outcome {outcome}: {count}")
@@ -0,0 +1,35 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from django_windowsauthtoken.warmup import (
+    DEFAULT_WARMUP_BATCH_SIZE,
+    DEFAULT_WARMUP_DAYS,
+    DEFAULT_WARMUP_LIMIT,
+    DEFAULT_WARMUP_WORKERS,
+    warm_identity_cache,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Pre-fill the identity cache with the accounts of recently active users, or the given account names. "
+        "Mostly useful with a shared cache, since the in-process cache of this command is discarded when it exits."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("usernames", nargs="*", help="Account names to resolve, instead of the recent users.")
+        parser.add_argument("--days", type=int, default=DEFAULT_WARMUP_DAYS, help="Include users active this recently.")
+        parser.add_argument("--limit", type=int, default=DEFAULT_WARMUP_LIMIT, help="Maximum number of users.")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_WARMUP_BATCH_SIZE, help="Accounts per batch.")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WARMUP_WORKERS, help="Concurrent lookups.")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        warmed = warm_identity_cache(
+            usernames=options["usernames"] or None,
+            days=options["days"],
+            limit=options["limit"],
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Warmed {warmed} identities."))
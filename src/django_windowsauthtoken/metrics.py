@@ -0,0 +1,350 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from collections.abc import Iterator
+from contextvars import ContextVar
+from typing import Any
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .trace import record_trace_outcome
+
+STAGE_HEADER_PARSE = "header_parse"
+STAGE_GET_TOKEN_INFORMATION = "get_token_information"
+STAGE_CLOSE_HANDLE = "close_handle"
+STAGE_LOOKUP_ACCOUNT_SID = "lookup_account_sid"
+STAGE_FORMAT_USERNAME = "format_username"
+
+STAGES = (
+    STAGE_HEADER_PARSE,
+    STAGE_GET_TOKEN_INFORMATION,
+    STAGE_CLOSE_HANDLE,
+    STAGE_LOOKUP_ACCOUNT_SID,
+    STAGE_FORMAT_USERNAME,
+)
+"""The stages of token resolution that are timed."""
+
+OUTCOME_NO_TOKEN = "no_token"
+OUTCOME_INVALID_TOKEN = "invalid_token"
+OUTCOME_LOOKUP_FAILURE = "lookup_failure"
+OUTCOME_FORMATTING_ERROR = "formatting_error"
+OUTCOME_SUCCESS = "success"
+OUTCOME_BYPASSED = "bypassed"
+
+OUTCOMES = (
+    OUTCOME_NO_TOKEN,
+    OUTCOME_BYPASSED,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_LOOKUP_FAILURE,
+    OUTCOME_FORMATTING_ERROR,
+    OUTCOME_SUCCESS,
+)
+"""The possible outcomes of a request passing through the middleware."""
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+"""Default upper bounds, in seconds, of the latency histogram buckets."""
+
+DEFAULT_EXPORTER = f"{__name__}.PrometheusExporter"
+
+SOURCE_CACHE = "cache"
+SOURCE_STALE_CACHE = "stale-cache"
+SOURCE_SHARED_CACHE = "shared-cache"
+SOURCE_NEGATIVE_CACHE = "negative-cache"
+SOURCE_SESSION = "session"
+SOURCE_LOOKUP = "lookup"
+
+SERVER_TIMING_METRICS = {
+    # Server-Timing metric name: (description, stages)
+    "windowsauthtoken-token": (
+        "Token inspection",
+        (STAGE_HEADER_PARSE, STAGE_GET_TOKEN_INFORMATION, STAGE_CLOSE_HANDLE),
+    ),
+    "windowsauthtoken-lookup": ("Account lookup", (STAGE_LOOKUP_ACCOUNT_SID,)),
+    "windowsauthtoken-format": ("Formatting", (STAGE_FORMAT_USERNAME,)),
+}
+"""The entries of the Server-Timing header, and the stages they are composed of."""
+
+
+class _Shard:
+    """Metrics recorded by a single thread, so recording needs no lock."""
+
+    def __init__(self, bucket_count: int) -> None:
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.sums = dict.fromkeys(STAGES, 0.0)
+        self.buckets = {stage: [0] * bucket_count for stage in STAGES}
+
+
+class MetricsCollector:
+    """
+    Counters and latency histograms for the middleware.
+
+    Every thread records into its own shard, so the request path never contends for a lock.
+    The shards are only combined when a snapshot is taken.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._local = threading.local()
+        self._shards: list[_Shard] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> _Shard:
+        try:
+            shard: _Shard = self._local.shard
+        except AttributeError:
+            # One extra bucket for values above the largest bound
+            shard = self._local.shard = _Shard(len(self.buckets) + 1)
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Record the duration of a stage."""
+        shard = self._shard()
+        shard.sums[stage] += seconds
+        shard.buckets[stage][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, outcome: str) -> None:
+        """Count a request outcome."""
+        self._shard().outcomes[outcome] += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Combine the shards into a snapshot of all metrics.
+
+        Returns:
+            dict[str, Any]: The outcome counts, and for every stage the observation count, the sum
+                of durations and the cumulative histogram as `(upper bound, count)` pairs.
+        """
+        with self._lock:
+            shards = list(self._shards)
+
+        outcomes = {outcome: sum(shard.outcomes[outcome] for shard in shards) for outcome in OUTCOMES}
+        stages = {}
+        for stage in STAGES:
+            counts = [sum(column) for column in zip(*(shard.buckets[stage] for shard in shards))]
+            counts = counts or [0] * (len(self.buckets) + 1)
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            stages[stage] = {
+                "count": cumulative,
+                "sum": sum(shard.sums[stage] for shard in shards),
+                "buckets": buckets,
+            }
+        return {"outcomes": outcomes, "stages": stages}
+
+
+class MetricsExporter:
+    """
+    Interface for rendering a metrics snapshot, e.g. for a monitoring system to scrape.
+    """
+
+    content_type = "text/plain"
+
+    def export(self, snapshot: dict[str, Any]) -> str:
+        raise NotImplementedError
+
+
+class PrometheusExporter(MetricsExporter):
+    """
+    Render a metrics snapshot in the Prometheus text exposition format.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+    namespace = "windowsauthtoken"
+
+    def export(self, snapshot: dict[str, Any]) -> str:
+        lines = [
+            f"# HELP {self.namespace}_requests_total Requests handled by the middleware, by outcome.",
+            f"# TYPE {self.namespace}_requests_total counter",
+        ]
+        for outcome, count in snapshot["outcomes"].items():
+            lines.append(f'{self.namespace}_requests_total{{outcome="{outcome}"}} {count}')
+
+        metric = f"{self.namespace}_stage_duration_seconds"
+        lines.append(f"# HELP {metric} Time spent in each stage of token resolution.")
+        lines.append(f"# TYPE {metric} histogram")
+        for stage, histogram in snapshot["stages"].items():
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram["sum"]!r}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram["count"]}')
+        if "handles" in snapshot:
+            lines.extend(self.export_handles(snapshot["handles"]))
+        return "\n".join(lines) + "\n"
+
+    def export_handles(self, handles: dict[str, Any]) -> list[str]:
+        metrics = [
+            ("handles_opened_total", "counter", "Token handles received.", handles["opened"]),
+            ("handles_closed_total", "counter", "Token handles closed.", handles["closed"]),
+            (
+                "handle_close_failures_total",
+                "counter",
+                "Token handles that failed to close.",
+                handles["close_failures"],
+            ),
+            ("handles_in_flight", "gauge", "Token handles received and not closed yet.", handles["in_flight"]),
+            ("handle_held_seconds_sum", "counter", "Total time token handles were held.", handles["held_seconds_sum"]),
+            ("handle_held_seconds_max", "gauge", "Longest time a token handle was held.", handles["held_seconds_max"]),
+        ]
+        lines = []
+        for name, metric_type, description, value in metrics:
+            lines.append(f"# HELP {self.namespace}_{name} {description}")
+            lines.append(f"# TYPE {self.namespace}_{name} {metric_type}")
+            lines.append(f"{self.namespace}_{name} {value!r}")
+        return lines
+
+
+class RequestTimings:
+    """
+    Stage durations, identity source and outcome for a single request, used for the Server-Timing header.
+    """
+
+    def __init__(self) -> None:
+        self.durations: dict[str, float] = {}
+        self.source: str | None = None
+        self.outcome: str | None = None
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """Render the timings as a Server-Timing header value, with durations in milliseconds."""
+        entries = []
+        for name, (description, stages) in SERVER_TIMING_METRICS.items():
+            if any(stage in self.durations for stage in stages):
+                duration = sum(self.durations.get(stage, 0.0) for stage in stages) * 1000
+                entries.append(f'{name};dur={duration:.3f};desc="{description}"')
+        if self.source is not None:
+            entries.append(f'windowsauthtoken-source;desc="{self.source}"')
+        return ", ".join(entries)
+
+
+_request_timings: ContextVar[RequestTimings | None] = ContextVar("windowsauthtoken_request_timings", default=None)
+"""Timings of the current request, only set while Server-Timing or tracing spans are being recorded."""
+
+
+@contextlib.contextmanager
+def record_request_timings(timings: RequestTimings | None = None) -> Iterator[RequestTimings]:
+    """
+    Record the stage durations, identity source and outcome within the block into a `RequestTimings`.
+
+    The timings are kept in a context variable, so they are also recorded in threads started
+    with `sync_to_async`, which copy the context.
+
+    Args:
+        timings (RequestTimings | None): The timings to record into, or None for new ones.
+    """
+    if timings is None:
+        timings = RequestTimings()
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def histogram_quantile(buckets: list[tuple[float, int]], quantile: float) -> float | None:
+    """
+    Estimate a quantile from a cumulative histogram, by linear interpolation within the bucket it falls in.
+
+    Args:
+        buckets (list[tuple[float, int]]): The cumulative histogram as `(upper bound, count)` pairs, as in a
+            metrics snapshot.
+        quantile (float): The quantile to estimate, between 0 and 1.
+    Returns:
+        float | None: The estimated value, or None if the histogram is empty. Values in the last bucket are
+            estimated as the largest finite bound.
+    """
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+
+    rank = quantile * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank and count > lower_count:
+            if bound == float("inf"):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+@functools.cache
+def get_metrics() -> MetricsCollector | None:
+    """Return the process-wide metrics collector, or None if metrics are disabled in the Django settings."""
+    if not getattr(settings, "WINDOWSAUTHTOKEN_METRICS", False):
+        return None
+    return MetricsCollector(buckets=getattr(settings, "WINDOWSAUTHTOKEN_METRICS_BUCKETS", DEFAULT_BUCKETS))
+
+
+@functools.cache
+def get_metrics_exporter() -> MetricsExporter:
+    """
+    Return the configured metrics exporter.
+
+    Raises:
+        ImproperlyConfigured: If the exporter cannot be imported.
+    """
+    exporter_path = getattr(settings, "WINDOWSAUTHTOKEN_METRICS_EXPORTER", DEFAULT_EXPORTER)
+    try:
+        exporter_class = import_string(exporter_path)
+    except ImportError as err:
+        raise ImproperlyConfigured(f"Cannot import metrics exporter {exporter_path!r}: {err}")
+    exporter: MetricsExporter = exporter_class()
+    return exporter
+
+
+def observe_stage(stage: str, started: float) -> None:
+    """
+    Record the duration of a stage that started at `started`, as returned by `time.perf_counter()`.
+
+    Does nothing when metrics are disabled and no request timings are being recorded.
+    """
+    metrics = get_metrics()
+    timings = _request_timings.get()
+    if metrics is None and timings is None:
+        return
+
+    elapsed = time.perf_counter() - started
+    if metrics is not None:
+        metrics.observe(stage, elapsed)
+    if timings is not None:
+        timings.add(stage, elapsed)
+
+
+def record_identity_source(source: str) -> None:
+    """Record where the identity of the current request came from, when request timings are being recorded."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.source = source
+
+
+def count_outcome(outcome: str) -> None:
+    """Count a request outcome, and record it in the trace and request timings if they are being recorded."""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.count(outcome)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.outcome = outcome
+    record_trace_outcome(outcome)
+
+
+@receiver(setting_changed)
+def reset_metrics(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_METRICS", "WINDOWSAUTHTOKEN_METRICS_BUCKETS"):
+        get_metrics.cache_clear()
+    elif setting == "WINDOWSAUTHTOKEN_METRICS_EXPORTER":
+        get_metrics_exporter.cache_clear()
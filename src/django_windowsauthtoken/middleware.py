@@ -1,29 +1,375 @@
+import contextlib
+import functools
 import logging
-import os
-from typing import Callable
+import re
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import HttpRequest, HttpResponse
+from django.urls import Resolver404, resolve
 from django.utils.module_loading import import_string
 
-from .formatters import DEFAULT_FORMATTER, FormattingError
+from .bypass import PathPrefixTrie
+from .cache import (
+    DEFAULT_CACHE_TTL,
+    SingleFlight,
+    get_identity_cache,
+    get_negative_identity_cache,
+    get_persistent_identity_store,
+    get_shared_identity_cache,
+)
+from .checks import check_pywin32
+from .formatters import DEFAULT_FORMATTER, FormattingError, compile_formatter_pipeline
+from .groups import resolve_group_names
+from .handles import track_handle_closed, track_handle_opened
+from .invalidation import check_invalidations, get_invalidation_generation, get_invalidation_watcher
+from .metrics import (
+    OUTCOME_BYPASSED,
+    OUTCOME_FORMATTING_ERROR,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_LOOKUP_FAILURE,
+    OUTCOME_NO_TOKEN,
+    OUTCOME_SUCCESS,
+    SOURCE_CACHE,
+    SOURCE_LOOKUP,
+    SOURCE_NEGATIVE_CACHE,
+    SOURCE_SESSION,
+    SOURCE_SHARED_CACHE,
+    SOURCE_STALE_CACHE,
+    STAGE_CLOSE_HANDLE,
+    STAGE_FORMAT_USERNAME,
+    STAGE_GET_TOKEN_INFORMATION,
+    STAGE_HEADER_PARSE,
+    STAGE_LOOKUP_ACCOUNT_SID,
+    RequestTimings,
+    count_outcome,
+    observe_stage,
+    record_identity_source,
+    record_request_timings,
+)
+from .resolvers import ERROR_NONE_MAPPED, CircuitOpenError, ResolverError, get_circuit_breaker, get_resolver
+from .trace import get_trace_recorder, record_trace_sid
+from .tracing import get_tracer, sampled, tracing_request
 
 logger = logging.getLogger("windowsauthtoken")
 
-_IGNORE_PYWIN32_ERRORS = os.getenv("WINDOWSAUTHTOKEN_IGNORE_PYWIN32_ERRORS", "false") == "true"
-"""Flag to ignore platform-specific errors, useful for non-Windows environments."""
 
-try:  # pragma: no cover
-    import pywintypes
-    import win32api
-    import win32security
-except ImportError:  # pragma: no cover
-    if _IGNORE_PYWIN32_ERRORS:
-        logger.warning("pywin32 is not installed, but errors are being ignored.")
-    pywintypes = None  # type: ignore[assignment]
-    win32api = None  # type: ignore[assignment]
-    win32security = None  # type: ignore[assignment]
+class InvalidTokenError(ValueError):
+    """Raised when the token is malformed or cannot be inspected."""
+
+    pass
+
+
+class AccountLookupError(ValueError):
+    """Raised when the account details for a valid token cannot be retrieved."""
+
+    pass
+
+
+_TOKEN_HANDLE_PATTERN = re.compile(r"(0[xX])?[0-9a-fA-F]{1,16}")
+"""A token handle is a 64-bit value, formatted as hexadecimal number."""
+
+_account_lookups: SingleFlight[tuple[str, str]] = SingleFlight()
+"""Account lookups in flight, so concurrent requests for the same SID share a single lookup."""
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="windowsauthtoken-refresh")
+"""Refreshes stale identities in the background. Threads are only started when the first refresh is submitted."""
+
+_refreshing: set[str] = set()
+"""SIDs that are being refreshed in the background, so every SID is refreshed only once at a time."""
+
+_refreshing_lock = threading.Lock()
+
+
+class ResolvedToken:
+    """
+    Details of the token of the current request, besides the username and domain.
+
+    They are collected while the token is resolved, possibly in another thread, and stored on the request
+    by the middleware.
+
+    Args:
+        with_groups (bool): Whether to retrieve the groups of the token.
+    """
+
+    def __init__(self, with_groups: bool = False) -> None:
+        self.with_groups = with_groups
+        self.sid_string: str | None = None
+        self.group_names: frozenset[str] | None = None
+
+
+_resolved_token: ContextVar[ResolvedToken | None] = ContextVar("windowsauthtoken_resolved_token", default=None)
+"""The token that is being resolved for the current request, if any."""
+
+
+@contextlib.contextmanager
+def resolving_token(with_groups: bool = False) -> Iterator[ResolvedToken]:
+    """
+    Collect the details of the token that is resolved within the block.
+
+    The details are kept in a context variable, which is shared with threads started with `sync_to_async`.
+    """
+    resolved = ResolvedToken(with_groups)
+    reset_token = _resolved_token.set(resolved)
+    try:
+        yield resolved
+    finally:
+        _resolved_token.reset(reset_token)
+
+
+@functools.cache
+def _debug_tracing_setting() -> bool:
+    return bool(getattr(settings, "WINDOWSAUTHTOKEN_DEBUG_TRACING", True))
+
+
+def debug_tracing_enabled() -> bool:
+    """
+    Check whether per-request debug messages should be logged.
+
+    Both the setting and the logger level are cached (the latter by the logging module itself),
+    so this is cheap enough to guard every debug message on the request path.
+    """
+    return _debug_tracing_setting() and logger.isEnabledFor(logging.DEBUG)
+
+
+@receiver(setting_changed)
+def reset_debug_tracing(*, setting: str, **kwargs: Any) -> None:
+    if setting == "WINDOWSAUTHTOKEN_DEBUG_TRACING":
+        _debug_tracing_setting.cache_clear()
+
+
+def security_id_to_string(security_id: Any) -> str:
+    """
+    Convert a security ID to its string form.
+
+    Raises:
+        AccountLookupError: If the security ID is invalid.
+    """
+    try:
+        sid_string = get_resolver().sid_to_string(security_id)
+    except ResolverError as err:
+        raise AccountLookupError(f"Can't retrieve account details for SID: {err}")
+
+    resolved = _resolved_token.get()
+    if resolved is not None:
+        resolved.sid_string = sid_string
+    record_trace_sid(sid_string)
+    return sid_string
+
+
+def lookup_account_details(security_id: Any, sid_string: str | None = None) -> tuple[str, str]:
+    """
+    Look up the username and domain for a security ID, using the identity caches when possible.
+
+    Args:
+        security_id (Any): The security ID retrieved from the token.
+        sid_string (str | None): The string form of the security ID, if it is already known.
+    Returns:
+        tuple[str, str]: A tuple containing the username and domain.
+    Raises:
+        AccountLookupError: If the account details cannot be retrieved.
+    """
+    if sid_string is None:
+        sid_string = security_id_to_string(security_id)
+
+    identity_cache = get_identity_cache()
+    cached = identity_cache.get(sid_string)
+    if cached is not None:
+        if debug_tracing_enabled():
+            logger.debug("Using cached account details for SID: sid_string=%r cached=%r", sid_string, cached)
+        record_identity_source(SOURCE_CACHE)
+        return cached
+
+    stale = identity_cache.get_stale(sid_string)
+    if stale is not None:
+        # Serve the expired identity right away, instead of making the request wait for the lookup
+        if debug_tracing_enabled():
+            logger.debug("Using stale account details for SID: sid_string=%r stale=%r", sid_string, stale)
+        record_identity_source(SOURCE_STALE_CACHE)
+        refresh_account_details(security_id, sid_string)
+        return stale
+
+    negative_cache = get_negative_identity_cache()
+    failure = negative_cache.get(sid_string)
+    if failure is not None:
+        record_identity_source(SOURCE_NEGATIVE_CACHE)
+        raise AccountLookupError(f"Can't retrieve account details for SID: {failure} (cached)")
+
+    try:
+        user_details = _account_lookups.do(sid_string, lambda: _resolve_account(security_id, sid_string))
+    except ResolverError as err:
+        # Only accounts that don't exist are remembered, not failures of the domain controller, which would keep
+        # refusing the user after it recovers
+        if err.winerror == ERROR_NONE_MAPPED:
+            negative_cache.set(sid_string, str(err))
+        raise AccountLookupError(f"Can't retrieve account details for SID: {err}")
+
+    _remember_account(sid_string, user_details)
+    return user_details
+
+
+def refresh_account_details(security_id: Any, sid_string: str) -> None:
+    """
+    Look up the account details for a security ID in the background, and update the identity caches.
+
+    Does nothing when a refresh for the security ID is already in progress.
+    """
+    with _refreshing_lock:
+        if sid_string in _refreshing:
+            return
+        _refreshing.add(sid_string)
+    _refresh_executor.submit(_refresh_account, security_id, sid_string)
+
+
+def _refresh_account(security_id: Any, sid_string: str) -> None:
+    try:
+        user_details = _account_lookups.do(sid_string, lambda: _resolve_account(security_id, sid_string))
+    except ResolverError as err:
+        # The stale identity keeps being served until the refresh succeeds, or it expires
+        logger.warning("Cannot refresh account details for SID: sid_string=%r error=%s", sid_string, err)
+    else:
+        _remember_account(sid_string, user_details)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(sid_string)
+
+
+def _remember_account(sid_string: str, user_details: tuple[str, str]) -> None:
+    get_identity_cache().set(sid_string, user_details)
+    persistent_store = get_persistent_identity_store()
+    if persistent_store is not None:
+        persistent_store.set(sid_string, user_details)
+
+
+def _resolve_account(security_id: Any, sid_string: str) -> tuple[str, str]:
+    """Resolve the account details from the shared identity cache, or from the resolver on a miss."""
+    shared_cache = get_shared_identity_cache()
+    if shared_cache is not None:
+        cached = shared_cache.get(sid_string)
+        if cached is not None:
+            if debug_tracing_enabled():
+                logger.debug("Using shared cached account details for SID: sid_string=%r cached=%r", sid_string, cached)
+            record_identity_source(SOURCE_SHARED_CACHE)
+            return cached
+
+    circuit_breaker = get_circuit_breaker()
+    if circuit_breaker is not None and not circuit_breaker.allow():
+        raise CircuitOpenError("Account lookups are suspended after repeated failures.")
+
+    record_identity_source(SOURCE_LOOKUP)
+    started = time.perf_counter()
+    try:
+        user, domain, account_type = get_resolver().lookup_account_sid(security_id)
+    except ResolverError as err:
+        if circuit_breaker is not None:
+            circuit_breaker.record_failure(err)
+        raise
+    finally:
+        observe_stage(STAGE_LOOKUP_ACCOUNT_SID, started)
+    if circuit_breaker is not None:
+        circuit_breaker.record_success(time.perf_counter() - started)
+    if debug_tracing_enabled():
+        logger.debug(
+            "Retrieved account details for SID: security_id=%r user=%r domain=%r account_type=%r",
+            security_id,
+            user,
+            domain,
+            account_type,
+        )
+
+    if shared_cache is not None:
+        shared_cache.set(sid_string, (user, domain))
+    return user, domain
+
+
+def parse_token_handle(auth_token: str) -> int:
+    """
+    Parse the token header value into a token handle.
+
+    Malformed values are rejected before any call to the Windows API is made. Note that `int()` alone
+    is too lenient here, since it accepts signs, whitespace and underscores.
+
+    Args:
+        auth_token (str): The Windows Authentication Token.
+    Returns:
+        int: The token handle.
+    Raises:
+        InvalidTokenError: If the value is not a valid token handle.
+    """
+    if not _TOKEN_HANDLE_PATTERN.fullmatch(auth_token):
+        raise InvalidTokenError("Invalid token format.")
+    token_handle = int(auth_token, 16)
+    if token_handle == 0:
+        raise InvalidTokenError("Invalid token format.")
+    return token_handle
+
+
+def close_token_handle(token_handle: int) -> None:
+    """Close the token handle, logging any issues with it instead of raising them."""
+    started = time.perf_counter()
+    try:
+        get_resolver().close_handle(token_handle)
+    except ResolverError as err:
+        # just log and continue
+        logger.warning("Failed to close token handle: %s", err)
+        track_handle_closed(token_handle, failed=True)
+    else:
+        track_handle_closed(token_handle)
+    observe_stage(STAGE_CLOSE_HANDLE, started)
+
+
+def retrieve_security_id(auth_token: str) -> Any:
+    """
+    Retrieve the security ID of the user for the Windows Authentication Token, and close the token handle.
+
+    Args:
+        auth_token (str): The Windows Authentication Token.
+    Returns:
+        Any: The security ID, in the format used by the resolver.
+    Raises:
+        InvalidTokenError: If the token is invalid or cannot be processed.
+    """
+    resolver = get_resolver()
+
+    started = time.perf_counter()
+    try:
+        token_handle = parse_token_handle(auth_token)
+    finally:
+        observe_stage(STAGE_HEADER_PARSE, started)
+    track_handle_opened(token_handle)
+
+    resolved = _resolved_token.get()
+    with_groups = resolved is not None and resolved.with_groups
+    started = time.perf_counter()
+    try:
+        security_id = resolver.get_token_user(token_handle)
+        group_sids = resolver.get_token_groups(token_handle) if with_groups else []
+    except ResolverError as err:
+        raise InvalidTokenError(f"Can't retrieve Security ID for token: {err}")
+    finally:
+        observe_stage(STAGE_GET_TOKEN_INFORMATION, started)
+        close_token_handle(token_handle)
+
+    if resolved is not None and with_groups:
+        resolved.group_names = resolve_group_names(group_sids)
+
+    if debug_tracing_enabled():
+        logger.debug(
+            "Retrieved security ID for auth token: auth_token=%r token_handle=%r security_id=%r",
+            auth_token,
+            token_handle,
+            security_id,
+        )
+    return security_id
 
 
 class WindowsAuthTokenMiddleware:
@@ -32,98 +378,366 @@ class WindowsAuthTokenMiddleware:
     """
 
     sync_capable = True
+    async_capable = True
 
     header_name = "X-IIS-WindowsAuthToken"
     """The HTTP header name where the Windows Authentication Token is expected."""
 
-    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]) -> None:
+    session_key = "_windowsauthtoken_identity"
+    """The session key where the resolved identity is pinned, when session pinning is enabled."""
+
+    def __init__(self, get_response: Callable[[HttpRequest], Any]) -> None:
         self.get_response = get_response
         self.username_formatter: str = getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_FORMATTER", DEFAULT_FORMATTER)
+        self.formatter_pipeline: dict[str, Any] | None = getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_PIPELINE", None)
+        self.formatter = self.load_username_formatter()
+        # Only rebuild the formatter when the settings change, i.e. in tests
+        setting_changed.connect(self.on_setting_changed)
+
+        self.session_pinning: bool = getattr(settings, "WINDOWSAUTHTOKEN_SESSION_PINNING", False)
+        self.session_pinning_ttl: float = getattr(settings, "WINDOWSAUTHTOKEN_CACHE_TTL", DEFAULT_CACHE_TTL)
+        self.server_timing: bool = getattr(settings, "WINDOWSAUTHTOKEN_SERVER_TIMING", False)
+        self.token_groups: bool = getattr(settings, "WINDOWSAUTHTOKEN_GROUPS", False)
+        self.trace_recorder = get_trace_recorder()
+        self.load_tracing()
+        self.load_bypass_rules()
+
+        # Fail early when the resolver is not available. pywin32 is only located, not loaded. Importing the
+        # check also registers it, for projects that don't have the app in INSTALLED_APPS
+        get_resolver()
+        errors = check_pywin32()
+        if errors:
+            raise ImproperlyConfigured(f"{errors[0].msg} {errors[0].hint}")
 
-        if not any([win32security, pywintypes, win32api]) and not _IGNORE_PYWIN32_ERRORS:
-            raise ImproperlyConfigured("pywin32 is required for Windows Authentication Token middleware.'")
+        # Start with the identities resolved before the last restart
+        persistent_store = get_persistent_identity_store()
+        if persistent_store is not None:
+            persistent_store.load_into(get_identity_cache())
+        if getattr(settings, "WINDOWSAUTHTOKEN_WARMUP", False):
+            # Imported here, since the warm-up needs the user model, which the middleware doesn't
+            from .warmup import start_process_warmup
 
-    def __call__(self, request: HttpRequest) -> HttpResponse:
+            start_process_warmup()
+
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            # Mark the instance as async-capable, so Django awaits __call__ without an extra thread hop
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest) -> Any:
+        if self.async_mode:
+            return self.__acall__(request)
+
+        if not self.server_timing and self.trace_recorder is None and self.tracer is None:
+            self.process_request(request)
+            return self.get_response(request)
+
+        with self.instrument_request(request) as timings:
+            self.process_request(request)
+        response = self.get_response(request)
+        if timings is not None:
+            self.add_server_timing(response, timings)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        if not self.server_timing and self.trace_recorder is None and self.tracer is None:
+            await self.aprocess_request(request)
+            response: HttpResponse = await self.get_response(request)
+            return response
+
+        with self.instrument_request(request) as timings:
+            await self.aprocess_request(request)
+        response = await self.get_response(request)
+        if timings is not None:
+            self.add_server_timing(response, timings)
+        return response
+
+    @contextlib.contextmanager
+    def instrument_request(self, request: HttpRequest) -> Iterator[RequestTimings | None]:
+        """
+        Record the Server-Timing entries, the trace entry and the tracing spans of the request processed within
+        the block, if enabled.
+
+        Returns:
+            Iterator[RequestTimings | None]: The timings for the Server-Timing header, or None if disabled.
+        """
+        with contextlib.ExitStack() as stack:
+            if self.trace_recorder is not None:
+                stack.enter_context(self.trace_recorder.recording(token=bool(request.headers.get(self.header_name))))
+            timings: RequestTimings | None = None
+            if self.tracer is not None and sampled(self.tracing_sample_rate):
+                # The spans are recorded from the same timings as the Server-Timing entries
+                timings = stack.enter_context(tracing_request(self.tracer))
+            if timings is None and self.server_timing:
+                timings = stack.enter_context(record_request_timings())
+            yield timings if self.server_timing else None
+
+    def process_request(self, request: HttpRequest) -> None:
+        """Resolve the token in the request, if any, and set the user on the request."""
         auth_token = request.headers.get(self.header_name, "")
-        if auth_token:
-            try:
-                username, domain = self.retrieve_auth_user_details(auth_token)
-            except ValueError as err:
-                logger.warning(f"Cannot retrieve username from auth token: {err}")
-                username = None
-                domain = None
+        check_invalidations()
+        if not auth_token:
+            count_outcome(OUTCOME_NO_TOKEN)
+        elif self.is_bypassed(request):
+            self.process_bypassed_token(auth_token)
+        elif self.session_pinning and hasattr(request, "session"):
+            with resolving_token(self.token_groups):
+                self.process_pinned_identity(request, auth_token)
         else:
-            username = None
-            domain = None
-
-        if username is not None and domain is not None:
-            try:
-                formatted_user = self.format_username(username, domain)
-            except FormattingError as err:
-                logger.warning(f"Username formatter raised an error: {err} {username=} {domain=}")
-                formatted_user = None
+            with resolving_token(self.token_groups):
+                self.process_user_details(request, self.get_user_details(auth_token))
+
+    async def aprocess_request(self, request: HttpRequest) -> None:
+        """Async version of `process_request`, which runs the blocking calls outside of the event loop."""
+        auth_token = request.headers.get(self.header_name, "")
+        watcher = get_invalidation_watcher()
+        if watcher is not None and watcher.due():
+            await sync_to_async(watcher.refresh, thread_sensitive=False)()
+        if not auth_token:
+            count_outcome(OUTCOME_NO_TOKEN)
+        elif self.is_bypassed(request):
+            await sync_to_async(self.process_bypassed_token, thread_sensitive=False)(auth_token)
+        elif self.session_pinning and hasattr(request, "session"):
+            with resolving_token(self.token_groups):
+                await self.aprocess_pinned_identity(request, auth_token)
         else:
-            formatted_user = None
+            with resolving_token(self.token_groups):
+                # Only the blocking resolver calls are moved off the event loop
+                user_details = await sync_to_async(self.get_user_details, thread_sensitive=False)(auth_token)
+                self.process_user_details(request, user_details)
+
+    def load_tracing(self) -> None:
+        """
+        Load the tracer and the fraction of requests to trace.
 
-        if formatted_user is not None:
-            # Set the REMOTE_USER environment variable
-            request.META["REMOTE_USER"] = formatted_user
-            # In async contexts, there is no environment variable, so we set it in META as a HTTP header,
-            # just like the RemoteUserMiddleware expects it for async requests.
-            request.META["HTTP_REMOTE_USER"] = formatted_user
-            # Save the original auth results for reference
-            request.META["WINDOWSAUTHTOKEN_USER"] = username
-            request.META["WINDOWSAUTHTOKEN_DOMAIN"] = domain
+        Raises:
+            ImproperlyConfigured: If the tracer cannot be loaded, or the sample rate is not between 0 and 1.
+        """
+        self.tracer = get_tracer()
+        self.tracing_sample_rate: float = getattr(settings, "WINDOWSAUTHTOKEN_TRACING_SAMPLE_RATE", 1.0)
+        if not 0 <= self.tracing_sample_rate <= 1:
+            raise ImproperlyConfigured(
+                f"WINDOWSAUTHTOKEN_TRACING_SAMPLE_RATE must be between 0 and 1, not {self.tracing_sample_rate!r}."
+            )
 
-            logger.debug(f"Set REMOTE_USER to {formatted_user}")
+    def load_bypass_rules(self) -> None:
+        """Compile the paths and URL names of requests that skip token resolution."""
+        self.bypass_paths = PathPrefixTrie(getattr(settings, "WINDOWSAUTHTOKEN_BYPASS_PATHS", ()))
+        self.bypass_url_names = frozenset(getattr(settings, "WINDOWSAUTHTOKEN_BYPASS_URL_NAMES", ()))
 
-        return self.get_response(request)
+    def is_bypassed(self, request: HttpRequest) -> bool:
+        """Return whether the request skips token resolution, based on its path or URL name."""
+        if self.bypass_paths and self.bypass_paths.matches(request.path_info):
+            return True
+        if not self.bypass_url_names:
+            return False
+        try:
+            match = resolve(request.path_info, getattr(request, "urlconf", None))
+        except Resolver404:
+            return False
+        return match.view_name in self.bypass_url_names
 
     @staticmethod
-    def retrieve_auth_user_details(auth_token: str) -> tuple[str, str]:
-        """
-        Retrieve the user details for the Windows Authentication Token.
+    def process_bypassed_token(auth_token: str) -> None:
+        """Close the handle of a token that is not resolved, so it doesn't leak."""
+        count_outcome(OUTCOME_BYPASSED)
+        try:
+            token_handle = parse_token_handle(auth_token)
+        except InvalidTokenError:
+            return
+        track_handle_opened(token_handle)
+        close_token_handle(token_handle)
+
+    @staticmethod
+    def add_server_timing(response: HttpResponse, timings: RequestTimings) -> None:
+        """Add the request timings to the Server-Timing header of the response, keeping any existing entries."""
+        server_timing = timings.server_timing()
+        if not server_timing:
+            return
+        if response.has_header("Server-Timing"):
+            server_timing = f"{response['Server-Timing']}, {server_timing}"
+        response["Server-Timing"] = server_timing
 
-        Uses pywin32 to access the hosts' API to extract the username and domain for the token.
+    def get_user_details(self, auth_token: str) -> tuple[str, str] | None:
+        """
+        Retrieve the user details for the token, logging and swallowing any errors.
 
         Args:
             auth_token (str): The Windows Authentication Token.
         Returns:
-            tuple[str, str]: A tuple containing the username and domain.
-        Raises:
-            ValueError: If the token is invalid or cannot be processed.
+            tuple[str, str] | None: A tuple containing the username and domain, or None if the token is invalid.
         """
-        if not any([win32security, pywintypes, win32api]) and not _IGNORE_PYWIN32_ERRORS:
-            raise ImproperlyConfigured("pywin32 is required for Windows Authentication Token middleware.'")
-
         try:
-            token_handle = int(auth_token, 16)
-        except ValueError:
-            raise ValueError("Invalid token format.")
+            return self.retrieve_auth_user_details(auth_token)
+        except ValueError as err:
+            logger.warning("Cannot retrieve username from auth token: %s", err)
+            count_outcome(OUTCOME_LOOKUP_FAILURE if isinstance(err, AccountLookupError) else OUTCOME_INVALID_TOKEN)
+            return None
+
+    def process_user_details(self, request: HttpRequest, user_details: tuple[str, str] | None) -> str | None:
+        """
+        Format the username and store the results on the request.
 
+        Args:
+            request (HttpRequest): The current request.
+            user_details (tuple[str, str] | None): The username and domain, or None if there is no valid token.
+        Returns:
+            str | None: The formatted username, or None if no user was set.
+        """
+        if user_details is None:
+            return None
+
+        username, domain = user_details
+        started = time.perf_counter()
         try:
-            # See https://learn.microsoft.com/en-us/windows/win32/api/winnt/ne-winnt-token_information_class
-            token_information_class = 1
-            security_id, _ = win32security.GetTokenInformation(token_handle, token_information_class)
-            logger.debug(f"Retrieved security ID for auth token: {auth_token=} {token_handle=} {security_id=}")
-        except pywintypes.error as err:
-            raise ValueError(f"Can't retrieve Security ID for token: {err}")
+            formatted_user = self.format_username(username, domain)
+        except FormattingError as err:
+            logger.warning("Username formatter raised an error: %s username=%r domain=%r", err, username, domain)
+            count_outcome(OUTCOME_FORMATTING_ERROR)
+            return None
         finally:
-            # Always try to close the token handle, but ignore any issues with it
-            try:
-                win32api.CloseHandle(token_handle)
-            except pywintypes.error as err:  # pragma: no cover
-                # just log and continue
-                logger.warning(f"Failed to close token handle: {err}")
+            observe_stage(STAGE_FORMAT_USERNAME, started)
+
+        self.set_remote_user(request, username, domain, formatted_user)
+        count_outcome(OUTCOME_SUCCESS)
+        return formatted_user
 
+    def process_pinned_identity(self, request: HttpRequest, auth_token: str) -> None:
+        """
+        Set the user for the token, reusing the identity pinned in the session when the SID matches.
+
+        Only the security ID of the token is retrieved for every request. The account lookup and the
+        username formatting only happen when the session holds no identity yet, one for another SID, or one
+        that expired or was invalidated since it was pinned.
+
+        Args:
+            request (HttpRequest): The current request, with a session.
+            auth_token (str): The Windows Authentication Token.
+        """
+        token_sid = self.get_token_sid(auth_token)
+        if token_sid is None:
+            return
+        security_id, sid_string = token_sid
+        if self.use_pinned_identity(request, sid_string):
+            return
+        user_details = self.lookup_pinned_account(security_id, sid_string)
+        formatted_user = self.process_user_details(request, user_details)
+        if user_details is not None and formatted_user is not None:
+            self.pin_identity(request, sid_string, user_details, formatted_user)
+
+    async def aprocess_pinned_identity(self, request: HttpRequest, auth_token: str) -> None:
+        """
+        Async version of `process_pinned_identity`.
+
+        Sessions may need the database, so they are only accessed from the thread that is used for database
+        access. The resolver calls run in other threads, so concurrent requests don't wait for each other.
+        """
+        token_sid = await sync_to_async(self.get_token_sid, thread_sensitive=False)(auth_token)
+        if token_sid is None:
+            return
+        security_id, sid_string = token_sid
+        if await sync_to_async(self.use_pinned_identity)(request, sid_string):
+            return
+        user_details = await sync_to_async(self.lookup_pinned_account, thread_sensitive=False)(security_id, sid_string)
+        formatted_user = self.process_user_details(request, user_details)
+        if user_details is not None and formatted_user is not None:
+            await sync_to_async(self.pin_identity)(request, sid_string, user_details, formatted_user)
+
+    @staticmethod
+    def get_token_sid(auth_token: str) -> tuple[Any, str] | None:
+        """Return the security ID of the token and its string form, or None if the token is invalid."""
         try:
-            user, domain, account_type = win32security.LookupAccountSid(None, security_id)
-            logger.debug(f"Retrieved account details for SID: {security_id=} {user=} {domain=} {account_type=}")
-        except (pywintypes.error, TypeError) as err:
-            # TypeError can occur if the SID has an incorrect type
-            raise ValueError(f"Can't retrieve account details for SID: {err}")
+            security_id = retrieve_security_id(auth_token)
+            return security_id, security_id_to_string(security_id)
+        except ValueError as err:
+            logger.warning("Cannot retrieve username from auth token: %s", err)
+            count_outcome(OUTCOME_LOOKUP_FAILURE if isinstance(err, AccountLookupError) else OUTCOME_INVALID_TOKEN)
+            return None
 
-        return user, domain
+    def use_pinned_identity(self, request: HttpRequest, sid_string: str) -> bool:
+        """
+        Set the user from the identity pinned in the session, if it was pinned for the SID.
+
+        Pinned identities expire after the cache TTL, and are dropped when cached identities are invalidated.
+        """
+        pinned = request.session.get(self.session_key)
+        if (
+            not pinned
+            or pinned["sid"] != sid_string
+            or pinned["formatter"] != self.formatter_id
+            or pinned.get("pinned_at", 0) + self.session_pinning_ttl <= time.time()
+            or pinned.get("generation") != get_invalidation_generation()
+        ):
+            return False
+        if debug_tracing_enabled():
+            logger.debug("Using identity pinned in session: sid_string=%r", sid_string)
+        record_identity_source(SOURCE_SESSION)
+        self.set_remote_user(request, pinned["user"], pinned["domain"], pinned["remote_user"])
+        count_outcome(OUTCOME_SUCCESS)
+        return True
+
+    @staticmethod
+    def lookup_pinned_account(security_id: Any, sid_string: str) -> tuple[str, str] | None:
+        """Look up the account of the SID, logging and swallowing any errors."""
+        try:
+            return lookup_account_details(security_id, sid_string)
+        except ValueError as err:
+            logger.warning("Cannot retrieve username from auth token: %s", err)
+            count_outcome(OUTCOME_LOOKUP_FAILURE)
+            return None
+
+    def pin_identity(
+        self, request: HttpRequest, sid_string: str, user_details: tuple[str, str], formatted_user: str
+    ) -> None:
+        """Pin the resolved identity in the session."""
+        request.session[self.session_key] = {
+            "sid": sid_string,
+            "user": user_details[0],
+            "domain": user_details[1],
+            "remote_user": formatted_user,
+            "formatter": self.formatter_id,
+            "pinned_at": time.time(),
+            "generation": get_invalidation_generation(),
+        }
+
+    def set_remote_user(self, request: HttpRequest, username: str, domain: str, formatted_user: str) -> None:
+        """
+        Store the formatted username and the original account details on the request.
+        """
+        # Set the REMOTE_USER environment variable
+        request.META["REMOTE_USER"] = formatted_user
+        # In async contexts, there is no environment variable, so we set it in META as a HTTP header,
+        # just like the RemoteUserMiddleware expects it for async requests.
+        request.META["HTTP_REMOTE_USER"] = formatted_user
+        # Save the original auth results for reference
+        request.META["WINDOWSAUTHTOKEN_USER"] = username
+        request.META["WINDOWSAUTHTOKEN_DOMAIN"] = domain
+        # And the details that were collected while resolving the token
+        resolved = _resolved_token.get()
+        if resolved is not None and resolved.sid_string is not None:
+            request.META["WINDOWSAUTHTOKEN_SID"] = resolved.sid_string
+        if resolved is not None and resolved.group_names is not None:
+            request.windowsauthtoken_groups = resolved.group_names  # type: ignore[attr-defined]
+
+        if debug_tracing_enabled():
+            logger.debug("Set REMOTE_USER to %s", formatted_user)
+
+    @staticmethod
+    def retrieve_auth_user_details(auth_token: str) -> tuple[str, str]:
+        """
+        Retrieve the user details for the Windows Authentication Token.
+
+        Uses the configured resolver to extract the username and domain for the token, by default
+        through pywin32. Account details are cached per SID, so the account lookup only runs on a cache miss.
+
+        Args:
+            auth_token (str): The Windows Authentication Token.
+        Returns:
+            tuple[str, str]: A tuple containing the username and domain.
+        Raises:
+            ValueError: If the token is invalid or cannot be processed.
+        """
+        return lookup_account_details(retrieve_security_id(auth_token))
 
     def format_username(self, user: str, domain: str) -> str:
         """
@@ -137,5 +751,37 @@ class WindowsAuthTokenMiddleware:
         Raises:
             FormattingError: If the formatter raises an error.
         """
-        formatter: Callable[[str, str], str] = import_string(self.username_formatter)
-        return formatter(user, domain)
+        return self.formatter(user, domain)
+
+    def load_username_formatter(self) -> Callable[[str, str], str]:
+        """
+        Resolve the configured username formatter to a callable, compiled into the pipeline if one is configured.
+
+        Returns:
+            Callable[[str, str], str]: The username formatter.
+        Raises:
+            ImproperlyConfigured: If the formatter cannot be imported, or the pipeline is invalid.
+        """
+        try:
+            formatter: Callable[[str, str], str] = import_string(self.username_formatter)
+        except ImportError as err:
+            raise ImproperlyConfigured(f"Cannot import username formatter {self.username_formatter!r}: {err}")
+
+        self.formatter_id: str = self.username_formatter
+        if self.formatter_pipeline is not None:
+            pipeline = compile_formatter_pipeline(formatter, self.formatter_pipeline)
+            self.formatter_id = f"{self.username_formatter}:{pipeline.fingerprint}"
+            return pipeline
+        return formatter
+
+    def on_setting_changed(self, *, setting: str, **kwargs: Any) -> None:
+        if setting in ("WINDOWSAUTHTOKEN_USERNAME_FORMATTER", "WINDOWSAUTHTOKEN_USERNAME_PIPELINE"):
+            self.username_formatter = getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_FORMATTER", DEFAULT_FORMATTER)
+            self.formatter_pipeline = getattr(settings, "WINDOWSAUTHTOKEN_USERNAME_PIPELINE", None)
+            self.formatter = self.load_username_formatter()
+        elif setting in ("WINDOWSAUTHTOKEN_BYPASS_PATHS", "WINDOWSAUTHTOKEN_BYPASS_URL_NAMES"):
+            self.load_bypass_rules()
+        elif setting in ("WINDOWSAUTHTOKEN_TRACE_FILE", "WINDOWSAUTHTOKEN_TRACE_FLUSH_SIZE"):
+            self.trace_recorder = get_trace_recorder()
+        elif setting in ("WINDOWSAUTHTOKEN_TRACING", "WINDOWSAUTHTOKEN_TRACER", "WINDOWSAUTHTOKEN_TRACING_SAMPLE_RATE"):
+            self.load_tracing()
@@ -0,0 +1,227 @@
+import asyncio
+import statistics
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from typing import Any
+
+from django.http import HttpRequest, HttpResponse
+from django.test import RequestFactory, override_settings
+
+from .metrics import (
+    OUTCOME_BYPASSED,
+    OUTCOME_FORMATTING_ERROR,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_NO_TOKEN,
+    OUTCOME_SUCCESS,
+    get_metrics,
+)
+from .middleware import WindowsAuthTokenMiddleware
+from .trace import TraceEntry
+
+REPLAY_BYPASS_PATH = "/windowsauthtoken-replay/bypassed/"
+"""The path used for replayed requests that were skipped by the middleware when they were recorded."""
+
+INVALID_TOKEN = "ffffffff"
+"""The token used for replayed requests that had an invalid token when they were recorded."""
+
+REPLAY_MODES = ("threads", "asyncio")
+
+
+class ReplayReport:
+    """
+    The results of replaying a trace.
+
+    Args:
+        latencies (list[float]): The time the middleware took for every request, in seconds.
+        elapsed (float): The time the whole replay took, in seconds.
+        outcomes (dict[str, int]): The number of requests per outcome.
+    """
+
+    def __init__(self, latencies: list[float], elapsed: float, outcomes: dict[str, int]) -> None:
+        self.latencies = latencies
+        self.elapsed = elapsed
+        self.outcomes = outcomes
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        """The number of requests per second."""
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percent: int) -> float:
+        """Return a percentile of the latencies, in seconds."""
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else 0.0
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[percent - 1]
+
+
+def build_resolver_options(entries: Sequence[TraceEntry]) -> tuple[dict[str, Any], dict[str, str]]:
+    """
+    Build options for the fake token resolver that reproduce the outcomes in the trace.
+
+    Every hashed SID gets its own token handle. SIDs that were resolved successfully at least once get an account,
+    SIDs that only caused formatting errors get an account without a domain, and the other SIDs get no account,
+    so their lookups fail.
+
+    Returns:
+        tuple[dict[str, Any], dict[str, str]]: The resolver options, and the token for every hashed SID.
+    """
+    outcomes: dict[str, set[str | None]] = {}
+    for entry in entries:
+        if entry.sid:
+            outcomes.setdefault(entry.sid, set()).add(entry.outcome)
+
+    tokens = {}
+    accounts = {}
+    handles = {}
+    for number, (sid, sid_outcomes) in enumerate(sorted(outcomes.items()), start=1):
+        handle = f"{number:x}"
+        sid_string = f"S-1-5-21-{number}"
+        handles[sid] = handle
+        tokens[handle] = sid_string
+        if OUTCOME_SUCCESS in sid_outcomes:
+            accounts[sid_string] = (f"user{number}", "REPLAY")
+        elif OUTCOME_FORMATTING_ERROR in sid_outcomes:
+            accounts[sid_string] = (f"user{number}", "")
+    return {"tokens": tokens, "accounts": accounts}, handles
+
+
+def build_request(entry: TraceEntry, handles: dict[str, str], request_factory: RequestFactory) -> HttpRequest:
+    """Build a request that reproduces the entry, using the tokens from `build_resolver_options`."""
+    if not entry.token or entry.outcome == OUTCOME_NO_TOKEN:
+        return request_factory.get("/")
+    if entry.outcome == OUTCOME_BYPASSED:
+        return request_factory.get(REPLAY_BYPASS_PATH, headers={WindowsAuthTokenMiddleware.header_name: "1"})
+    token = handles.get(entry.sid, INVALID_TOKEN) if entry.outcome != OUTCOME_INVALID_TOKEN else INVALID_TOKEN
+    return request_factory.get("/", headers={WindowsAuthTokenMiddleware.header_name: token})
+
+
+def _schedule(entries: Sequence[TraceEntry], requests: list[HttpRequest], speed: float) -> list[tuple[float, Any]]:
+    """Return the requests with the number of seconds after the start of the replay they are due."""
+    if not entries:
+        return []
+    first = entries[0].timestamp
+    return [((entry.timestamp - first) / speed if speed else 0.0, request) for entry, request in zip(entries, requests)]
+
+
+def _replay_threads(
+    middleware: WindowsAuthTokenMiddleware, schedule: list[tuple[float, Any]], workers: int, latencies: list[float]
+) -> None:
+    items: Iterator[tuple[float, Any]] = iter(schedule)
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def worker() -> None:
+        while True:
+            with lock:
+                item = next(items, None)
+            if item is None:
+                return
+            due, request = item
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            request_started = time.perf_counter()
+            middleware(request)
+            latencies.append(time.perf_counter() - request_started)
+
+    threads = [threading.Thread(target=worker, name=f"windowsauthtoken-replay-{n}") for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+async def _replay_asyncio(
+    middleware: WindowsAuthTokenMiddleware, schedule: list[tuple[float, Any]], workers: int, latencies: list[float]
+) -> None:
+    items = iter(schedule)
+    started = time.perf_counter()
+
+    async def worker() -> None:
+        for due, request in items:
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            request_started = time.perf_counter()
+            await middleware(request)
+            latencies.append(time.perf_counter() - request_started)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+
+def replay_trace(
+    entries: Sequence[TraceEntry],
+    speed: float = 1.0,
+    workers: int = 4,
+    mode: str = "threads",
+    token_latency: float = 0.0,
+    lookup_latency: float = 0.0,
+) -> ReplayReport:
+    """
+    Replay a trace against `WindowsAuthTokenMiddleware`, with the Windows API simulated by the fake token resolver.
+
+    Requests are sent at the moments they were recorded, relative to the first one, divided by `speed`.
+    A request that is due while all workers are busy waits for the next free worker, like in a real worker pool.
+
+    Args:
+        entries (Sequence[TraceEntry]): The recorded requests, ordered by timestamp.
+        speed (float): How much faster than recorded to replay, or 0 to send the requests as fast as possible.
+        workers (int): The number of threads or asyncio tasks sending requests.
+        mode (str): `threads` to call the middleware synchronously from threads, or `asyncio` to call it
+            asynchronously from tasks.
+        token_latency (float): Seconds the simulated token inspection takes.
+        lookup_latency (float): Seconds the simulated account lookup takes.
+    Returns:
+        ReplayReport: The latencies, duration and outcomes of the replay.
+    Raises:
+        ValueError: If the mode is unknown.
+    """
+    if mode not in REPLAY_MODES:
+        raise ValueError(f"Unknown replay mode {mode!r}, expected one of {REPLAY_MODES}.")
+
+    resolver_options, handles = build_resolver_options(entries)
+    request_factory = RequestFactory()
+    requests = [build_request(entry, handles, request_factory) for entry in entries]
+    latencies: list[float] = []
+
+    def get_response(request: HttpRequest) -> HttpResponse:
+        return HttpResponse()
+
+    async def aget_response(request: HttpRequest) -> HttpResponse:
+        return HttpResponse()
+
+    with override_settings(
+        WINDOWSAUTHTOKEN_RESOLVER="django_windowsauthtoken.resolvers.FakeTokenResolver",
+        WINDOWSAUTHTOKEN_RESOLVER_OPTIONS={
+            **resolver_options,
+            "token_latency": token_latency,
+            "lookup_latency": lookup_latency,
+        },
+        WINDOWSAUTHTOKEN_BYPASS_PATHS=[REPLAY_BYPASS_PATH],
+        WINDOWSAUTHTOKEN_METRICS=True,
+        WINDOWSAUTHTOKEN_TRACE_FILE=None,
+        # Keep the simulated identities out of the caches and the invalidation log shared with the project
+        WINDOWSAUTHTOKEN_SHARED_CACHE=None,
+        WINDOWSAUTHTOKEN_PERSISTENT_CACHE=None,
+        WINDOWSAUTHTOKEN_GROUPS=False,
+        # And don't warm the caches from the project's users, or send spans to the project's tracer
+        WINDOWSAUTHTOKEN_WARMUP=False,
+        WINDOWSAUTHTOKEN_TRACING=False,
+    ):
+        middleware = WindowsAuthTokenMiddleware(aget_response if mode == "asyncio" else get_response)
+        schedule = _schedule(entries, requests, speed)
+        started = time.perf_counter()
+        if mode == "asyncio":
+            asyncio.run(_replay_asyncio(middleware, schedule, workers, latencies))
+        else:
+            _replay_threads(middleware, schedule, workers, latencies)
+        elapsed = time.perf_counter() - started
+        metrics = get_metrics()
+        outcomes = metrics.snapshot()["outcomes"] if metrics is not None else {}
+
+    return ReplayReport(latencies, elapsed, {outcome: count for outcome, count in outcomes.items() if count})
@@ -0,0 +1,372 @@
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from typing import Any
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("windowsauthtoken")
+
+_IGNORE_PYWIN32_ERRORS = os.getenv("WINDOWSAUTHTOKEN_IGNORE_PYWIN32_ERRORS", "false") == "true"
+"""Flag to ignore platform-specific errors, useful for non-Windows environments."""
+
+PYWIN32_MODULES = ("pywintypes", "win32api", "win32security")
+"""The pywin32 modules used by `Pywin32Resolver`."""
+
+# Loading the DLLs of pywin32 takes noticeable time, so these are only imported by `import_pywin32`
+pywintypes: Any = None
+win32api: Any = None
+win32security: Any = None
+_pywin32_imported = False
+_pywin32_lock = threading.Lock()
+
+DEFAULT_RESOLVER = f"{__name__}.Pywin32Resolver"
+
+TOKEN_USER = 1
+"""The `TokenUser` information class, see https://learn.microsoft.com/en-us/windows/win32/api/winnt/ne-winnt-token_information_class"""
+
+TOKEN_GROUPS = 2
+"""The `TokenGroups` information class."""
+
+SID_TYPE_USER = 1
+"""The `SidTypeUser` account type, as returned by `LookupAccountSid`."""
+
+SE_GROUP_ENABLED = 0x00000004
+"""Attribute of the groups in a token that are enabled for access checks."""
+
+SE_GROUP_LOGON_ID = 0xC0000000
+"""Attribute of the group in a token that identifies the logon session, which is not an actual group."""
+
+ERROR_NONE_MAPPED = 1332
+"""The Windows error code for an account that doesn't exist, as opposed to a failure to look it up."""
+
+DEFAULT_CIRCUIT_BREAKER_COOLDOWN = 30
+"""Default number of seconds account lookups are suspended after the circuit breaker opens."""
+
+
+class ResolverError(Exception):
+    """
+    Raised by a resolver when the underlying API call fails.
+
+    Args:
+        winerror (int | None): The Windows error code of the failure, if known.
+    """
+
+    def __init__(self, *args: Any, winerror: int | None = None) -> None:
+        super().__init__(*args)
+        self.winerror = winerror
+
+
+class CircuitOpenError(ResolverError):
+    """Raised instead of calling the resolver, while the circuit breaker is open."""
+
+    pass
+
+
+class BaseTokenResolver:
+    """
+    Interface for the Windows API calls needed to resolve a token handle to an account.
+
+    Subclasses must raise `ResolverError` for any failure of the underlying API.
+    """
+
+    def get_token_user(self, token_handle: int) -> Any:
+        """Return the security ID of the user the token belongs to."""
+        raise NotImplementedError
+
+    def get_token_groups(self, token_handle: int) -> list[Any]:
+        """Return the security IDs of the enabled groups the token belongs to."""
+        raise NotImplementedError
+
+    def close_handle(self, token_handle: int) -> None:
+        """Close the token handle."""
+        raise NotImplementedError
+
+    def sid_to_string(self, security_id: Any) -> str:
+        """Convert a security ID to its string form, e.g. `S-1-5-21-...`."""
+        raise NotImplementedError
+
+    def lookup_account_sid(self, security_id: Any) -> tuple[str, str, int]:
+        """Return the username, domain and account type for a security ID."""
+        raise NotImplementedError
+
+    def lookup_account_name(self, account_name: str) -> tuple[Any, str, int]:
+        r"""Return the security ID, domain and account type for an account name, e.g. `DOMAIN\user`."""
+        raise NotImplementedError
+
+
+def import_pywin32() -> None:
+    """
+    Import the pywin32 modules, once per process, on their first use.
+
+    Raises:
+        ImproperlyConfigured: If pywin32 is not installed, unless `WINDOWSAUTHTOKEN_IGNORE_PYWIN32_ERRORS` is set.
+    """
+    global pywintypes, win32api, win32security, _pywin32_imported
+    if not _pywin32_imported:
+        with _pywin32_lock:
+            if not _pywin32_imported:
+                try:  # pragma: no cover
+                    import pywintypes
+                    import win32api
+                    import win32security
+                except ImportError:  # pragma: no cover
+                    if _IGNORE_PYWIN32_ERRORS:
+                        logger.warning("pywin32 is not installed, but errors are being ignored.")
+                _pywin32_imported = True
+    if not any([win32security, pywintypes, win32api]) and not _IGNORE_PYWIN32_ERRORS:
+        raise ImproperlyConfigured("pywin32 is required for Windows Authentication Token middleware.'")
+
+
+class Pywin32Resolver(BaseTokenResolver):
+    """
+    Resolver that uses pywin32 to access the hosts' API.
+
+    pywin32 is imported on the first call, which is the first request with a token, so it doesn't slow down
+    the startup of the worker processes. A missing pywin32 is reported at startup by the `windowsauthtoken.E001`
+    system check and the middleware instead.
+    """
+
+    def get_token_user(self, token_handle: int) -> Any:
+        import_pywin32()
+        try:
+            security_id, _ = win32security.GetTokenInformation(token_handle, TOKEN_USER)
+        except pywintypes.error as err:
+            raise ResolverError(err) from err
+        return security_id
+
+    def get_token_groups(self, token_handle: int) -> list[Any]:
+        import_pywin32()
+        try:
+            groups = win32security.GetTokenInformation(token_handle, TOKEN_GROUPS)
+        except pywintypes.error as err:
+            raise ResolverError(err) from err
+        return [
+            security_id
+            for security_id, attributes in groups
+            if attributes & SE_GROUP_ENABLED and attributes & SE_GROUP_LOGON_ID != SE_GROUP_LOGON_ID
+        ]
+
+    def close_handle(self, token_handle: int) -> None:
+        import_pywin32()
+        try:
+            win32api.CloseHandle(token_handle)
+        except pywintypes.error as err:
+            raise ResolverError(err) from err
+
+    def sid_to_string(self, security_id: Any) -> str:
+        import_pywin32()
+        try:
+            sid_string: str = win32security.ConvertSidToStringSid(security_id)
+        except (pywintypes.error, TypeError) as err:
+            raise ResolverError(err) from err
+        return sid_string
+
+    def lookup_account_sid(self, security_id: Any) -> tuple[str, str, int]:
+        import_pywin32()
+        try:
+            user, domain, account_type = win32security.LookupAccountSid(None, security_id)
+        except (pywintypes.error, TypeError) as err:
+            # TypeError can occur if the SID has an incorrect type
+            raise ResolverError(err, winerror=getattr(err, "winerror", None)) from err
+        return user, domain, account_type
+
+    def lookup_account_name(self, account_name: str) -> tuple[Any, str, int]:
+        import_pywin32()
+        try:
+            security_id, domain, account_type = win32security.LookupAccountName(None, account_name)
+        except pywintypes.error as err:
+            raise ResolverError(err) from err
+        return security_id, domain, account_type
+
+
+class FakeTokenResolver(BaseTokenResolver):
+    """
+    Deterministic in-memory resolver, for tests and load testing on platforms without pywin32.
+
+    Args:
+        tokens (Mapping[str, str]): Maps hexadecimal token handles to SID strings.
+        accounts (Mapping[str, Sequence[str]]): Maps SID strings of users and groups to `(name, domain)` tuples.
+        groups (Mapping[str, Sequence[str]]): Maps hexadecimal token handles to the SID strings of their groups.
+        token_latency (float): Seconds to sleep for every token inspection.
+        lookup_latency (float): Seconds to sleep for every account lookup.
+        failure_rate (float): Fraction of calls, between 0 and 1, that fail with a `ResolverError`.
+        seed (int | None): Seed for the random failures, to make them reproducible.
+    """
+
+    def __init__(
+        self,
+        tokens: Mapping[str, str] | None = None,
+        accounts: Mapping[str, Sequence[str]] | None = None,
+        groups: Mapping[str, Sequence[str]] | None = None,
+        token_latency: float = 0.0,
+        lookup_latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.tokens = {int(handle, 16): sid for handle, sid in (tokens or {}).items()}
+        self.accounts = {sid: (account[0], account[1]) for sid, account in (accounts or {}).items()}
+        self.groups = {int(handle, 16): list(sids) for handle, sids in (groups or {}).items()}
+        self.token_latency = token_latency
+        self.lookup_latency = lookup_latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    def _simulate(self, latency: float) -> None:
+        if latency:
+            time.sleep(latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise ResolverError("Simulated failure.")
+
+    def get_token_user(self, token_handle: int) -> Any:
+        self._simulate(self.token_latency)
+        try:
+            return self.tokens[token_handle]
+        except KeyError:
+            raise ResolverError("The handle is invalid.")
+
+    def get_token_groups(self, token_handle: int) -> list[Any]:
+        self._simulate(self.token_latency)
+        if token_handle not in self.tokens:
+            raise ResolverError("The handle is invalid.")
+        return self.groups.get(token_handle, [])
+
+    def close_handle(self, token_handle: int) -> None:
+        pass
+
+    def sid_to_string(self, security_id: Any) -> str:
+        if not isinstance(security_id, str):
+            raise ResolverError(f"Invalid SID object: {security_id!r}")
+        return security_id
+
+    def lookup_account_sid(self, security_id: Any) -> tuple[str, str, int]:
+        self._simulate(self.lookup_latency)
+        try:
+            user, domain = self.accounts[security_id]
+        except KeyError:
+            raise ResolverError(
+                "No mapping between account names and security IDs was done.", winerror=ERROR_NONE_MAPPED
+            )
+        return user, domain, SID_TYPE_USER
+
+    def lookup_account_name(self, account_name: str) -> tuple[Any, str, int]:
+        self._simulate(self.lookup_latency)
+        # Accept the same forms as LookupAccountName: DOMAIN\user, user@domain or a bare user
+        if "\\" in account_name:
+            domain_name, _, user_name = account_name.partition("\\")
+        else:
+            user_name, _, domain_name = account_name.partition("@")
+        for sid, (user, domain) in self.accounts.items():
+            if user.lower() == user_name.lower() and domain_name.lower() in ("", domain.lower()):
+                return sid, domain, SID_TYPE_USER
+        raise ResolverError("No mapping between account names and security IDs was done.")
+
+
+class CircuitBreaker:
+    """
+    Stop calling the resolver for a while, after repeated failures.
+
+    After `threshold` consecutive failures, the breaker opens and calls are refused for `cooldown` seconds.
+    Then a single trial call is let through: when it succeeds the breaker closes, otherwise it stays open
+    for another cool-down period. Calls that take longer than `slow_call` seconds count as failures, since
+    a slow domain controller is as bad for latency as an unreachable one. Lookups of accounts that don't
+    exist count as successes, since the domain controller did answer.
+
+    Args:
+        threshold (int): The number of consecutive failures that open the breaker.
+        cooldown (float): The number of seconds calls are refused while the breaker is open.
+        slow_call (float | None): The number of seconds after which a successful call counts as a failure.
+    """
+
+    def __init__(
+        self, threshold: int, cooldown: float = DEFAULT_CIRCUIT_BREAKER_COOLDOWN, slow_call: float | None = None
+    ) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.slow_call = slow_call
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Return whether a call may be made now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            # Let a single trial call through, and keep refusing others until it has finished
+            self._opened_at = time.monotonic()
+            return True
+
+    def record_success(self, duration: float) -> None:
+        """Record a call that returned after `duration` seconds."""
+        if self.slow_call is not None and duration > self.slow_call:
+            self.record_failure(ResolverError(f"Call took {duration:.3f} seconds."))
+            return
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+
+    def record_failure(self, err: ResolverError) -> None:
+        """Record a failed call."""
+        if err.winerror == ERROR_NONE_MAPPED:
+            self.record_success(0.0)
+            return
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold or self._opened_at is not None:
+                if self._opened_at is None:
+                    logger.warning("Suspending account lookups after %d failures: %s", self.failures, err)
+                self._opened_at = time.monotonic()
+
+
+@functools.cache
+def get_resolver() -> BaseTokenResolver:
+    """
+    Return the process-wide token resolver, configured from the Django settings.
+
+    Raises:
+        ImproperlyConfigured: If the resolver cannot be imported or initialized.
+    """
+    resolver_path = getattr(settings, "WINDOWSAUTHTOKEN_RESOLVER", DEFAULT_RESOLVER)
+    options = getattr(settings, "WINDOWSAUTHTOKEN_RESOLVER_OPTIONS", {})
+    try:
+        resolver_class = import_string(resolver_path)
+    except ImportError as err:
+        raise ImproperlyConfigured(f"Cannot import token resolver {resolver_path!r}: {err}")
+    resolver: BaseTokenResolver = resolver_class(**options)
+    return resolver
+
+
+@functools.cache
+def get_circuit_breaker() -> CircuitBreaker | None:
+    """Return the process-wide circuit breaker for account lookups, or None if it is disabled in the settings."""
+    threshold = getattr(settings, "WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD", 0)
+    if not threshold:
+        return None
+    return CircuitBreaker(
+        threshold=threshold,
+        cooldown=getattr(settings, "WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_COOLDOWN", DEFAULT_CIRCUIT_BREAKER_COOLDOWN),
+        slow_call=getattr(settings, "WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_SLOW_CALL", None),
+    )
+
+
+@receiver(setting_changed)
+def reset_resolver(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_RESOLVER", "WINDOWSAUTHTOKEN_RESOLVER_OPTIONS"):
+        get_resolver.cache_clear()
+    elif setting.startswith("WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_"):
+        get_circuit_breaker.cache_clear()
@@ -0,0 +1,189 @@
+import atexit
+import contextlib
+import csv
+import functools
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextvars import ContextVar
+from typing import Any
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.crypto import salted_hmac
+
+TRACE_FIELDS = ("timestamp", "token", "sid", "outcome", "duration")
+"""The columns of a trace file."""
+
+DEFAULT_TRACE_FLUSH_SIZE = 1000
+"""Default number of trace entries buffered in memory before they are written to the trace file."""
+
+
+class TraceEntry:
+    """
+    A single request in a trace: when it arrived, whether it had a token, the hashed SID and the outcome.
+
+    Args:
+        timestamp (float): The time the request arrived, in seconds since the epoch.
+        token (bool): Whether the request had a token.
+        sid (str): The hashed SID of the user, or an empty string if the token was not resolved.
+        outcome (str | None): The outcome of the request, as counted in the metrics.
+        duration (float): The time the middleware spent on the request, in seconds.
+    """
+
+    __slots__ = ("timestamp", "token", "sid", "outcome", "duration")
+
+    def __init__(
+        self, timestamp: float, token: bool = False, sid: str = "", outcome: str | None = None, duration: float = 0.0
+    ) -> None:
+        self.timestamp = timestamp
+        self.token = token
+        self.sid = sid
+        self.outcome = outcome
+        self.duration = duration
+
+    def to_row(self) -> tuple[str, ...]:
+        return (
+            f"{self.timestamp:.6f}",
+            "1" if self.token else "0",
+            self.sid,
+            self.outcome or "",
+            f"{self.duration:.6f}",
+        )
+
+    @classmethod
+    def from_row(cls, row: dict[str, str]) -> "TraceEntry":
+        return cls(
+            timestamp=float(row["timestamp"]),
+            token=row["token"] == "1",
+            sid=row["sid"],
+            outcome=row["outcome"] or None,
+            duration=float(row["duration"]),
+        )
+
+
+_trace_entry: ContextVar[TraceEntry | None] = ContextVar("windowsauthtoken_trace_entry", default=None)
+"""The trace entry of the current request, only set while a trace is being recorded."""
+
+
+def hash_sid(sid_string: str) -> str:
+    """Return an anonymized, but stable, identifier for a SID. It depends on the `SECRET_KEY` of the project."""
+    return salted_hmac("django_windowsauthtoken.trace", sid_string).hexdigest()[:16]
+
+
+class TraceRecorder:
+    """
+    Record the inputs and outcomes of the middleware in a compact CSV file, to replay real traffic later.
+
+    SIDs are hashed and usernames are not recorded, so traces can be shared without exposing accounts.
+    Entries are buffered in memory and appended to the file in batches by a background thread, so requests
+    never wait for the disk, and when the process exits.
+
+    Args:
+        path (str): The path of the trace file. Entries are appended if it already exists.
+        flush_size (int): The number of entries to buffer before writing them to the file.
+    """
+
+    def __init__(self, path: str, flush_size: int = DEFAULT_TRACE_FLUSH_SIZE) -> None:
+        self.path = path
+        self.flush_size = flush_size
+        self._buffer: list[tuple[str, ...]] = []
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._writer: threading.Thread | None = None
+        atexit.register(self.flush)
+
+    @contextlib.contextmanager
+    def recording(self, token: bool) -> Iterator[TraceEntry]:
+        """
+        Record the request handled within the block.
+
+        The entry is kept in a context variable, so it is also filled in threads started with `sync_to_async`.
+        """
+        entry = TraceEntry(timestamp=time.time(), token=token)
+        reset_token = _trace_entry.set(entry)
+        started = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry.duration = time.perf_counter() - started
+            _trace_entry.reset(reset_token)
+            self.write(entry)
+
+    def write(self, entry: TraceEntry) -> None:
+        """Buffer the entry, and start the background writer when a full batch is buffered."""
+        with self._lock:
+            self._buffer.append(entry.to_row())
+            if len(self._buffer) < self.flush_size or self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_behind, name="windowsauthtoken-trace", daemon=True)
+            self._writer.start()
+
+    def _write_behind(self) -> None:
+        while True:
+            self.flush()
+            with self._lock:
+                # Stop when no full batch is left, a new writer is started when the next batch is full
+                if len(self._buffer) < self.flush_size:
+                    self._writer = None
+                    return
+
+    def flush(self) -> None:
+        """Append the buffered entries to the trace file, after any batch that is being written."""
+        with self._file_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a", newline="") as trace_file:
+                writer = csv.writer(trace_file)
+                if new_file:
+                    writer.writerow(TRACE_FIELDS)
+                writer.writerows(rows)
+
+
+def read_trace(path: str) -> list[TraceEntry]:
+    """
+    Read the entries of a trace file.
+
+    Returns:
+        list[TraceEntry]: The entries, ordered by timestamp.
+    """
+    with open(path, newline="") as trace_file:
+        entries = [TraceEntry.from_row(row) for row in csv.DictReader(trace_file)]
+    return sorted(entries, key=lambda entry: entry.timestamp)
+
+
+@functools.cache
+def get_trace_recorder() -> TraceRecorder | None:
+    """Return the process-wide trace recorder, or None if recording is disabled in the Django settings."""
+    path = getattr(settings, "WINDOWSAUTHTOKEN_TRACE_FILE", None)
+    if path is None:
+        return None
+    return TraceRecorder(
+        path=str(path),
+        flush_size=getattr(settings, "WINDOWSAUTHTOKEN_TRACE_FLUSH_SIZE", DEFAULT_TRACE_FLUSH_SIZE),
+    )
+
+
+def record_trace_sid(sid_string: str) -> None:
+    """Record the SID of the current request, when a trace is being recorded."""
+    entry = _trace_entry.get()
+    if entry is not None:
+        entry.sid = hash_sid(sid_string)
+
+
+def record_trace_outcome(outcome: str) -> None:
+    """Record the outcome of the current request, when a trace is being recorded."""
+    entry = _trace_entry.get()
+    if entry is not None:
+        entry.outcome = outcome
+
+
+@receiver(setting_changed)
+def reset_trace_recorder(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_TRACE_FILE", "WINDOWSAUTHTOKEN_TRACE_FLUSH_SIZE"):
+        get_trace_recorder.cache_clear()
@@ -0,0 +1,233 @@
+import contextlib
+import functools
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from typing import Any
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .metrics import (
+    SOURCE_CACHE,
+    SOURCE_SESSION,
+    SOURCE_SHARED_CACHE,
+    SOURCE_STALE_CACHE,
+    STAGE_FORMAT_USERNAME,
+    STAGE_GET_TOKEN_INFORMATION,
+    STAGE_LOOKUP_ACCOUNT_SID,
+    RequestTimings,
+    record_request_timings,
+)
+
+DEFAULT_TRACER = f"{__name__}.OpenTelemetryTracer"
+
+DEFAULT_MEMORY_TRACER_SIZE = 1000
+"""Default number of ended spans kept by the `MemoryTracer`, older spans are discarded."""
+
+REQUEST_SPAN_NAME = "windowsauthtoken.resolve"
+"""The name of the span that covers the token resolution of a request."""
+
+STAGE_SPAN_NAMES = {
+    STAGE_GET_TOKEN_INFORMATION: "windowsauthtoken.token_inspection",
+    STAGE_LOOKUP_ACCOUNT_SID: "windowsauthtoken.sid_lookup",
+    STAGE_FORMAT_USERNAME: "windowsauthtoken.format_username",
+}
+"""The stages that are recorded as child spans of the request span, and the names of their spans."""
+
+CACHE_HIT_SOURCES = frozenset([SOURCE_CACHE, SOURCE_STALE_CACHE, SOURCE_SHARED_CACHE, SOURCE_SESSION])
+"""The identity sources that count as a cache hit."""
+
+
+class Span:
+    """
+    A span of the internal tracing API, which the tracers translate to their tracing library.
+    """
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def end(self, end_time: float | None = None) -> None:
+        """End the span, at `end_time` in seconds since the epoch, or now."""
+        raise NotImplementedError
+
+
+class Tracer:
+    """
+    Interface of the tracers, which create spans in a tracing library.
+    """
+
+    def start_span(self, name: str, parent: Span | None = None, start_time: float | None = None) -> Span:
+        """
+        Start a span.
+
+        Args:
+            name (str): The name of the span.
+            parent (Span | None): The parent span, or None to use the current span of the tracing library.
+            start_time (float | None): The start of the span in seconds since the epoch, or None for now.
+        Returns:
+            Span: The started span.
+        """
+        raise NotImplementedError
+
+
+class OpenTelemetrySpan(Span):
+    def __init__(self, span: Any) -> None:
+        self.span = span
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.span.set_attribute(key, value)
+
+    def end(self, end_time: float | None = None) -> None:
+        self.span.end(end_time=_nanoseconds(end_time))
+
+
+class OpenTelemetryTracer(Tracer):
+    """
+    Tracer that creates OpenTelemetry spans, as children of the current span, such as the span of the request
+    created by the OpenTelemetry instrumentation of Django. Requires `opentelemetry-api`.
+
+    Raises:
+        ImproperlyConfigured: If OpenTelemetry is not installed.
+    """
+
+    def __init__(self) -> None:
+        try:
+            from opentelemetry import trace  # type: ignore[import-not-found]
+        except ImportError as err:
+            raise ImproperlyConfigured(f"opentelemetry-api is required for tracing: {err}")
+        self.trace = trace
+        self.tracer = trace.get_tracer("django_windowsauthtoken")
+
+    def start_span(self, name: str, parent: Span | None = None, start_time: float | None = None) -> Span:
+        context = None
+        if isinstance(parent, OpenTelemetrySpan):
+            context = self.trace.set_span_in_context(parent.span)
+        return OpenTelemetrySpan(self.tracer.start_span(name, context=context, start_time=_nanoseconds(start_time)))
+
+
+class MemorySpan(Span):
+    """
+    A span kept in memory by the `MemoryTracer`.
+    """
+
+    def __init__(self, tracer: "MemoryTracer", name: str, parent: Span | None, start_time: float) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.start_time = start_time
+        self.end_time: float | None = None
+        self.attributes: dict[str, Any] = {}
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, end_time: float | None = None) -> None:
+        self.end_time = end_time if end_time is not None else time.time()
+        with self.tracer.lock:
+            self.tracer.spans.append(self)
+
+
+class MemoryTracer(Tracer):
+    """
+    Tracer that keeps the ended spans in memory, for tests and for trying out the tracing without a tracing library.
+
+    Only the most recent spans are kept, so the memory use is bounded in long-running processes.
+
+    Args:
+        max_spans (int): The number of ended spans to keep.
+    """
+
+    def __init__(self, max_spans: int = DEFAULT_MEMORY_TRACER_SIZE) -> None:
+        self.spans: deque[MemorySpan] = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    def start_span(self, name: str, parent: Span | None = None, start_time: float | None = None) -> Span:
+        return MemorySpan(self, name, parent, start_time if start_time is not None else time.time())
+
+
+def _nanoseconds(seconds: float | None) -> int | None:
+    return int(seconds * 1e9) if seconds is not None else None
+
+
+class SpanTimings(RequestTimings):
+    """
+    Request timings that also record the stages of the request as child spans of the request span.
+
+    Stages are timed by the middleware anyway, so the child spans are created when a stage ends, with the
+    start time derived from its duration. This adds no calls on the request path besides the ones for
+    the timings.
+    """
+
+    def __init__(self, tracer: Tracer, span: Span) -> None:
+        super().__init__()
+        self.tracer = tracer
+        self.span = span
+
+    def add(self, stage: str, seconds: float) -> None:
+        super().add(stage, seconds)
+        name = STAGE_SPAN_NAMES.get(stage)
+        if name is not None:
+            end_time = time.time()
+            span = self.tracer.start_span(name, parent=self.span, start_time=end_time - seconds)
+            span.end(end_time=end_time)
+
+    def finish(self) -> None:
+        """Set the outcome and identity source of the request on the request span, and end it."""
+        if self.outcome is not None:
+            self.span.set_attribute("windowsauthtoken.outcome", self.outcome)
+        if self.source is not None:
+            self.span.set_attribute("windowsauthtoken.identity_source", self.source)
+            self.span.set_attribute("windowsauthtoken.cache_hit", self.source in CACHE_HIT_SOURCES)
+        self.span.end()
+
+
+@contextlib.contextmanager
+def tracing_request(tracer: Tracer) -> Iterator[SpanTimings]:
+    """
+    Record the token resolution within the block as a span, with a child span for every stage.
+
+    Returns:
+        Iterator[SpanTimings]: The timings of the request, which can also be used for the Server-Timing header.
+    """
+    timings = SpanTimings(tracer, tracer.start_span(REQUEST_SPAN_NAME))
+    try:
+        with record_request_timings(timings):
+            yield timings
+    finally:
+        timings.finish()
+
+
+def sampled(sample_rate: float) -> bool:
+    """Decide whether to trace a request, with a probability of `sample_rate`."""
+    return sample_rate >= 1 or random.random() < sample_rate
+
+
+@functools.cache
+def get_tracer() -> Tracer | None:
+    """
+    Return the process-wide tracer, or None if tracing is disabled in the Django settings.
+
+    Raises:
+        ImproperlyConfigured: If the tracer cannot be imported or initialized.
+    """
+    if not getattr(settings, "WINDOWSAUTHTOKEN_TRACING", False):
+        return None
+    tracer_path = getattr(settings, "WINDOWSAUTHTOKEN_TRACER", DEFAULT_TRACER)
+    try:
+        tracer_class = import_string(tracer_path)
+    except ImportError as err:
+        raise ImproperlyConfigured(f"Cannot import tracer {tracer_path!r}: {err}")
+    tracer: Tracer = tracer_class()
+    return tracer
+
+
+@receiver(setting_changed)
+def reset_tracer(*, setting: str, **kwargs: Any) -> None:
+    if setting in ("WINDOWSAUTHTOKEN_TRACING", "WINDOWSAUTHTOKEN_TRACER"):
+        get_tracer.cache_clear()
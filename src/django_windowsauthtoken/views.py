@@ -1,7 +1,15 @@
+from typing import Any
+
 from django.conf import settings
-from django.http import HttpRequest, JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse
+from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_GET
 
+from .diagnostics import collect_diagnostics
+from .handles import get_handle_tracker
+from .metrics import get_metrics, get_metrics_exporter
+
 
 @require_GET
 def debug_view(request: HttpRequest) -> JsonResponse:
@@ -29,3 +37,42 @@ def debug_view(request: HttpRequest) -> JsonResponse:
             "META": {k: str(v) for k, v in request.META.items()},
         }
     )
+
+
+@require_GET
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """
+    Expose the middleware metrics in the format of the configured exporter, e.g. for Prometheus to scrape.
+
+    When handle tracking is enabled, the handle accounting is included as well.
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        raise Http404("Metrics are disabled.")
+
+    snapshot = metrics.snapshot()
+    handle_tracker = get_handle_tracker()
+    if handle_tracker is not None:
+        snapshot["handles"] = handle_tracker.snapshot()
+
+    exporter = get_metrics_exporter()
+    return HttpResponse(exporter.export(snapshot), content_type=exporter.content_type)
+
+
+@require_GET
+@never_cache
+def diagnostics_view(request: HttpRequest) -> JsonResponse:
+    """
+    Expose a snapshot of the runtime state of the middleware, also when DEBUG is off.
+
+    Only available to superusers, and to users with the permission in `WINDOWSAUTHTOKEN_DIAGNOSTICS_PERMISSION`.
+
+    Raises:
+        PermissionDenied: If the user is not allowed to see the diagnostics.
+    """
+    permission = getattr(settings, "WINDOWSAUTHTOKEN_DIAGNOSTICS_PERMISSION", None)
+    user: Any = request.user
+    if not (user.is_active and (user.is_superuser or (permission is not None and user.has_perm(permission)))):
+        raise PermissionDenied("Not allowed to view the diagnostics.")
+
+    return JsonResponse(collect_diagnostics())
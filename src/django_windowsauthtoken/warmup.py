@@ -0,0 +1,168 @@
+import functools
+import logging
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from .cache import get_identity_cache, get_persistent_identity_store, get_shared_identity_cache
+from .invalidation import get_invalidation_log, set_shared_namespace
+from .resolvers import ResolverError, get_resolver
+
+logger = logging.getLogger("windowsauthtoken")
+
+DEFAULT_WARMUP_DAYS = 7
+"""Default number of days a user must have logged in within, to be included in the warm-up."""
+
+DEFAULT_WARMUP_LIMIT = 1000
+"""Default maximum number of users included in the warm-up."""
+
+DEFAULT_WARMUP_BATCH_SIZE = 50
+"""Default number of accounts resolved per batch."""
+
+DEFAULT_WARMUP_WORKERS = 4
+"""Default number of threads resolving accounts concurrently."""
+
+
+def recently_active_usernames(days: int = DEFAULT_WARMUP_DAYS, limit: int = DEFAULT_WARMUP_LIMIT) -> list[str]:
+    """
+    Return the usernames of the users that logged in most recently.
+
+    Args:
+        days (int): Only include users that logged in within this number of days.
+        limit (int): The maximum number of usernames to return.
+
+    Returns:
+        list[str]: The usernames, most recently active first.
+    """
+    user_model = get_user_model()
+    username_field = str(user_model.USERNAME_FIELD)
+    users = user_model._default_manager.filter(last_login__gte=timezone.now() - timedelta(days=days))
+    return list(users.order_by("-last_login").values_list(username_field, flat=True)[:limit])
+
+
+def resolve_account_name(account_name: str) -> tuple[str, tuple[str, str]] | None:
+    r"""
+    Resolve an account name, as produced by the username formatter, to the identity the middleware would cache.
+
+    The name is resolved to a SID using `LookupAccountName`, which accepts the `DOMAIN\user`, `user@domain` and
+    bare `user` forms. The SID is then looked up with `LookupAccountSid`, so the cached username and domain
+    are exactly what a request with a token for the account would produce.
+
+    Returns:
+        tuple[str, tuple[str, str]] | None: The SID string and the `(user, domain)` tuple, or None if the
+            account cannot be resolved.
+    """
+    resolver = get_resolver()
+    try:
+        security_id, _, _ = resolver.lookup_account_name(account_name)
+        sid_string = resolver.sid_to_string(security_id)
+        user, domain, _ = resolver.lookup_account_sid(security_id)
+    except ResolverError as err:
+        logger.debug("Cannot resolve account for warm-up: account_name=%r error=%s", account_name, err)
+        return None
+    return sid_string, (user, domain)
+
+
+def _batches(items: list[str], batch_size: int) -> Iterator[list[str]]:
+    for start in range(0, len(items), batch_size):
+        yield items[start : start + batch_size]
+
+
+def warm_identity_cache(
+    usernames: Iterable[str] | None = None,
+    days: int = DEFAULT_WARMUP_DAYS,
+    limit: int = DEFAULT_WARMUP_LIMIT,
+    batch_size: int = DEFAULT_WARMUP_BATCH_SIZE,
+    workers: int = DEFAULT_WARMUP_WORKERS,
+) -> int:
+    """
+    Pre-fill the identity caches with the accounts of known users.
+
+    The accounts are resolved in batches on a thread pool. After each batch, the in-process cache is filled,
+    and the shared cache, if configured, in a single round trip. The shared cache is written under the current
+    namespace, so the identities survive earlier flushes. The persistent store, if configured, is written when
+    the warm-up is done.
+
+    Args:
+        usernames (Iterable[str] | None): The account names to resolve, defaults to the recently active users.
+        days (int): When using the recently active users, only include users that logged in within this
+            number of days.
+        limit (int): When using the recently active users, the maximum number of users to include.
+        batch_size (int): The number of accounts resolved per batch.
+        workers (int): The number of threads resolving accounts concurrently.
+
+    Returns:
+        int: The number of identities that were resolved and cached.
+    """
+    log = get_invalidation_log()
+    if log is not None:
+        # Use the same keys in the shared cache as the running workers
+        try:
+            set_shared_namespace(log.read()[1])
+        except Exception as err:
+            logger.warning("Cannot read invalidations from shared cache %r: %s", log.alias, err)
+
+    names = list(usernames) if usernames is not None else recently_active_usernames(days, limit)
+    identity_cache = get_identity_cache()
+    shared_cache = get_shared_identity_cache()
+    persistent_store = get_persistent_identity_store()
+
+    warmed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="windowsauthtoken-warmup") as executor:
+        for batch in _batches(names, batch_size):
+            resolved = dict(result for result in executor.map(resolve_account_name, batch) if result is not None)
+            for sid_string, user_details in resolved.items():
+                identity_cache.set(sid_string, user_details)
+            if shared_cache is not None and resolved:
+                shared_cache.set_many(resolved)
+            if persistent_store is not None:
+                for sid_string, user_details in resolved.items():
+                    persistent_store.set(sid_string, user_details)
+            warmed += len(resolved)
+
+    if persistent_store is not None:
+        persistent_store.flush()
+    logger.info("Warmed identity cache: accounts=%d resolved=%d", len(names), warmed)
+    return warmed
+
+
+def _warm_identity_cache_in_background() -> None:
+    try:
+        warm_identity_cache(
+            days=getattr(settings, "WINDOWSAUTHTOKEN_WARMUP_DAYS", DEFAULT_WARMUP_DAYS),
+            limit=getattr(settings, "WINDOWSAUTHTOKEN_WARMUP_LIMIT", DEFAULT_WARMUP_LIMIT),
+        )
+    except DatabaseError as err:
+        # E.g. when the tables don't exist yet, because migrations haven't run
+        logger.warning("Cannot warm identity cache: %s", err)
+    except Exception:
+        logger.exception("Cannot warm identity cache")
+    finally:
+        # The connection of this thread would otherwise stay open until the process exits
+        connection.close()
+
+
+def start_warmup() -> threading.Thread:
+    """
+    Warm the identity caches in a background thread, so the startup of the application is not delayed.
+    """
+    thread = threading.Thread(target=_warm_identity_cache_in_background, name="windowsauthtoken-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+@functools.cache
+def start_process_warmup() -> threading.Thread:
+    """
+    Warm the identity caches in a background thread, once per process.
+
+    Called when the middleware is created, so only processes that serve requests warm their caches, and not
+    management commands such as `migrate`.
+    """
+    return start_warmup()
@@ -1,5 +1,6 @@
 import os
 
+import pytest
 from django.conf import settings
 
 
@@ -15,6 +16,7 @@ def pytest_configure():
             "django.contrib.auth",
             "django.contrib.sessions",
             "django.contrib.admin",
+            "django_windowsauthtoken",
         ],
         MIDDLEWARE=[
             "django.contrib.sessions.middleware.SessionMiddleware",
@@ -28,3 +30,90 @@ def pytest_configure():
         ROOT_URLCONF="urlconf",
         SECRET_KEY="django-insecure-test-key",
     )
+
+
+@pytest.fixture(autouse=True)
+def reset_windowsauthtoken_state():
+    """Make sure no resolvers, resolved identities or metrics leak between tests."""
+    from django_windowsauthtoken.backends import get_user_cache, get_user_row_cache
+    from django_windowsauthtoken.cache import (
+        get_identity_cache,
+        get_negative_identity_cache,
+        get_persistent_identity_store,
+        get_shared_identity_cache,
+    )
+    from django_windowsauthtoken.groups import get_group_cache, get_shared_group_cache
+    from django_windowsauthtoken.handles import get_handle_tracker
+    from django_windowsauthtoken.invalidation import get_invalidation_log, get_invalidation_watcher
+    from django_windowsauthtoken.metrics import get_metrics, get_metrics_exporter
+    from django_windowsauthtoken.resolvers import get_circuit_breaker, get_resolver
+    from django_windowsauthtoken.trace import get_trace_recorder
+    from django_windowsauthtoken.tracing import get_tracer
+    from django_windowsauthtoken.warmup import start_process_warmup
+
+    accessors = [
+        get_identity_cache,
+        get_negative_identity_cache,
+        get_shared_identity_cache,
+        get_persistent_identity_store,
+        get_resolver,
+        get_circuit_breaker,
+        get_user_cache,
+        get_user_row_cache,
+        get_group_cache,
+        get_shared_group_cache,
+        get_handle_tracker,
+        get_invalidation_log,
+        get_invalidation_watcher,
+        get_metrics,
+        get_metrics_exporter,
+        get_trace_recorder,
+        get_tracer,
+        start_process_warmup,
+    ]
+    for accessor in accessors:
+        accessor.cache_clear()
+    yield
+    for accessor in accessors:
+        accessor.cache_clear()
+
+
+@pytest.fixture()
+def resolver_options():
+    """The tokens and accounts of the fake resolver, override this fixture in a module to simulate others."""
+    return {
+        "tokens": {"1a": "S-1-5-21-1", "2b": "S-1-5-21-2"},
+        "accounts": {"S-1-5-21-1": ("testuser", "TESTDOMAIN")},
+    }
+
+
+@pytest.fixture()
+def fake_resolver(settings, resolver_options):
+    """Use the fake resolver, with the options of the `resolver_options` fixture."""
+    from django_windowsauthtoken.resolvers import get_resolver
+
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.FakeTokenResolver"
+    settings.WINDOWSAUTHTOKEN_RESOLVER_OPTIONS = resolver_options
+    return get_resolver()
+
+
+@pytest.fixture()
+def shared_cache(request, settings):
+    """
+    Configure a local memory cache as the shared identity cache, and clear it afterwards.
+
+    The location of the cache defaults to `identities`, and can be set by parametrizing the fixture indirectly.
+    """
+    from django_windowsauthtoken.cache import get_shared_identity_cache
+
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "identities": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": getattr(request, "param", "identities"),
+        },
+    }
+    settings.WINDOWSAUTHTOKEN_SHARED_CACHE = "identities"
+    shared_cache = get_shared_identity_cache()
+    yield shared_cache
+    shared_cache.cache.clear()
@@ -0,0 +1,120 @@
+import pytest
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory
+
+from django_windowsauthtoken.backends import WindowsAuthTokenBackend, get_user_cache, get_user_row_cache
+
+
+@pytest.fixture()
+def backend_settings(settings):
+    settings.AUTHENTICATION_BACKENDS = ["django_windowsauthtoken.backends.WindowsAuthTokenBackend"]
+    settings.SESSION_ENGINE = "django.contrib.sessions.backends.signed_cookies"
+    settings.WINDOWSAUTHTOKEN_USER_CACHE_ROWS = True
+    return settings
+
+
+def make_request(sid_string=None):
+    request = RequestFactory().get("/")
+    if sid_string is not None:
+        request.META["WINDOWSAUTHTOKEN_SID"] = sid_string
+    return request
+
+
+@pytest.mark.django_db
+def test_authenticate_caches_user_by_sid(django_assert_num_queries):
+    backend = WindowsAuthTokenBackend()
+    user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    assert user.get_username() == r"TESTDOMAIN\testuser"
+    assert get_user_cache().get("S-1-5-21-1") == user.pk
+
+    # Without cached rows, the user is fetched by its primary key
+    with django_assert_num_queries(1):
+        assert backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser") == user
+
+
+@pytest.mark.django_db
+def test_authenticate_cached_rows(settings, django_assert_num_queries):
+    settings.WINDOWSAUTHTOKEN_USER_CACHE_ROWS = True
+    backend = WindowsAuthTokenBackend()
+    user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    with django_assert_num_queries(0):
+        cached_user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+    assert cached_user == user
+    assert cached_user is not user
+    assert cached_user._state.adding is False
+
+
+@pytest.mark.django_db
+def test_authenticate_renamed_account():
+    backend = WindowsAuthTokenBackend()
+    user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    renamed_user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\renameduser")
+
+    assert renamed_user != user
+    assert renamed_user.get_username() == r"TESTDOMAIN\renameduser"
+    assert get_user_cache().get("S-1-5-21-1") == renamed_user.pk
+
+
+@pytest.mark.django_db
+def test_authenticate_without_sid():
+    user = WindowsAuthTokenBackend().authenticate(make_request(), r"TESTDOMAIN\testuser")
+
+    assert user.get_username() == r"TESTDOMAIN\testuser"
+    assert len(get_user_cache()) == 0
+
+
+@pytest.mark.django_db
+def test_cached_rows_are_invalidated(settings, django_assert_num_queries):
+    settings.WINDOWSAUTHTOKEN_USER_CACHE_ROWS = True
+    backend = WindowsAuthTokenBackend()
+    user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    user.is_active = False
+    user.save()
+    assert get_user_row_cache().get(str(user.pk)) is None
+    assert backend.get_user(user.pk) is None
+
+    user.delete()
+    assert get_user_row_cache().get(str(user.pk)) is None
+
+
+@pytest.mark.django_db
+def test_cached_rows_inactive_user(settings):
+    settings.WINDOWSAUTHTOKEN_USER_CACHE_ROWS = True
+    backend = WindowsAuthTokenBackend()
+    user = backend.authenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    # The row is updated without signals, e.g. by another process
+    get_user_model().objects.filter(pk=user.pk).update(is_active=False)
+    row_cache = get_user_row_cache()
+    db, values = row_cache.get(str(user.pk))
+    field_names = [field.attname for field in get_user_model()._meta.concrete_fields]
+    values = tuple(False if name == "is_active" else value for name, value in zip(field_names, values))
+    row_cache.set(str(user.pk), (db, values))
+
+    assert backend.get_user(user.pk) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_full_stack_without_queries(backend_settings, fake_resolver, client, django_assert_num_queries):
+    response = client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    assert response.wsgi_request.META["WINDOWSAUTHTOKEN_SID"] == "S-1-5-21-1"
+    assert response.wsgi_request.user.get_username() == r"TESTDOMAIN\testuser"
+    # Logging in updates the last login time, which drops the cached row
+    client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+
+    with django_assert_num_queries(0):
+        response = client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+        assert response.wsgi_request.user.get_username() == r"TESTDOMAIN\testuser"
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_aauthenticate(fake_resolver):
+    user = await WindowsAuthTokenBackend().aauthenticate(make_request("S-1-5-21-1"), r"TESTDOMAIN\testuser")
+
+    assert user.get_username() == r"TESTDOMAIN\testuser"
+    assert get_user_cache().get("S-1-5-21-1") == user.pk
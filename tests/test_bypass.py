@@ -0,0 +1,41 @@
+import pytest
+
+from django_windowsauthtoken.bypass import PathPrefixTrie
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    [
+        ("/static/css/site.css", True),
+        ("/static/", True),
+        ("/static", False),
+        ("/media/uploads/file.pdf", True),
+        ("/healthz", True),
+        ("/health", True),
+        ("/", False),
+        ("/admin/", False),
+        ("", False),
+    ],
+)
+def test_trie_matches(path, expected):
+    trie = PathPrefixTrie(["/static/", "/media/", "/health"])
+
+    assert trie.matches(path) is expected
+
+
+def test_trie_overlapping_prefixes():
+    trie = PathPrefixTrie(["/api/public/", "/api/"])
+
+    assert trie.matches("/api/private/")
+    assert trie.matches("/api/public/status")
+
+
+def test_trie_empty():
+    trie = PathPrefixTrie()
+
+    assert not trie
+    assert not trie.matches("/static/")
+
+
+def test_trie_empty_prefix_matches_everything():
+    assert PathPrefixTrie([""]).matches("/any/path")
@@ -0,0 +1,345 @@
+import gc
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from django_windowsauthtoken.cache import (
+    IdentityCache,
+    PersistentIdentityStore,
+    SharedIdentityCache,
+    SingleFlight,
+    _flush_persistent_stores,
+    get_identity_cache,
+    get_persistent_identity_store,
+    get_shared_identity_cache,
+)
+
+
+def test_cache_miss_and_hit():
+    cache = IdentityCache(max_size=10, ttl=60)
+
+    assert cache.get("S-1-5-21-1") is None
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    assert cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_cache_expires_entries(mocker):
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    cache = IdentityCache(max_size=10, ttl=60)
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    mock_monotonic.return_value = 159.0
+    assert cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+    mock_monotonic.return_value = 160.0
+    assert cache.get("S-1-5-21-1") is None
+    assert len(cache) == 0
+
+
+def test_cache_stale_entries(mocker):
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    cache = IdentityCache(max_size=10, ttl=60, stale_ttl=30)
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    assert cache.get_stale("S-1-5-21-1") is None
+
+    # Expired entries are misses, but remain available as stale entries
+    mock_monotonic.return_value = 170.0
+    assert cache.get("S-1-5-21-1") is None
+    assert cache.get_stale("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    assert cache.stale_hits == 1
+
+    mock_monotonic.return_value = 190.0
+    assert cache.get("S-1-5-21-1") is None
+    assert cache.get_stale("S-1-5-21-1") is None
+    assert len(cache) == 0
+
+
+def test_cache_set_shorter_ttl(mocker):
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    cache = IdentityCache(max_size=10, ttl=60)
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"), ttl=10)
+    # A longer TTL than the cache TTL is capped
+    cache.set("S-1-5-21-2", ("otheruser", "TESTDOMAIN"), ttl=3600)
+
+    mock_monotonic.return_value = 110.0
+    assert cache.get("S-1-5-21-1") is None
+    assert cache.get("S-1-5-21-2") == ("otheruser", "TESTDOMAIN")
+
+    mock_monotonic.return_value = 160.0
+    assert cache.get("S-1-5-21-2") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = IdentityCache(max_size=2, ttl=60)
+    cache.set("S-1-5-21-1", ("user1", "TESTDOMAIN"))
+    cache.set("S-1-5-21-2", ("user2", "TESTDOMAIN"))
+
+    # Touch the first entry, so the second one becomes the least recently used
+    cache.get("S-1-5-21-1")
+    cache.set("S-1-5-21-3", ("user3", "TESTDOMAIN"))
+
+    assert cache.get("S-1-5-21-1") == ("user1", "TESTDOMAIN")
+    assert cache.get("S-1-5-21-2") is None
+    assert cache.get("S-1-5-21-3") == ("user3", "TESTDOMAIN")
+
+
+@pytest.mark.parametrize("max_size,ttl", [(0, 60), (10, 0)])
+def test_cache_disabled(max_size, ttl):
+    cache = IdentityCache(max_size=max_size, ttl=ttl)
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    assert cache.enabled is False
+    assert cache.get("S-1-5-21-1") is None
+
+
+def test_cache_delete_and_clear():
+    cache = IdentityCache(max_size=10, ttl=60)
+    cache.set("S-1-5-21-1", ("user1", "TESTDOMAIN"))
+    cache.set("S-1-5-21-2", ("user2", "TESTDOMAIN"))
+
+    cache.delete("S-1-5-21-1")
+    assert cache.get("S-1-5-21-1") is None
+
+    cache.clear()
+    assert cache.stats() == {"size": 0, "max_size": 10, "ttl": 60, "hits": 0, "misses": 0, "stale_hits": 0}
+
+
+def test_get_identity_cache_uses_settings(settings):
+    settings.WINDOWSAUTHTOKEN_CACHE_SIZE = 5
+    settings.WINDOWSAUTHTOKEN_CACHE_TTL = 10
+
+    cache = get_identity_cache()
+    assert cache.max_size == 5
+    assert cache.ttl == 10
+    assert get_identity_cache() is cache
+
+
+class WaiterCountingEvent(threading.Event):
+    """Event that keeps track of the number of threads waiting for it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = threading.Semaphore(0)
+
+    def wait(self, timeout=None):
+        self.waiters.release()
+        return super().wait(timeout)
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ("testuser", "TESTDOMAIN")
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        leader = executor.submit(single_flight.do, "S-1-5-21-1", lookup)
+        started.wait(5)
+        done = single_flight._calls["S-1-5-21-1"].done = WaiterCountingEvent()
+
+        followers = [executor.submit(single_flight.do, "S-1-5-21-1", lookup) for _ in range(4)]
+        # Only release the leader once all followers are waiting for its result
+        for _ in followers:
+            assert done.waiters.acquire(timeout=5)
+        release.set()
+
+        results = [leader.result(5)] + [follower.result(5) for follower in followers]
+
+    assert results == [("testuser", "TESTDOMAIN")] * 5
+    assert len(calls) == 1
+    assert len(single_flight) == 0
+
+
+def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def lookup():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("Domain controller unavailable")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "S-1-5-21-1", lookup)
+        started.wait(5)
+        done = single_flight._calls["S-1-5-21-1"].done = WaiterCountingEvent()
+
+        follower = executor.submit(single_flight.do, "S-1-5-21-1", lookup)
+        assert done.waiters.acquire(timeout=5)
+        release.set()
+
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError, match="Domain controller unavailable"):
+                future.result(5)
+
+    assert len(single_flight) == 0
+
+
+def test_single_flight_separate_keys():
+    single_flight = SingleFlight()
+
+    assert single_flight.do("S-1-5-21-1", lambda: 1) == 1
+    assert single_flight.do("S-1-5-21-2", lambda: 2) == 2
+
+
+def test_shared_cache_miss_and_hit(shared_cache):
+    assert shared_cache.get("S-1-5-21-1") is None
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    assert shared_cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+    assert shared_cache.cache.get("windowsauthtoken:sid:S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    assert shared_cache.stats() == {"alias": "identities", "ttl": 300, "hits": 1, "misses": 1}
+
+
+def test_shared_cache_batched(mocker, shared_cache):
+    spy_set_many = mocker.spy(shared_cache.cache, "set_many")
+    spy_get_many = mocker.spy(shared_cache.cache, "get_many")
+
+    shared_cache.set_many({"S-1-5-21-1": ("user1", "TESTDOMAIN"), "S-1-5-21-2": ("user2", "TESTDOMAIN")})
+    found = shared_cache.get_many(["S-1-5-21-1", "S-1-5-21-2", "S-1-5-21-3"])
+
+    assert found == {"S-1-5-21-1": ("user1", "TESTDOMAIN"), "S-1-5-21-2": ("user2", "TESTDOMAIN")}
+    assert spy_set_many.call_count == 1
+    assert spy_get_many.call_count == 1
+
+
+def test_shared_cache_delete(shared_cache):
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    shared_cache.delete("S-1-5-21-1")
+    assert shared_cache.get("S-1-5-21-1") is None
+
+
+def test_shared_cache_errors_are_misses(mocker, shared_cache, caplog):
+    mock_cache = mocker.patch.object(SharedIdentityCache, "cache", new_callable=mocker.PropertyMock)
+    mock_cache.return_value.get_many.side_effect = ConnectionError("Connection refused")
+    mock_cache.return_value.set_many.side_effect = ConnectionError("Connection refused")
+    mock_cache.return_value.delete.side_effect = ConnectionError("Connection refused")
+
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    assert shared_cache.get("S-1-5-21-1") is None
+    shared_cache.delete("S-1-5-21-1")
+
+    assert "Cannot write to shared identity cache 'identities': Connection refused" in caplog.text
+    assert "Cannot read from shared identity cache 'identities': Connection refused" in caplog.text
+    assert "Cannot delete from shared identity cache 'identities': Connection refused" in caplog.text
+
+
+def test_get_shared_identity_cache_disabled_by_default():
+    assert get_shared_identity_cache() is None
+
+
+def test_persistent_store_round_trip(tmp_path):
+    path = str(tmp_path / "identities.sqlite3")
+    store = PersistentIdentityStore(path, ttl=60)
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.set("S-1-5-21-2", ("otheruser", "TESTDOMAIN"))
+    assert store.pending_count() == 2
+
+    store.flush()
+    assert store.pending_count() == 0
+
+    # A new process reads what the previous one wrote
+    identities = PersistentIdentityStore(path, ttl=60).load()
+    assert {sid: identity[:2] for sid, identity in identities.items()} == {
+        "S-1-5-21-1": ("testuser", "TESTDOMAIN"),
+        "S-1-5-21-2": ("otheruser", "TESTDOMAIN"),
+    }
+
+
+def test_persistent_store_flushed_at_exit(tmp_path):
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60)
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    _flush_persistent_stores()
+
+    assert store.pending_count() == 0
+    assert list(store.load()) == ["S-1-5-21-1"]
+
+
+def test_persistent_store_not_kept_alive(tmp_path):
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60)
+    reference = weakref.ref(store)
+
+    del store
+    gc.collect()
+
+    assert reference() is None
+
+
+def test_persistent_store_writes_in_background(mocker, tmp_path):
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60, flush_interval=0.01)
+    spy = mocker.spy(store, "flush")
+
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.set("S-1-5-21-2", ("otheruser", "TESTDOMAIN"))
+    writer = store._writer
+    writer.join(timeout=5)
+
+    assert store._writer is None
+    assert len(store.load()) == 2
+    # Both identities were written in a single batch
+    assert spy.call_count == 1
+
+
+def test_persistent_store_expires_entries(mocker, tmp_path):
+    mock_time = mocker.patch("django_windowsauthtoken.cache.time.time", return_value=1000.0)
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60)
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    mock_time.return_value = 1030.0
+    store.set("S-1-5-21-2", ("otheruser", "TESTDOMAIN"))
+    store.flush()
+
+    mock_time.return_value = 1070.0
+    assert list(store.load()) == ["S-1-5-21-2"]
+
+
+def test_persistent_store_load_into(mocker, tmp_path):
+    mock_time = mocker.patch("django_windowsauthtoken.cache.time.time", return_value=1000.0)
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60)
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.flush()
+
+    mock_time.return_value = 1050.0
+    cache = IdentityCache(max_size=10, ttl=300)
+    assert store.load_into(cache) == 1
+    # Loading is only done once
+    assert store.load_into(cache) == 0
+
+    # The entry is kept for the remainder of its TTL
+    mock_monotonic.return_value = 109.0
+    assert cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    mock_monotonic.return_value = 110.0
+    assert cache.get("S-1-5-21-1") is None
+
+
+def test_persistent_store_errors(tmp_path, caplog):
+    store = PersistentIdentityStore(str(tmp_path / "missing" / "identities.sqlite3"))
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.flush()
+
+    assert store.load() == {}
+    assert "Cannot write to persistent identity store" in caplog.text
+    assert "Cannot read from persistent identity store" in caplog.text
+
+
+def test_get_persistent_identity_store(settings, tmp_path):
+    assert get_persistent_identity_store() is None
+
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = tmp_path / "identities.sqlite3"
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE_TTL = 3600
+    store = get_persistent_identity_store()
+    assert store.path == str(tmp_path / "identities.sqlite3")
+    assert store.ttl == 3600
@@ -0,0 +1,43 @@
+from django.core.checks import Tags, run_checks
+
+from django_windowsauthtoken.checks import check_pywin32
+
+
+def test_check_pywin32_missing(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("importlib.util.find_spec", return_value=None)
+
+    errors = check_pywin32()
+
+    assert [error.id for error in errors] == ["windowsauthtoken.E001"]
+    assert "pywintypes, win32api, win32security cannot be found" in errors[0].hint
+
+
+def test_check_pywin32_installed(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mock_find_spec = mocker.patch("importlib.util.find_spec")
+
+    assert check_pywin32() == []
+    assert mock_find_spec.call_count == 3
+
+
+def test_check_pywin32_ignored(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", True)
+
+    assert check_pywin32() == []
+
+
+def test_check_pywin32_other_resolver(mocker, settings):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.FakeTokenResolver"
+
+    assert check_pywin32() == []
+
+
+def test_check_is_registered(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("importlib.util.find_spec", return_value=None)
+
+    errors = run_checks(tags=[Tags.compatibility])
+
+    assert "windowsauthtoken.E001" in [error.id for error in errors]
@@ -1,9 +1,11 @@
 import pytest
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 
 from django_windowsauthtoken.formatters import (
+    FormatterPipeline,
     FormattingError,
+    compile_formatter_pipeline,
     format_domain_user,
     format_email_like,
     format_username_only,
@@ -89,3 +91,73 @@ def test_format_email_like_compatible_with_django_user_model():
     formatted_username = format_email_like("testuser", "TESTDOMAIN")
     user = User.objects.create_user(username=formatted_username)
     assert user.full_clean() is None
+
+
+def test_formatter_pipeline():
+    pipeline = FormatterPipeline(
+        format_email_like,
+        strip_prefixes=["adm-", "adm-x-"],
+        domain_aliases={"CORP": "Corp.Example.com"},
+        case="lower",
+    )
+
+    assert pipeline("ADM-X-TestUser", "corp") == "testuser@corp.example.com"
+    assert pipeline("adm-testuser", "OTHERDOMAIN") == "testuser@otherdomain"
+    # Prefixes are only stripped from the start of the username
+    assert pipeline("testadm-user", "CORP") == "testadm-user@corp.example.com"
+
+
+def test_formatter_pipeline_without_steps():
+    assert FormatterPipeline(format_domain_user)("testuser", "TESTDOMAIN") == r"TESTDOMAIN\testuser"
+
+
+def test_formatter_pipeline_memoizes(mocker):
+    formatter = mocker.Mock(side_effect=format_domain_user)
+    pipeline = FormatterPipeline(formatter, case="upper", cache_size=2)
+
+    assert pipeline("testuser", "testdomain") == r"TESTDOMAIN\TESTUSER"
+    assert pipeline("testuser", "testdomain") == r"TESTDOMAIN\TESTUSER"
+    assert formatter.call_count == 1
+
+    pipeline.cache_clear()
+    pipeline("testuser", "testdomain")
+    assert formatter.call_count == 2
+
+
+def test_formatter_pipeline_without_memoization(mocker):
+    formatter = mocker.Mock(side_effect=format_domain_user)
+    pipeline = FormatterPipeline(formatter, cache_size=0)
+
+    pipeline("testuser", "TESTDOMAIN")
+    pipeline("testuser", "TESTDOMAIN")
+    pipeline.cache_clear()
+    assert formatter.call_count == 2
+
+
+def test_formatter_pipeline_raises_formatting_error():
+    pipeline = FormatterPipeline(format_domain_user, strip_prefixes=["adm-"])
+
+    # Stripping the prefix leaves an empty username
+    for _ in range(2):
+        with pytest.raises(FormattingError):
+            pipeline("adm-", "TESTDOMAIN")
+
+
+def test_formatter_pipeline_fingerprint():
+    pipeline = FormatterPipeline(format_domain_user, case="lower")
+
+    assert pipeline.fingerprint == FormatterPipeline(format_email_like, case="lower", cache_size=10).fingerprint
+    assert pipeline.fingerprint != FormatterPipeline(format_domain_user, case="upper").fingerprint
+
+
+@pytest.mark.parametrize(
+    "options, message",
+    [
+        ({"case": "title"}, "Unknown case conversion 'title'"),
+        ({"strip_prefixes": "adm-"}, "strip_prefixes must be a list"),
+        ({"format": "email"}, "Invalid username formatter pipeline"),
+    ],
+)
+def test_compile_formatter_pipeline_invalid(options, message):
+    with pytest.raises(ImproperlyConfigured, match=message):
+        compile_formatter_pipeline(format_domain_user, options)
@@ -0,0 +1,190 @@
+import threading
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+
+from django_windowsauthtoken.groups import (
+    format_group_name,
+    get_group_cache,
+    get_shared_group_cache,
+    resolve_group_names,
+    sync_user_groups,
+)
+from django_windowsauthtoken.resolvers import ResolverError
+
+
+@pytest.fixture()
+def resolver_options():
+    return {
+        "accounts": {
+            "S-1-5-21-512": ("Domain Admins", "TESTDOMAIN"),
+            "S-1-5-21-513": ("Domain Users", "TESTDOMAIN"),
+            "S-1-1-0": ("Everyone", ""),
+        },
+    }
+
+
+@pytest.fixture()
+def shared_group_cache(shared_cache):
+    return get_shared_group_cache()
+
+
+def test_format_group_name():
+    assert format_group_name("Domain Users", "TESTDOMAIN") == r"TESTDOMAIN\Domain Users"
+    assert format_group_name("Everyone", "") == "Everyone"
+
+
+def test_resolve_group_names(mocker, fake_resolver):
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    expected = frozenset([r"TESTDOMAIN\Domain Users", "Everyone"])
+    assert resolve_group_names(["S-1-5-21-513", "S-1-1-0"]) == expected
+    assert spy.call_count == 2
+
+    # The second time, the names come from the cache
+    assert resolve_group_names(["S-1-5-21-513", "S-1-1-0"]) == expected
+    assert spy.call_count == 2
+    assert get_group_cache().get("S-1-1-0") == ("Everyone", "")
+
+
+def test_resolve_group_names_unknown_group(mocker, fake_resolver):
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    assert resolve_group_names(["S-1-5-21-999", None]) == frozenset(["S-1-5-21-999"])
+    # Unknown groups are cached by their SID string, invalid SIDs are skipped
+    assert resolve_group_names(["S-1-5-21-999"]) == frozenset(["S-1-5-21-999"])
+    assert spy.call_count == 1
+    assert get_group_cache().get("S-1-5-21-999") == ("S-1-5-21-999", "")
+
+
+def test_resolve_group_names_unknown_group_expires(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL = 0
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    for _ in range(2):
+        assert resolve_group_names(["S-1-5-21-999"]) == frozenset(["S-1-5-21-999"])
+    assert spy.call_count == 2
+
+
+def test_resolve_group_names_failed_lookup_not_cached(mocker, fake_resolver):
+    mock_lookup = mocker.patch.object(
+        fake_resolver,
+        "lookup_account_sid",
+        side_effect=[ResolverError("Unavailable"), ("Domain Users", "TESTDOMAIN", 2)],
+    )
+
+    assert resolve_group_names(["S-1-5-21-513"]) == frozenset(["S-1-5-21-513"])
+    assert resolve_group_names(["S-1-5-21-513"]) == frozenset([r"TESTDOMAIN\Domain Users"])
+    assert mock_lookup.call_count == 2
+
+
+def test_resolve_group_names_shared_cache(mocker, fake_resolver, shared_group_cache):
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+    spy_get_many = mocker.spy(shared_group_cache.cache, "get_many")
+    shared_group_cache.set("S-1-5-21-1000", ("Sales", "TESTDOMAIN"))
+
+    names = resolve_group_names(["S-1-5-21-1000", "S-1-5-21-512", "S-1-5-21-513"])
+    assert names == frozenset([r"TESTDOMAIN\Sales", r"TESTDOMAIN\Domain Admins", r"TESTDOMAIN\Domain Users"])
+    # One round trip to the shared cache, and only the missing groups are looked up
+    assert spy_get_many.call_count == 1
+    assert spy.call_count == 2
+    assert shared_group_cache.get("S-1-5-21-512") == ("Domain Admins", "TESTDOMAIN")
+    assert get_group_cache().get("S-1-5-21-1000") == ("Sales", "TESTDOMAIN")
+
+
+def test_resolve_group_names_concurrently(mocker, fake_resolver):
+    # Every lookup waits for the others, so serial lookups would break the barrier
+    barrier = threading.Barrier(3, timeout=5)
+    lookup_account_sid = fake_resolver.lookup_account_sid
+
+    def lookup(security_id):
+        barrier.wait()
+        return lookup_account_sid(security_id)
+
+    mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=lookup)
+
+    names = resolve_group_names(["S-1-5-21-512", "S-1-5-21-513", "S-1-1-0"])
+    assert names == frozenset([r"TESTDOMAIN\Domain Admins", r"TESTDOMAIN\Domain Users", "Everyone"])
+
+
+def test_resolve_group_names_concurrency_limit(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_GROUP_LOOKUP_CONCURRENCY = 2
+    fake_resolver.lookup_latency = 0.01
+    lookup_account_sid = fake_resolver.lookup_account_sid
+    lock = threading.Lock()
+    running = []
+    max_running = 0
+
+    def lookup(security_id):
+        nonlocal max_running
+        with lock:
+            running.append(security_id)
+            max_running = max(max_running, len(running))
+        try:
+            return lookup_account_sid(security_id)
+        finally:
+            with lock:
+                running.remove(security_id)
+
+    mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=lookup)
+
+    names = resolve_group_names([f"S-1-5-21-{number}" for number in range(1000, 1006)])
+    assert len(names) == 6
+    assert max_running <= 2
+
+
+def test_shared_group_cache_is_separate(fake_resolver, shared_cache, shared_group_cache):
+    shared_cache.set("S-1-5-21-512", ("testuser", "TESTDOMAIN"))
+
+    assert shared_group_cache.get("S-1-5-21-512") is None
+
+
+def test_resolve_group_names_circuit_open(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD = 1
+    settings.WINDOWSAUTHTOKEN_GROUP_LOOKUP_CONCURRENCY = 1
+    mock_lookup = mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=ResolverError("Unavailable"))
+
+    assert resolve_group_names(["S-1-5-21-512", "S-1-5-21-513"]) == frozenset(["S-1-5-21-512", "S-1-5-21-513"])
+    # The first failure opens the circuit, so the second group is not looked up
+    assert mock_lookup.call_count == 1
+
+
+@pytest.fixture()
+def group_mapping(settings):
+    settings.WINDOWSAUTHTOKEN_GROUP_MAPPING = {
+        r"TESTDOMAIN\Domain Admins": "admins",
+        r"TESTDOMAIN\Sales": "sales",
+    }
+
+
+@pytest.mark.django_db
+def test_sync_user_groups(group_mapping):
+    user = get_user_model().objects.create_user("testuser")
+    other = Group.objects.create(name="other")
+    user.groups.add(other)
+
+    sync_user_groups(user, [r"testdomain\domain admins", r"TESTDOMAIN\Domain Users"])
+    assert set(user.groups.values_list("name", flat=True)) == {"admins", "other"}
+
+    sync_user_groups(user, [r"TESTDOMAIN\Sales"])
+    # Groups that are not in the mapping are left alone
+    assert set(user.groups.values_list("name", flat=True)) == {"sales", "other"}
+
+
+@pytest.mark.django_db
+def test_sync_user_groups_unchanged(group_mapping, django_assert_num_queries):
+    user = get_user_model().objects.create_user("testuser")
+    sync_user_groups(user, [r"TESTDOMAIN\Sales"])
+
+    # Only the current memberships are read
+    with django_assert_num_queries(1):
+        sync_user_groups(user, [r"TESTDOMAIN\Sales"])
+
+
+@pytest.mark.django_db
+def test_sync_user_groups_without_mapping(django_assert_num_queries):
+    user = get_user_model().objects.create_user("testuser")
+
+    with django_assert_num_queries(0):
+        sync_user_groups(user, [r"TESTDOMAIN\Sales"])
@@ -0,0 +1,75 @@
+import logging
+
+from django_windowsauthtoken.handles import HandleTracker, get_handle_tracker, track_handle_closed, track_handle_opened
+
+
+def test_handle_tracker_counts():
+    tracker = HandleTracker()
+    tracker.track_opened(0x1A)
+    tracker.track_opened(0x2B)
+    tracker.track_opened(0x3C)
+    tracker.track_closed(0x1A)
+    tracker.track_closed(0x2B, failed=True)
+
+    snapshot = tracker.snapshot()
+    assert snapshot["opened"] == 3
+    assert snapshot["closed"] == 1
+    assert snapshot["close_failures"] == 1
+    assert snapshot["in_flight"] == 1
+    assert snapshot["held_seconds_sum"] >= snapshot["held_seconds_max"] > 0
+    assert snapshot["oldest_in_flight_seconds"] > 0
+    assert snapshot["leak_suspected"] is False
+    assert tracker.in_flight == 1
+
+
+def test_handle_tracker_empty_snapshot():
+    snapshot = HandleTracker().snapshot()
+    assert snapshot["in_flight"] == 0
+    assert snapshot["oldest_in_flight_seconds"] == 0.0
+
+
+def test_handle_tracker_leak_alarm(caplog):
+    tracker = HandleTracker(leak_threshold=2)
+    tracker.track_opened(0x1A)
+    tracker.track_opened(0x2B)
+    tracker.track_opened(0x3C)
+
+    # The alarm is only raised once
+    errors = [record for record in caplog.records if record.levelno == logging.ERROR]
+    assert len(errors) == 1
+    assert "Token handles may be leaking: in_flight=2 close_failures=0 threshold=2" in errors[0].getMessage()
+    assert tracker.snapshot()["leak_suspected"] is True
+
+    tracker.track_closed(0x1A)
+    tracker.track_closed(0x2B)
+    assert tracker.snapshot()["leak_suspected"] is False
+
+
+def test_handle_tracker_failed_closes_count_as_leaks(caplog):
+    tracker = HandleTracker(leak_threshold=2)
+    for handle in (0x1A, 0x2B):
+        tracker.track_opened(handle)
+        tracker.track_closed(handle, failed=True)
+
+    assert tracker.in_flight == 0
+    assert tracker.snapshot()["leak_suspected"] is True
+    assert "Token handles may be leaking" in caplog.text
+
+
+def test_handle_tracking_disabled_by_default():
+    assert get_handle_tracker() is None
+    # Doesn't fail when disabled
+    track_handle_opened(0x1A)
+    track_handle_closed(0x1A)
+
+
+def test_handle_tracking_enabled(settings):
+    settings.WINDOWSAUTHTOKEN_HANDLE_TRACKING = True
+    settings.WINDOWSAUTHTOKEN_HANDLE_LEAK_THRESHOLD = 10
+
+    track_handle_opened(0x1A)
+    track_handle_closed(0x1A)
+
+    tracker = get_handle_tracker()
+    assert tracker.leak_threshold == 10
+    assert tracker.snapshot()["closed"] == 1
@@ -0,0 +1,322 @@
+import sys
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory
+
+from django_windowsauthtoken.backends import get_user_cache
+from django_windowsauthtoken.cache import (
+    IdentityCache,
+    PersistentIdentityStore,
+    get_identity_cache,
+    get_negative_identity_cache,
+    get_persistent_identity_store,
+)
+from django_windowsauthtoken.groups import get_group_cache, get_shared_group_cache
+from django_windowsauthtoken.invalidation import (
+    GENERATION_KEY,
+    INVALIDATION_LOG_SIZE,
+    LOG_KEY,
+    InvalidationWatcher,
+    check_invalidations,
+    get_invalidation_log,
+    get_invalidation_watcher,
+    invalidate_all,
+    invalidate_domain,
+    invalidate_sid,
+)
+from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+
+
+@pytest.fixture()
+def identities():
+    identity_cache = get_identity_cache()
+    identity_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    identity_cache.set("S-1-5-21-2", ("otheruser", "testdomain"))
+    identity_cache.set("S-1-5-21-3", ("thirduser", "OTHERDOMAIN"))
+    get_negative_identity_cache().set("S-1-5-21-4", "No mapping")
+    get_group_cache().set("S-1-5-21-513", ("Domain Users", "TESTDOMAIN"))
+    get_user_cache().set("S-1-5-21-1", 1)
+    return identity_cache
+
+
+def test_identity_cache_delete_where():
+    cache: IdentityCache[tuple[str, str]] = IdentityCache()
+    cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    cache.set("S-1-5-21-2", ("otheruser", "OTHERDOMAIN"))
+
+    assert cache.delete_where(lambda key, value: value[1] == "TESTDOMAIN") == 1
+    assert cache.get("S-1-5-21-1") is None
+    assert cache.get("S-1-5-21-2") == ("otheruser", "OTHERDOMAIN")
+
+
+def test_shared_cache_namespace(shared_cache):
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    shared_cache.namespace = 3
+
+    assert shared_cache.make_key("S-1-5-21-1") == "windowsauthtoken:sid:3:S-1-5-21-1"
+    assert shared_cache.get("S-1-5-21-1") is None
+
+
+def test_persistent_store_delete(tmp_path):
+    store = PersistentIdentityStore(str(tmp_path / "identities.sqlite3"), ttl=60)
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.set("S-1-5-21-2", ("otheruser", "testdomain"))
+    store.set("S-1-5-21-3", ("thirduser", "OTHERDOMAIN"))
+    store.flush()
+    store.set("S-1-5-21-4", ("queueduser", "TESTDOMAIN"))
+
+    assert store.get("S-1-5-21-1")[:2] == ("testuser", "TESTDOMAIN")
+    assert store.delete(key="S-1-5-21-1") == 1
+    assert store.get("S-1-5-21-1") is None
+    assert store.delete(domain="TestDomain") == 1
+    assert store.pending_count() == 0
+    assert list(store.load()) == ["S-1-5-21-3"]
+    assert store.delete() == 1
+    assert store.load() == {}
+
+
+def test_invalidate_sid(identities):
+    invalidate_sid("S-1-5-21-1")
+
+    assert identities.get("S-1-5-21-1") is None
+    assert identities.get("S-1-5-21-2") == ("otheruser", "testdomain")
+    assert get_user_cache().get("S-1-5-21-1") is None
+
+
+def test_invalidate_domain(identities):
+    invalidate_domain("TESTDOMAIN")
+
+    assert identities.get("S-1-5-21-1") is None
+    assert identities.get("S-1-5-21-2") is None
+    assert identities.get("S-1-5-21-3") == ("thirduser", "OTHERDOMAIN")
+    assert get_group_cache().get("S-1-5-21-513") is None
+    assert get_negative_identity_cache().get("S-1-5-21-4") is None
+
+
+def test_invalidate_without_backend_loaded(mocker, identities):
+    mocker.patch.dict(sys.modules, {"django_windowsauthtoken.backends": None})
+
+    invalidate_sid("S-1-5-21-1")
+    invalidate_all()
+
+    assert identities.get("S-1-5-21-2") is None
+    assert get_user_cache().get("S-1-5-21-1") == 1
+
+
+def test_invalidation_log_publish(shared_cache):
+    log = get_invalidation_log()
+
+    assert log.read() == (0, 0, [])
+    assert log.publish("sid", "S-1-5-21-1") == 1
+    assert log.publish("domain", "TESTDOMAIN") == 2
+    assert log.read() == (2, 2, [(1, "sid", "S-1-5-21-1"), (2, "domain", "TESTDOMAIN")])
+
+
+def test_invalidation_log_is_bounded(shared_cache):
+    log = get_invalidation_log()
+    for number in range(INVALIDATION_LOG_SIZE + 5):
+        log.publish("sid", f"S-1-5-21-{number}")
+
+    generation, _, entries = log.read()
+    assert generation == INVALIDATION_LOG_SIZE + 5
+    assert len(entries) == INVALIDATION_LOG_SIZE
+    assert entries[0][0] == 6
+
+
+def test_get_invalidation_watcher_disabled_by_default():
+    assert get_invalidation_log() is None
+    assert get_invalidation_watcher() is None
+    check_invalidations()
+
+
+def test_watcher_adopts_current_generation(shared_cache, identities):
+    log = get_invalidation_log()
+    log.publish("all")
+    watcher = InvalidationWatcher(log)
+
+    watcher.refresh()
+
+    assert watcher.generation == 1
+    assert identities.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    assert shared_cache.namespace == 1
+
+
+def test_watcher_applies_invalidations(shared_cache, identities):
+    log = get_invalidation_log()
+    watcher = InvalidationWatcher(log, check_interval=0)
+    watcher.refresh()
+
+    log.publish("sid", "S-1-5-21-1")
+    log.publish("domain", "OTHERDOMAIN")
+    watcher.refresh()
+
+    assert watcher.generation == 2
+    assert identities.get("S-1-5-21-1") is None
+    assert identities.get("S-1-5-21-2") == ("otheruser", "testdomain")
+    assert identities.get("S-1-5-21-3") is None
+    assert shared_cache.namespace == 2
+    assert get_shared_group_cache().namespace == 2
+
+
+def test_watcher_clears_caches_after_missed_invalidations(shared_cache, identities):
+    log = get_invalidation_log()
+    watcher = InvalidationWatcher(log, check_interval=0)
+    watcher.refresh()
+
+    for number in range(INVALIDATION_LOG_SIZE + 1):
+        log.publish("sid", f"S-1-5-22-{number}")
+    watcher.refresh()
+
+    assert len(identities) == 0
+
+
+def test_watcher_clears_caches_after_lost_log_entry(shared_cache, identities):
+    log = get_invalidation_log()
+    watcher = InvalidationWatcher(log, check_interval=0)
+    watcher.refresh()
+
+    # A concurrent publish overwrote the log without the second invalidation
+    shared_cache.cache.set_many({GENERATION_KEY: 2, LOG_KEY: [(1, "sid", "S-1-5-21-1")]})
+    watcher.refresh()
+
+    assert watcher.generation == 2
+    assert len(identities) == 0
+
+
+def test_watcher_clears_caches_when_shared_cache_was_cleared(shared_cache, identities):
+    log = get_invalidation_log()
+    log.publish("sid", "S-1-5-21-5")
+    watcher = InvalidationWatcher(log, check_interval=0)
+    watcher.refresh()
+
+    shared_cache.cache.clear()
+    watcher.refresh()
+
+    assert watcher.generation == 0
+    assert len(identities) == 0
+
+
+def test_watcher_checks_once_per_interval(mocker, shared_cache):
+    log = get_invalidation_log()
+    watcher = InvalidationWatcher(log, check_interval=60)
+    spy_read = mocker.spy(log, "read")
+
+    assert watcher.due()
+    watcher.refresh()
+    assert not watcher.due()
+    assert spy_read.call_count == 1
+
+
+def test_watcher_errors_are_logged(mocker, shared_cache, identities, caplog):
+    log = get_invalidation_log()
+    mocker.patch.object(log, "read", side_effect=ConnectionError("Connection refused"))
+    watcher = InvalidationWatcher(log)
+
+    watcher.refresh()
+
+    assert watcher.generation is None
+    assert identities.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    assert "Cannot read invalidations from shared cache 'identities': Connection refused" in caplog.text
+
+
+def test_middleware_checks_invalidations(shared_cache, fake_resolver):
+    middleware = WindowsAuthTokenMiddleware(lambda request: None)
+    request = RequestFactory().get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware.process_request(request)
+    assert get_identity_cache().get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+    get_invalidation_log().publish("sid", "S-1-5-21-1")
+    get_invalidation_watcher().check_interval = 0
+    get_invalidation_watcher()._next_check = 0
+    middleware.process_request(RequestFactory().get("/"))
+
+    assert get_invalidation_watcher().generation == 1
+    assert get_identity_cache().get("S-1-5-21-1") is None
+
+
+@pytest.mark.asyncio
+async def test_middleware_checks_invalidations_async(shared_cache, fake_resolver):
+    get_identity_cache().set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    watcher = get_invalidation_watcher()
+    watcher.refresh()
+    get_invalidation_log().publish("sid", "S-1-5-21-1")
+    watcher._next_check = 0
+
+    middleware = WindowsAuthTokenMiddleware(lambda request: None)
+    await middleware.aprocess_request(RequestFactory().get("/"))
+
+    assert watcher.generation == 1
+    assert get_identity_cache().get("S-1-5-21-1") is None
+
+
+def test_cache_command_stats(settings, shared_cache, tmp_path, capsys):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = str(tmp_path / "identities.sqlite3")
+    get_invalidation_log().publish("domain", "TESTDOMAIN")
+
+    call_command("windowsauthtoken_cache", "stats")
+
+    out = capsys.readouterr().out
+    assert "Shared cache:          identities" in out
+    assert "Generation:            1" in out
+    assert "Invalidation 1: domain TESTDOMAIN" in out
+    assert "(0 identities)" in out
+
+
+def test_cache_command_lookup(settings, shared_cache, fake_resolver, tmp_path, capsys):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = str(tmp_path / "identities.sqlite3")
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    call_command("windowsauthtoken_cache", "lookup", r"TESTDOMAIN\testuser")
+
+    out = capsys.readouterr().out
+    assert "SID:              S-1-5-21-1" in out
+    assert r"Shared cache:     TESTDOMAIN\testuser" in out
+    assert "Persistent store: not found" in out
+
+
+def test_cache_command_lookup_unknown_account(fake_resolver):
+    with pytest.raises(CommandError, match=r"Cannot look up account 'TESTDOMAIN\\\\nobody'"):
+        call_command("windowsauthtoken_cache", "lookup", r"TESTDOMAIN\nobody")
+
+
+def test_cache_command_invalidate_sid(settings, shared_cache, tmp_path, capsys):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = str(tmp_path / "identities.sqlite3")
+    store = get_persistent_identity_store()
+    store.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+    store.flush()
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    call_command("windowsauthtoken_cache", "invalidate", "--sid", "S-1-5-21-1")
+
+    out = capsys.readouterr().out
+    assert "Deleted 1 identities from the persistent store." in out
+    assert "Published invalidation 1: sid S-1-5-21-1" in out
+    assert shared_cache.get("S-1-5-21-1") is None
+    assert store.get("S-1-5-21-1") is None
+
+
+def test_cache_command_invalidate_domain(shared_cache, capsys):
+    shared_cache.set("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+    call_command("windowsauthtoken_cache", "invalidate", "--domain", "TESTDOMAIN")
+
+    assert "Published invalidation 1: domain TESTDOMAIN" in capsys.readouterr().out
+    assert get_invalidation_log().read()[1] == 1
+    assert shared_cache.get("S-1-5-21-1") is None
+
+
+def test_cache_command_flush(shared_cache, capsys):
+    get_invalidation_log().publish("sid", "S-1-5-21-1")
+
+    call_command("windowsauthtoken_cache", "flush")
+
+    assert "Published invalidation 2: all" in capsys.readouterr().out
+    assert shared_cache.cache.get(GENERATION_KEY) == 2
+
+
+def test_cache_command_without_shared_cache(capsys):
+    call_command("windowsauthtoken_cache", "flush")
+
+    assert "running workers keep their cached identities until they expire" in capsys.readouterr().err
@@ -0,0 +1,182 @@
+import threading
+import time
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from django_windowsauthtoken.metrics import (
+    MetricsCollector,
+    MetricsExporter,
+    PrometheusExporter,
+    RequestTimings,
+    count_outcome,
+    get_metrics,
+    get_metrics_exporter,
+    histogram_quantile,
+    observe_stage,
+    record_identity_source,
+    record_request_timings,
+)
+
+
+def test_collector_counts_outcomes():
+    metrics = MetricsCollector()
+    metrics.count("success")
+    metrics.count("success")
+    metrics.count("no_token")
+
+    outcomes = metrics.snapshot()["outcomes"]
+    assert outcomes == {
+        "no_token": 1,
+        "bypassed": 0,
+        "invalid_token": 0,
+        "lookup_failure": 0,
+        "formatting_error": 0,
+        "success": 2,
+    }
+
+
+def test_collector_histograms():
+    metrics = MetricsCollector(buckets=(0.01, 0.1))
+    metrics.observe("lookup_account_sid", 0.005)
+    metrics.observe("lookup_account_sid", 0.01)
+    metrics.observe("lookup_account_sid", 0.05)
+    metrics.observe("lookup_account_sid", 3.0)
+
+    histogram = metrics.snapshot()["stages"]["lookup_account_sid"]
+    assert histogram["count"] == 4
+    assert histogram["sum"] == pytest.approx(3.065)
+    assert histogram["buckets"] == [(0.01, 2), (0.1, 3), (float("inf"), 4)]
+
+
+def test_collector_empty_snapshot():
+    histogram = MetricsCollector(buckets=(0.01,)).snapshot()["stages"]["header_parse"]
+    assert histogram == {"count": 0, "sum": 0, "buckets": [(0.01, 0), (float("inf"), 0)]}
+
+
+def test_collector_combines_threads():
+    metrics = MetricsCollector()
+
+    def record():
+        for _ in range(1000):
+            metrics.count("success")
+            metrics.observe("format_username", 0.0001)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = metrics.snapshot()
+    assert snapshot["outcomes"]["success"] == 4000
+    assert snapshot["stages"]["format_username"]["count"] == 4000
+
+
+def test_prometheus_exporter():
+    metrics = MetricsCollector(buckets=(0.01,))
+    metrics.count("success")
+    metrics.observe("lookup_account_sid", 0.005)
+
+    output = PrometheusExporter().export(metrics.snapshot())
+
+    assert "# TYPE windowsauthtoken_requests_total counter\n" in output
+    assert 'windowsauthtoken_requests_total{outcome="success"} 1\n' in output
+    assert "# TYPE windowsauthtoken_stage_duration_seconds histogram\n" in output
+    assert 'windowsauthtoken_stage_duration_seconds_bucket{stage="lookup_account_sid",le="0.01"} 1\n' in output
+    assert 'windowsauthtoken_stage_duration_seconds_bucket{stage="lookup_account_sid",le="+Inf"} 1\n' in output
+    assert 'windowsauthtoken_stage_duration_seconds_sum{stage="lookup_account_sid"} 0.005\n' in output
+    assert 'windowsauthtoken_stage_duration_seconds_count{stage="header_parse"} 0\n' in output
+
+
+def test_histogram_quantile():
+    buckets = [(0.01, 50), (0.1, 90), (1.0, 100), (float("inf"), 100)]
+
+    assert histogram_quantile(buckets, 0.5) == 0.01
+    assert histogram_quantile(buckets, 0.7) == pytest.approx(0.055)
+    assert histogram_quantile(buckets, 0.99) == pytest.approx(0.91)
+    assert histogram_quantile(buckets, 0.0) == 0.0
+
+
+def test_histogram_quantile_overflow_bucket():
+    assert histogram_quantile([(0.01, 1), (float("inf"), 10)], 0.9) == 0.01
+
+
+def test_histogram_quantile_empty():
+    assert histogram_quantile([(0.01, 0), (float("inf"), 0)], 0.5) is None
+    assert histogram_quantile([], 0.5) is None
+
+
+def test_base_exporter_not_implemented():
+    with pytest.raises(NotImplementedError):
+        MetricsExporter().export({})
+
+
+def test_metrics_disabled_by_default(mocker):
+    assert get_metrics() is None
+
+    # Recording is a no-op
+    observe_stage("header_parse", 0.0)
+    count_outcome("success")
+
+
+def test_metrics_enabled(settings):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+
+    observe_stage("header_parse", 0.0)
+    count_outcome("success")
+
+    snapshot = get_metrics().snapshot()
+    assert snapshot["outcomes"]["success"] == 1
+    assert snapshot["stages"]["header_parse"]["count"] == 1
+
+
+class CustomExporter(MetricsExporter):
+    def export(self, snapshot):
+        return str(snapshot["outcomes"])
+
+
+def test_get_metrics_exporter(settings):
+    assert isinstance(get_metrics_exporter(), PrometheusExporter)
+
+    settings.WINDOWSAUTHTOKEN_METRICS_EXPORTER = "test_metrics.CustomExporter"
+    assert isinstance(get_metrics_exporter(), CustomExporter)
+
+
+def test_get_metrics_exporter_invalid_path(settings):
+    settings.WINDOWSAUTHTOKEN_METRICS_EXPORTER = "test_metrics.NonexistentExporter"
+
+    with pytest.raises(ImproperlyConfigured, match="Cannot import metrics exporter"):
+        get_metrics_exporter()
+
+
+def test_request_timings_server_timing():
+    timings = RequestTimings()
+    timings.add("header_parse", 0.0001)
+    timings.add("get_token_information", 0.002)
+    timings.add("format_username", 0.0005)
+    timings.source = "cache"
+
+    assert timings.server_timing() == (
+        'windowsauthtoken-token;dur=2.100;desc="Token inspection", '
+        'windowsauthtoken-format;dur=0.500;desc="Formatting", '
+        'windowsauthtoken-source;desc="cache"'
+    )
+
+
+def test_request_timings_empty():
+    assert RequestTimings().server_timing() == ""
+
+
+def test_record_request_timings():
+    with record_request_timings() as timings:
+        observe_stage("lookup_account_sid", time.perf_counter())
+        record_identity_source("lookup")
+    assert "lookup_account_sid" in timings.durations
+    assert timings.source == "lookup"
+
+    # Nothing is recorded outside of the block
+    observe_stage("format_username", time.perf_counter())
+    record_identity_source("cache")
+    assert "format_username" not in timings.durations
+    assert timings.source == "lookup"
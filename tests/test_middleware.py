@@ -1,20 +1,42 @@
+import asyncio
 import logging
 import sys
+import threading
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from asgiref.sync import iscoroutinefunction
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ImproperlyConfigured
-
-from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+from django.http import HttpResponse
+
+from django_windowsauthtoken.cache import (
+    get_identity_cache,
+    get_negative_identity_cache,
+    get_persistent_identity_store,
+)
+from django_windowsauthtoken.handles import get_handle_tracker
+from django_windowsauthtoken.invalidation import get_invalidation_log, get_invalidation_watcher
+from django_windowsauthtoken.metrics import get_metrics
+from django_windowsauthtoken.middleware import (
+    WindowsAuthTokenMiddleware,
+    _refresh_executor,
+    debug_tracing_enabled,
+    parse_token_handle,
+)
+from django_windowsauthtoken.resolvers import ResolverError, get_resolver
 
 
 @pytest.fixture()
 def mock_pywin32(mocker):
     """Fixture to mock pywin32 components used in the middleware."""
-    mock_win32security = mocker.patch("django_windowsauthtoken.middleware.win32security")
-    mock_win32api = mocker.patch("django_windowsauthtoken.middleware.win32api")
-    mock_pywintypes = mocker.patch("django_windowsauthtoken.middleware.pywintypes")
+    # Don't let the lazy import replace the mocks
+    mocker.patch("django_windowsauthtoken.resolvers._pywin32_imported", True)
+    mock_win32security = mocker.patch("django_windowsauthtoken.resolvers.win32security")
+    mock_win32api = mocker.patch("django_windowsauthtoken.resolvers.win32api")
+    mock_pywintypes = mocker.patch("django_windowsauthtoken.resolvers.pywintypes")
     mock_pywintypes.error = Pywin32MockException
 
     # Return a namedtuple for easier access to the mocks
@@ -150,23 +172,29 @@ def test_retrieve_auth_user_details_success(mock_pywin32):
     mock_pywin32.win32api.CloseHandle.assert_called_once()
 
 
-def test_middleware_init_pywin32_error_handling(mocker):
-    mocker.patch("django_windowsauthtoken.middleware._IGNORE_PYWIN32_ERRORS", False)
-    mocker.patch("django_windowsauthtoken.middleware.win32security", None)
-    mocker.patch("django_windowsauthtoken.middleware.pywintypes", None)
-    mocker.patch("django_windowsauthtoken.middleware.win32api", None)
+def test_middleware_init_doesnt_import_pywin32(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("importlib.util.find_spec")
+    mock_import_pywin32 = mocker.patch("django_windowsauthtoken.resolvers.import_pywin32")
+
+    WindowsAuthTokenMiddleware(mocker.Mock())
+    mock_import_pywin32.assert_not_called()
 
-    mock_get_response = mocker.Mock()
-    with pytest.raises(ImproperlyConfigured) as excinfo:
-        WindowsAuthTokenMiddleware(mock_get_response)
-    assert "pywin32 is required for Windows Authentication Token middleware." in str(excinfo.value)
+
+def test_middleware_init_pywin32_missing(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("importlib.util.find_spec", return_value=None)
+
+    with pytest.raises(ImproperlyConfigured, match="pywin32 is required for Windows Authentication Token middleware."):
+        WindowsAuthTokenMiddleware(mocker.Mock())
 
 
 def test_retrieve_auth_user_details_pywin32_error_handling(mocker):
-    mocker.patch("django_windowsauthtoken.middleware._IGNORE_PYWIN32_ERRORS", False)
-    mocker.patch("django_windowsauthtoken.middleware.win32security", None)
-    mocker.patch("django_windowsauthtoken.middleware.pywintypes", None)
-    mocker.patch("django_windowsauthtoken.middleware.win32api", None)
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("django_windowsauthtoken.resolvers._pywin32_imported", True)
+    mocker.patch("django_windowsauthtoken.resolvers.win32security", None)
+    mocker.patch("django_windowsauthtoken.resolvers.pywintypes", None)
+    mocker.patch("django_windowsauthtoken.resolvers.win32api", None)
 
     with pytest.raises(ImproperlyConfigured) as excinfo:
         WindowsAuthTokenMiddleware.retrieve_auth_user_details("123")
@@ -176,7 +204,7 @@ def test_retrieve_auth_user_details_pywin32_error_handling(mocker):
 @pytest.mark.skipif(sys.platform != "win32", reason="Requires Windows platform")
 def test_retrieve_auth_user_details_nonexistent_token(mocker):
     """On Windows, a made up token should result in an actual GetTokenInformation error."""
-    mocker.patch("django_windowsauthtoken.middleware._IGNORE_PYWIN32_ERRORS", False)
+    mocker.patch("django_windowsauthtoken.resolvers._IGNORE_PYWIN32_ERRORS", False)
 
     with pytest.raises(ValueError) as excinfo:
         WindowsAuthTokenMiddleware.retrieve_auth_user_details("123")
@@ -251,7 +279,7 @@ def test_combine_with_remote_user_middleware(mocker, settings, client):
 
 
 @pytest.mark.asyncio
-@pytest.mark.django_db
+@pytest.mark.django_db(transaction=True)
 async def test_combine_with_remote_user_middleware_async(mocker, settings, async_client):
     mocker.patch(
         "django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware.retrieve_auth_user_details",
@@ -271,3 +299,834 @@ async def test_combine_with_remote_user_middleware_async(mocker, settings, async
     user = await User.objects.afirst()
     assert user == response.asgi_request.user
     assert user.get_username() == r"TESTDOMAIN\testuser"
+
+
+def test_retrieve_auth_user_details_cached(mock_pywin32):
+    mock_pywin32.win32security.GetTokenInformation.return_value = ("mocked_sid", 0)
+    mock_pywin32.win32security.ConvertSidToStringSid.return_value = "S-1-5-21-1"
+    mock_pywin32.win32security.LookupAccountSid.return_value = ("testuser", "TESTDOMAIN", 1)
+
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("123") == ("testuser", "TESTDOMAIN")
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("123") == ("testuser", "TESTDOMAIN")
+
+    # The token is inspected and closed for every request, but the account lookup runs only once
+    assert mock_pywin32.win32security.GetTokenInformation.call_count == 2
+    assert mock_pywin32.win32api.CloseHandle.call_count == 2
+    mock_pywin32.win32security.LookupAccountSid.assert_called_once_with(None, "mocked_sid")
+
+
+def test_retrieve_auth_user_details_failed_lookup_not_cached(mock_pywin32):
+    # Failures of the domain controller are not remembered by the negative cache, unlike unknown accounts
+    mock_pywin32.win32security.GetTokenInformation.return_value = ("mocked_sid", 0)
+    mock_pywin32.win32security.ConvertSidToStringSid.return_value = "S-1-5-21-1"
+    mock_pywin32.win32security.LookupAccountSid.side_effect = [
+        Pywin32MockException("Domain controller unavailable"),
+        ("testuser", "TESTDOMAIN", 1),
+    ]
+
+    with pytest.raises(ValueError):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("123")
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("123") == ("testuser", "TESTDOMAIN")
+
+
+@pytest.mark.asyncio
+async def test_middleware_async_sets_remote_user(mocker, rf):
+    mocker.patch(
+        "django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware.retrieve_auth_user_details",
+        return_value=("testuser", "TESTDOMAIN"),
+    )
+
+    mock_get_response = mocker.AsyncMock()
+    middleware = WindowsAuthTokenMiddleware(mock_get_response)
+    assert iscoroutinefunction(middleware)
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "valid_token"})
+    response = await middleware(request)
+
+    assert response == mock_get_response.return_value
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+    assert request.META["HTTP_REMOTE_USER"] == r"TESTDOMAIN\testuser"
+    mock_get_response.assert_awaited_once_with(request)
+
+
+@pytest.mark.asyncio
+async def test_middleware_async_no_token_stays_on_event_loop(mocker, rf):
+    mock_sync_to_async = mocker.patch("django_windowsauthtoken.middleware.sync_to_async")
+
+    mock_get_response = mocker.AsyncMock()
+    middleware = WindowsAuthTokenMiddleware(mock_get_response)
+
+    request = rf.get("/")
+    response = await middleware(request)
+
+    assert response == mock_get_response.return_value
+    assert "REMOTE_USER" not in request.META
+    mock_sync_to_async.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_middleware_async_invalid_token(mocker, rf):
+    mocker.patch(
+        "django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware.retrieve_auth_user_details",
+        side_effect=ValueError("Invalid token"),
+    )
+
+    mock_get_response = mocker.AsyncMock()
+    middleware = WindowsAuthTokenMiddleware(mock_get_response)
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "invalid_token"})
+    await middleware(request)
+
+    assert "REMOTE_USER" not in request.META
+    mock_get_response.assert_awaited_once_with(request)
+
+
+def test_format_username_resolves_formatter_once(mocker):
+    mock_import_string = mocker.patch(
+        "django_windowsauthtoken.middleware.import_string",
+        return_value=custom_formatter,
+    )
+
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+    middleware.format_username("testuser", "TESTDOMAIN")
+    middleware.format_username("testuser", "TESTDOMAIN")
+
+    mock_import_string.assert_called_once()
+
+
+def test_format_username_reloaded_on_setting_changed(mocker, settings):
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+    assert middleware.format_username("testuser", "TESTDOMAIN") == r"TESTDOMAIN\testuser"
+
+    settings.WINDOWSAUTHTOKEN_USERNAME_FORMATTER = "test_middleware.custom_formatter"
+    assert middleware.format_username("testuser", "TESTDOMAIN") == "testuser@TESTDOMAIN.com"
+
+
+def test_format_username_invalid_formatter(mocker):
+    # Patch the settings directly, overriding them would notify middleware instances of other tests
+    mocker.patch(
+        "django_windowsauthtoken.middleware.settings",
+        WINDOWSAUTHTOKEN_USERNAME_FORMATTER="test_middleware.nonexistent_formatter",
+    )
+
+    with pytest.raises(ImproperlyConfigured) as excinfo:
+        WindowsAuthTokenMiddleware(mocker.Mock())
+    assert "Cannot import username formatter 'test_middleware.nonexistent_formatter'" in str(excinfo.value)
+
+
+def test_format_username_pipeline(mocker, settings):
+    settings.WINDOWSAUTHTOKEN_USERNAME_FORMATTER = "django_windowsauthtoken.formatters.format_email_like"
+    settings.WINDOWSAUTHTOKEN_USERNAME_PIPELINE = {
+        "domain_aliases": {"TESTDOMAIN": "test.example.com"},
+        "case": "lower",
+    }
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    assert middleware.format_username("TestUser", "TESTDOMAIN") == "testuser@test.example.com"
+    assert middleware.formatter_id.startswith("django_windowsauthtoken.formatters.format_email_like:")
+
+    settings.WINDOWSAUTHTOKEN_USERNAME_PIPELINE = None
+    assert middleware.format_username("TestUser", "TESTDOMAIN") == "TestUser@TESTDOMAIN"
+    assert middleware.formatter_id == "django_windowsauthtoken.formatters.format_email_like"
+
+
+def test_debug_tracing_enabled(caplog):
+    caplog.set_level(logging.DEBUG, logger="windowsauthtoken")
+    assert debug_tracing_enabled() is True
+
+    caplog.set_level(logging.INFO, logger="windowsauthtoken")
+    assert debug_tracing_enabled() is False
+
+
+def test_debug_tracing_disabled_by_setting(settings, caplog):
+    caplog.set_level(logging.DEBUG, logger="windowsauthtoken")
+    settings.WINDOWSAUTHTOKEN_DEBUG_TRACING = False
+
+    assert debug_tracing_enabled() is False
+
+
+def test_debug_tracing_no_messages_when_disabled(mocker, settings, caplog):
+    caplog.set_level(logging.DEBUG, logger="windowsauthtoken")
+    settings.WINDOWSAUTHTOKEN_DEBUG_TRACING = False
+    mocker.patch(
+        "django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware.retrieve_auth_user_details",
+        return_value=("testuser", "TESTDOMAIN"),
+    )
+
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+    request = mocker.Mock()
+    request.headers = {"X-IIS-WindowsAuthToken": "valid_token"}
+    request.META = {}
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+    assert caplog.records == []
+
+
+def test_retrieve_auth_user_details_close_handle_fails(mock_pywin32, caplog):
+    mock_pywin32.win32security.GetTokenInformation.return_value = ("mocked_sid", 0)
+    mock_pywin32.win32security.LookupAccountSid.return_value = ("testuser", "TESTDOMAIN", 1)
+    mock_pywin32.win32api.CloseHandle.side_effect = Pywin32MockException("The handle is invalid.")
+
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("123") == ("testuser", "TESTDOMAIN")
+    assert "Failed to close token handle: The handle is invalid." in caplog.text
+
+
+def test_retrieve_auth_user_details_coalesces_concurrent_lookups(mocker, settings):
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.FakeTokenResolver"
+    settings.WINDOWSAUTHTOKEN_RESOLVER_OPTIONS = {
+        "tokens": {"1a": "S-1-5-21-1"},
+        "accounts": {"S-1-5-21-1": ("testuser", "TESTDOMAIN")},
+        "lookup_latency": 0.2,
+    }
+    spy = mocker.spy(get_resolver(), "lookup_account_sid")
+    barrier = threading.Barrier(8)
+
+    def retrieve(_):
+        barrier.wait(5)
+        return WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(retrieve, range(8)))
+
+    assert results == [("testuser", "TESTDOMAIN")] * 8
+    assert spy.call_count == 1
+
+
+def test_retrieve_auth_user_details_uses_shared_cache(mocker, fake_resolver, shared_cache):
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+    shared_cache.set("S-1-5-21-2", ("otheruser", "OTHERDOMAIN"))
+
+    # A SID that is unknown to the resolver is found in the shared cache
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("2b") == ("otheruser", "OTHERDOMAIN")
+    assert spy.call_count == 0
+    assert get_identity_cache().get("S-1-5-21-2") == ("otheruser", "OTHERDOMAIN")
+
+
+def test_retrieve_auth_user_details_fills_shared_cache(mocker, fake_resolver, shared_cache):
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+    assert shared_cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+
+def test_retrieve_auth_user_details_invalid_token_skips_shared_cache(mocker, fake_resolver, shared_cache):
+    spy = mocker.spy(shared_cache.cache, "get_many")
+
+    with pytest.raises(ValueError):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("3c")
+    assert spy.call_count == 0
+
+
+@pytest.mark.parametrize("auth_token", ["1a", "1A", "0x1a", "ffffffffffffffff"])
+def test_parse_token_handle_valid(auth_token):
+    assert parse_token_handle(auth_token) == int(auth_token, 16)
+
+
+@pytest.mark.parametrize("auth_token", [" 1a", "1a\n", "-1a", "+1a", "1_a", "0x", "0", "00", "10000000000000000"])
+def test_parse_token_handle_invalid(auth_token):
+    with pytest.raises(ValueError, match="Invalid token format."):
+        parse_token_handle(auth_token)
+
+
+def test_retrieve_auth_user_details_malformed_token_skips_resolver(mocker, fake_resolver):
+    spy = mocker.spy(fake_resolver, "get_token_user")
+
+    with pytest.raises(ValueError, match="Invalid token format."):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("-1a")
+    assert spy.call_count == 0
+
+
+def test_retrieve_auth_user_details_negative_cache(mocker, fake_resolver):
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    with pytest.raises(ValueError, match="No mapping between account names and security IDs was done."):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("2b")
+    with pytest.raises(ValueError, match=r"No mapping between account names and security IDs was done. \(cached\)"):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("2b")
+
+    assert spy.call_count == 1
+    assert get_negative_identity_cache().ttl == 30
+
+
+def test_retrieve_auth_user_details_negative_cache_expires(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL = 0
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            WindowsAuthTokenMiddleware.retrieve_auth_user_details("2b")
+    assert spy.call_count == 2
+
+
+@pytest.mark.django_db
+def test_session_pinning_skips_account_lookup(mocker, settings, client, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    spy_token = mocker.spy(fake_resolver, "get_token_user")
+    spy_lookup = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    response = client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    assert response.wsgi_request.user.get_username() == r"TESTDOMAIN\testuser"
+    assert client.session[WindowsAuthTokenMiddleware.session_key] == {
+        "sid": "S-1-5-21-1",
+        "user": "testuser",
+        "domain": "TESTDOMAIN",
+        "remote_user": r"TESTDOMAIN\testuser",
+        "formatter": "django_windowsauthtoken.formatters.format_domain_user",
+        "pinned_at": mocker.ANY,
+        "generation": None,
+    }
+
+    # Even without the identity cache, the pinned identity is reused
+    get_identity_cache().clear()
+    response = client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    assert response.wsgi_request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+    assert response.wsgi_request.user.get_username() == r"TESTDOMAIN\testuser"
+
+    assert spy_token.call_count == 2
+    assert spy_lookup.call_count == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_session_pinning_async(mocker, settings, async_client, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    spy_lookup = mocker.spy(fake_resolver, "lookup_account_sid")
+
+    for _ in range(2):
+        get_identity_cache().clear()
+        response = await async_client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+        assert response.asgi_request.META["HTTP_REMOTE_USER"] == r"TESTDOMAIN\testuser"
+
+    assert spy_lookup.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_session_pinning_async_runs_resolver_concurrently(mocker, settings, async_rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    get_token_user = fake_resolver.get_token_user
+    lock = threading.Lock()
+    running = 0
+    overlapped = threading.Event()
+
+    def inspect_token(token_handle):
+        nonlocal running
+        with lock:
+            running += 1
+            if running > 1:
+                overlapped.set()
+        try:
+            # Serialized through the thread for database access, the first inspection would wait in vain
+            overlapped.wait(timeout=5)
+            return get_token_user(token_handle)
+        finally:
+            with lock:
+                running -= 1
+
+    mocker.patch.object(fake_resolver, "get_token_user", side_effect=inspect_token)
+
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    requests = []
+    for _ in range(10):
+        request = async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+        request.session = {}
+        requests.append(request)
+
+    await asyncio.gather(*(middleware(request) for request in requests))
+
+    assert overlapped.is_set()
+    assert all(request.META["HTTP_REMOTE_USER"] == r"TESTDOMAIN\testuser" for request in requests)
+
+
+def test_session_pinning_other_sid(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    fake_resolver.accounts["S-1-5-21-2"] = ("otheruser", "TESTDOMAIN")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "2b"})
+    request.session = {
+        WindowsAuthTokenMiddleware.session_key: {
+            "sid": "S-1-5-21-1",
+            "user": "testuser",
+            "domain": "TESTDOMAIN",
+            "remote_user": r"TESTDOMAIN\testuser",
+            "formatter": "django_windowsauthtoken.formatters.format_domain_user",
+        }
+    }
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\otheruser"
+    assert request.session[WindowsAuthTokenMiddleware.session_key]["sid"] == "S-1-5-21-2"
+
+
+def test_session_pinning_expires(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    settings.WINDOWSAUTHTOKEN_CACHE_TTL = 60
+    fake_resolver.accounts["S-1-5-21-1"] = ("renamed", "TESTDOMAIN")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    request.session = {
+        WindowsAuthTokenMiddleware.session_key: {
+            "sid": "S-1-5-21-1",
+            "user": "testuser",
+            "domain": "TESTDOMAIN",
+            "remote_user": r"TESTDOMAIN\testuser",
+            "formatter": "django_windowsauthtoken.formatters.format_domain_user",
+            "pinned_at": time.time() - 61,
+            "generation": None,
+        }
+    }
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\renamed"
+    assert request.session[WindowsAuthTokenMiddleware.session_key]["pinned_at"] > time.time() - 1
+
+
+def test_session_pinning_invalidated(mocker, settings, rf, shared_cache, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+    session = {}
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    request.session = session
+    middleware(request)
+    assert session[WindowsAuthTokenMiddleware.session_key]["generation"] == 0
+
+    fake_resolver.accounts["S-1-5-21-1"] = ("renamed", "TESTDOMAIN")
+    get_invalidation_log().publish("all")
+    get_invalidation_watcher()._next_check = 0
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    request.session = session
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\renamed"
+    assert session[WindowsAuthTokenMiddleware.session_key]["generation"] == 1
+
+
+def test_session_pinning_other_formatter(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    settings.WINDOWSAUTHTOKEN_USERNAME_FORMATTER = "django_windowsauthtoken.formatters.format_email_like"
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    request.session = {
+        WindowsAuthTokenMiddleware.session_key: {
+            "sid": "S-1-5-21-1",
+            "user": "testuser",
+            "domain": "TESTDOMAIN",
+            "remote_user": r"TESTDOMAIN\testuser",
+            "formatter": "django_windowsauthtoken.formatters.format_domain_user",
+        }
+    }
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == "testuser@TESTDOMAIN"
+
+
+def test_session_pinning_other_pipeline(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    settings.WINDOWSAUTHTOKEN_USERNAME_PIPELINE = {"case": "upper"}
+    spy_lookup = mocker.spy(fake_resolver, "lookup_account_sid")
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    request.session = {
+        WindowsAuthTokenMiddleware.session_key: {
+            "sid": "S-1-5-21-1",
+            "user": "testuser",
+            "domain": "TESTDOMAIN",
+            "remote_user": r"TESTDOMAIN\testuser",
+            "formatter": "django_windowsauthtoken.formatters.format_domain_user",
+        }
+    }
+
+    WindowsAuthTokenMiddleware(mocker.Mock())(request)
+
+    # The identity was pinned without the pipeline, so it is looked up and formatted again
+    assert spy_lookup.call_count == 1
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\TESTUSER"
+
+
+@pytest.mark.parametrize("auth_token", ["-1a", "3c", "2b"])
+def test_session_pinning_invalid_token(mocker, settings, rf, caplog, fake_resolver, auth_token):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": auth_token})
+    request.session = {}
+    middleware(request)
+
+    assert "REMOTE_USER" not in request.META
+    assert request.session == {}
+    assert "Cannot retrieve username from auth token" in caplog.text
+
+
+def test_session_pinning_without_session(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = True
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+
+
+@pytest.mark.parametrize(
+    "auth_token,outcome",
+    [
+        (None, "no_token"),
+        ("-1a", "invalid_token"),
+        ("3c", "invalid_token"),
+        ("2b", "lookup_failure"),
+        ("1a", "success"),
+    ],
+)
+@pytest.mark.parametrize("session_pinning", [False, True])
+def test_metrics_outcomes(mocker, settings, rf, fake_resolver, auth_token, outcome, session_pinning):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    settings.WINDOWSAUTHTOKEN_SESSION_PINNING = session_pinning
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": auth_token} if auth_token else {})
+    request.session = {}
+    middleware(request)
+
+    outcomes = get_metrics().snapshot()["outcomes"]
+    assert outcomes[outcome] == 1
+    assert sum(outcomes.values()) == 1
+
+
+def test_metrics_formatting_error(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    fake_resolver.accounts["S-1-5-21-2"] = ("testuser", "")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "2b"}))
+
+    assert get_metrics().snapshot()["outcomes"]["formatting_error"] == 1
+
+
+def test_metrics_stages(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    for _ in range(2):
+        middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    stages = get_metrics().snapshot()["stages"]
+    assert stages["header_parse"]["count"] == 2
+    assert stages["get_token_information"]["count"] == 2
+    assert stages["close_handle"]["count"] == 2
+    # The second request uses the identity cache
+    assert stages["lookup_account_sid"]["count"] == 1
+    assert stages["format_username"]["count"] == 2
+
+
+def test_server_timing(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SERVER_TIMING = True
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    response = middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    entries = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+    assert entries == [
+        "windowsauthtoken-token",
+        "windowsauthtoken-lookup",
+        "windowsauthtoken-format",
+        "windowsauthtoken-source",
+    ]
+    assert response["Server-Timing"].endswith('windowsauthtoken-source;desc="lookup"')
+
+    # The second request uses the identity cache, so no lookup is timed
+    response = middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert "windowsauthtoken-lookup" not in response["Server-Timing"]
+    assert response["Server-Timing"].endswith('windowsauthtoken-source;desc="cache"')
+
+
+def test_server_timing_keeps_existing_header(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SERVER_TIMING = True
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse(headers={"Server-Timing": "db;dur=1.5"}))
+
+    response = middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert response["Server-Timing"].startswith("db;dur=1.5, windowsauthtoken-token;dur=")
+
+
+@pytest.mark.parametrize("server_timing", [False, True])
+def test_server_timing_no_token(mocker, settings, rf, server_timing):
+    settings.WINDOWSAUTHTOKEN_SERVER_TIMING = server_timing
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    response = middleware(rf.get("/"))
+    assert not response.has_header("Server-Timing")
+
+
+def test_server_timing_disabled(mocker, rf, fake_resolver):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    response = middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert not response.has_header("Server-Timing")
+
+
+@pytest.mark.asyncio
+async def test_server_timing_async(mocker, settings, async_rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_SERVER_TIMING = True
+
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+
+    response = await middleware(async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert "windowsauthtoken-lookup;dur=" in response["Server-Timing"]
+    assert response["Server-Timing"].endswith('windowsauthtoken-source;desc="lookup"')
+
+
+def test_persistent_store(mocker, settings, rf, tmp_path, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = tmp_path / "identities.sqlite3"
+    spy = mocker.spy(fake_resolver, "lookup_account_sid")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    get_persistent_identity_store().flush()
+
+    # After a restart, the identity is loaded from the store when the middleware is created
+    get_identity_cache.cache_clear()
+    get_persistent_identity_store.cache_clear()
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+    assert get_identity_cache().get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+    assert spy.call_count == 1
+
+
+def test_stale_while_revalidate(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_STALE_TTL = 3600
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+
+    # The domain controller becomes slow, and the cached identity expires
+    fake_resolver.accounts["S-1-5-21-1"] = ("renameduser", "TESTDOMAIN")
+    lookup_started = threading.Event()
+    lookup_allowed = threading.Event()
+    lookup_account_sid = fake_resolver.lookup_account_sid
+
+    def slow_lookup_account_sid(security_id):
+        lookup_started.set()
+        lookup_allowed.wait(timeout=5)
+        return lookup_account_sid(security_id)
+
+    mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=slow_lookup_account_sid)
+    mock_monotonic.return_value = 500.0
+
+    # The stale identity is served without waiting for the lookup, which is only done once
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+    assert lookup_started.wait(timeout=5)
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+
+    lookup_allowed.set()
+    _refresh_executor.submit(lambda: None).result(timeout=5)
+    for _ in range(100):
+        if get_identity_cache().get("S-1-5-21-1") is not None:
+            break
+        time.sleep(0.01)
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("renameduser", "TESTDOMAIN")
+    assert fake_resolver.lookup_account_sid.call_count == 1
+
+
+def test_stale_while_revalidate_refresh_fails(mocker, settings, caplog, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_STALE_TTL = 3600
+    mock_monotonic = mocker.patch("django_windowsauthtoken.cache.time.monotonic", return_value=100.0)
+    WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a")
+
+    mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=ResolverError("Simulated failure."))
+    mock_monotonic.return_value = 500.0
+    mocker.patch(
+        "django_windowsauthtoken.middleware._refresh_executor.submit", side_effect=lambda func, *args: func(*args)
+    )
+
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+    assert "Cannot refresh account details for SID: sid_string='S-1-5-21-1' error=Simulated failure." in caplog.text
+    # The failed refresh doesn't prevent the stale identity from being served
+    assert get_negative_identity_cache().get("S-1-5-21-1") is None
+    assert WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a") == ("testuser", "TESTDOMAIN")
+
+
+def test_circuit_breaker(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD = 2
+    settings.WINDOWSAUTHTOKEN_NEGATIVE_CACHE_TTL = 0
+    spy = mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=ResolverError("Simulated failure."))
+
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a")
+    assert spy.call_count == 2
+
+    with pytest.raises(ValueError, match="Account lookups are suspended after repeated failures."):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a")
+
+
+def test_circuit_breaker_open_is_not_cached(mocker, settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD = 1
+    mocker.patch.object(fake_resolver, "lookup_account_sid", side_effect=ResolverError("Simulated failure."))
+    with pytest.raises(ValueError):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("1a")
+
+    with pytest.raises(ValueError, match="suspended"):
+        WindowsAuthTokenMiddleware.retrieve_auth_user_details("2b")
+    assert get_negative_identity_cache().get("S-1-5-21-2") is None
+
+
+@pytest.mark.parametrize(
+    "path,bypassed",
+    [("/static/css/site.css", True), ("/metrics/", True), ("/debug/", False), ("/", False)],
+)
+def test_bypass(mocker, settings, rf, fake_resolver, path, bypassed):
+    settings.WINDOWSAUTHTOKEN_BYPASS_PATHS = ["/static/", "/media/"]
+    settings.WINDOWSAUTHTOKEN_BYPASS_URL_NAMES = ["metrics"]
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    spy_token = mocker.spy(fake_resolver, "get_token_user")
+    spy_close = mocker.spy(fake_resolver, "close_handle")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get(path, headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+
+    assert ("REMOTE_USER" not in request.META) is bypassed
+    assert spy_token.call_count == (0 if bypassed else 1)
+    # The token handle is closed in any case
+    spy_close.assert_called_once_with(0x1A)
+    assert get_metrics().snapshot()["outcomes"]["bypassed"] == (1 if bypassed else 0)
+
+
+def test_bypass_malformed_token(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_BYPASS_PATHS = ["/static/"]
+    spy_close = mocker.spy(fake_resolver, "close_handle")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    middleware(rf.get("/static/site.css", headers={"X-IIS-WindowsAuthToken": "-1a"}))
+
+    assert spy_close.call_count == 0
+
+
+def test_bypass_unknown_url(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_BYPASS_URL_NAMES = ["metrics"]
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/unknown/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+
+
+@pytest.mark.asyncio
+async def test_bypass_async(mocker, settings, async_rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_BYPASS_PATHS = ["/static/"]
+    spy_close = mocker.spy(fake_resolver, "close_handle")
+
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    request = async_rf.get("/static/site.css", headers={"X-IIS-WindowsAuthToken": "1a"})
+    await middleware(request)
+
+    assert "REMOTE_USER" not in request.META
+    spy_close.assert_called_once_with(0x1A)
+
+
+def test_middleware_sets_sid(mocker, settings, rf, fake_resolver):
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+    assert request.META["WINDOWSAUTHTOKEN_SID"] == "S-1-5-21-1"
+
+    # Also when the identity comes from the cache
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+    assert request.META["WINDOWSAUTHTOKEN_SID"] == "S-1-5-21-1"
+
+
+@pytest.mark.asyncio
+async def test_middleware_sets_sid_async(mocker, settings, async_rf, fake_resolver):
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    request = async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    await middleware(request)
+
+    assert request.META["WINDOWSAUTHTOKEN_SID"] == "S-1-5-21-1"
+
+
+@pytest.fixture()
+def token_groups(settings, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_GROUPS = True
+    fake_resolver.groups[0x1A] = ["S-1-5-21-513", "S-1-1-0"]
+    fake_resolver.accounts["S-1-5-21-513"] = ("Domain Users", "TESTDOMAIN")
+    fake_resolver.accounts["S-1-1-0"] = ("Everyone", "")
+
+
+def test_middleware_sets_groups(mocker, rf, token_groups):
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+
+    assert request.windowsauthtoken_groups == frozenset([r"TESTDOMAIN\Domain Users", "Everyone"])
+    assert request.META["REMOTE_USER"] == r"TESTDOMAIN\testuser"
+
+
+def test_middleware_groups_disabled(mocker, rf, fake_resolver):
+    spy = mocker.spy(fake_resolver, "get_token_groups")
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    request = rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    middleware(request)
+
+    assert spy.call_count == 0
+    assert not hasattr(request, "windowsauthtoken_groups")
+
+
+@pytest.mark.asyncio
+async def test_middleware_sets_groups_async(mocker, async_rf, token_groups):
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    request = async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    await middleware(request)
+
+    assert request.windowsauthtoken_groups == frozenset([r"TESTDOMAIN\Domain Users", "Everyone"])
+
+
+@pytest.mark.django_db
+def test_middleware_syncs_groups_on_login(settings, client, token_groups):
+    settings.WINDOWSAUTHTOKEN_GROUP_MAPPING = {r"TESTDOMAIN\Domain Users": "staff"}
+
+    client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+
+    user = get_user_model().objects.get(username=r"TESTDOMAIN\testuser")
+    assert list(user.groups.values_list("name", flat=True)) == ["staff"]
+
+
+def test_middleware_tracks_handles(mocker, settings, rf, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_HANDLE_TRACKING = True
+    settings.WINDOWSAUTHTOKEN_BYPASS_PATHS = ["/static/"]
+    middleware = WindowsAuthTokenMiddleware(mocker.Mock())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "3c"}))
+    middleware(rf.get("/static/site.css", headers={"X-IIS-WindowsAuthToken": "2b"}))
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "-1a"}))
+
+    mocker.patch.object(fake_resolver, "close_handle", side_effect=ResolverError("The handle is invalid."))
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    snapshot = get_handle_tracker().snapshot()
+    # Malformed tokens have no handle to track
+    assert snapshot["opened"] == 4
+    assert snapshot["closed"] == 3
+    assert snapshot["close_failures"] == 1
+    assert snapshot["in_flight"] == 0
@@ -0,0 +1,253 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+
+from django_windowsauthtoken.resolvers import (
+    BaseTokenResolver,
+    CircuitBreaker,
+    FakeTokenResolver,
+    Pywin32Resolver,
+    ResolverError,
+    get_circuit_breaker,
+    get_resolver,
+)
+
+FAKE_RESOLVER_OPTIONS = {
+    "tokens": {"1a": "S-1-5-21-1", "2B": "S-1-5-21-2"},
+    "accounts": {"S-1-5-21-1": ("testuser", "TESTDOMAIN")},
+}
+
+
+class Pywin32MockException(Exception):
+    """Mock exception to simulate pywin32 errors."""
+
+    pass
+
+
+@pytest.fixture()
+def mock_win32security(mocker):
+    # Don't let the lazy import replace the mocks
+    mocker.patch("django_windowsauthtoken.resolvers._pywin32_imported", True)
+    mocker.patch("django_windowsauthtoken.resolvers.pywintypes").error = Pywin32MockException
+    return mocker.patch("django_windowsauthtoken.resolvers.win32security")
+
+
+def test_base_resolver_not_implemented():
+    resolver = BaseTokenResolver()
+    with pytest.raises(NotImplementedError):
+        resolver.get_token_user(1)
+    with pytest.raises(NotImplementedError):
+        resolver.get_token_groups(1)
+    with pytest.raises(NotImplementedError):
+        resolver.close_handle(1)
+    with pytest.raises(NotImplementedError):
+        resolver.sid_to_string("S-1-5-21-1")
+    with pytest.raises(NotImplementedError):
+        resolver.lookup_account_sid("S-1-5-21-1")
+    with pytest.raises(NotImplementedError):
+        resolver.lookup_account_name("TESTDOMAIN\\testuser")
+
+
+def test_pywin32_resolver_translates_errors(mock_win32security):
+    mock_win32security.GetTokenInformation.side_effect = Pywin32MockException("The handle is invalid.")
+    mock_win32security.ConvertSidToStringSid.side_effect = TypeError("Invalid SID object")
+    mock_win32security.LookupAccountSid.side_effect = Pywin32MockException("No mapping")
+    mock_win32security.LookupAccountName.side_effect = Pywin32MockException("No mapping")
+
+    resolver = Pywin32Resolver()
+    with pytest.raises(ResolverError, match="The handle is invalid."):
+        resolver.get_token_user(291)
+    with pytest.raises(ResolverError, match="Invalid SID object"):
+        resolver.sid_to_string("mocked_sid")
+    with pytest.raises(ResolverError, match="No mapping"):
+        resolver.lookup_account_sid("mocked_sid")
+    with pytest.raises(ResolverError, match="No mapping"):
+        resolver.lookup_account_name("TESTDOMAIN\\testuser")
+
+
+def test_pywin32_resolver_token_groups(mock_win32security):
+    mock_win32security.GetTokenInformation.return_value = [
+        ("enabled_sid", 0x7),
+        ("disabled_sid", 0x0),
+        ("logon_sid", 0xC0000007),
+    ]
+
+    assert Pywin32Resolver().get_token_groups(291) == ["enabled_sid"]
+
+
+def test_pywin32_resolver_error_code(mock_win32security):
+    error = Pywin32MockException("No mapping")
+    error.winerror = 1332
+    mock_win32security.LookupAccountSid.side_effect = error
+
+    with pytest.raises(ResolverError) as excinfo:
+        Pywin32Resolver().lookup_account_sid("mocked_sid")
+    assert excinfo.value.winerror == 1332
+
+
+def test_pywin32_resolver_close_handle_error(mocker):
+    mocker.patch("django_windowsauthtoken.resolvers._pywin32_imported", True)
+    mocker.patch("django_windowsauthtoken.resolvers.pywintypes").error = Pywin32MockException
+    mock_win32api = mocker.patch("django_windowsauthtoken.resolvers.win32api")
+    mock_win32api.CloseHandle.side_effect = Pywin32MockException("The handle is invalid.")
+
+    with pytest.raises(ResolverError, match="The handle is invalid."):
+        Pywin32Resolver().close_handle(291)
+
+
+def test_fake_resolver_resolves_tokens():
+    resolver = FakeTokenResolver(**FAKE_RESOLVER_OPTIONS)
+
+    security_id = resolver.get_token_user(0x1A)
+    assert security_id == "S-1-5-21-1"
+    assert resolver.sid_to_string(security_id) == "S-1-5-21-1"
+    assert resolver.lookup_account_sid(security_id) == ("testuser", "TESTDOMAIN", 1)
+    assert resolver.close_handle(0x1A) is None
+    assert resolver.lookup_account_name("TESTDOMAIN\\testuser") == ("S-1-5-21-1", "TESTDOMAIN", 1)
+
+
+def test_fake_resolver_token_groups():
+    resolver = FakeTokenResolver(**FAKE_RESOLVER_OPTIONS, groups={"1a": ["S-1-5-32-545"]})
+
+    assert resolver.get_token_groups(0x1A) == ["S-1-5-32-545"]
+    assert resolver.get_token_groups(0x2B) == []
+    with pytest.raises(ResolverError, match="The handle is invalid."):
+        resolver.get_token_groups(0x3C)
+
+
+def test_fake_resolver_unknown_values():
+    resolver = FakeTokenResolver(**FAKE_RESOLVER_OPTIONS)
+
+    with pytest.raises(ResolverError, match="The handle is invalid."):
+        resolver.get_token_user(0x3C)
+    with pytest.raises(ResolverError, match="No mapping between account names and security IDs"):
+        resolver.lookup_account_sid(resolver.get_token_user(0x2B))
+    with pytest.raises(ResolverError, match="Invalid SID object"):
+        resolver.sid_to_string(None)
+    with pytest.raises(ResolverError, match="No mapping between account names and security IDs"):
+        resolver.lookup_account_name("OTHERDOMAIN\\testuser")
+
+
+def test_fake_resolver_latency(mocker):
+    mock_sleep = mocker.patch("django_windowsauthtoken.resolvers.time.sleep")
+    resolver = FakeTokenResolver(**FAKE_RESOLVER_OPTIONS, token_latency=0.001, lookup_latency=0.05)
+
+    resolver.lookup_account_sid(resolver.get_token_user(0x1A))
+
+    assert mock_sleep.call_args_list == [mocker.call(0.001), mocker.call(0.05)]
+
+
+def test_fake_resolver_failure_rate_is_reproducible():
+    def run(resolver):
+        outcomes = []
+        for _ in range(50):
+            try:
+                resolver.lookup_account_sid("S-1-5-21-1")
+                outcomes.append(True)
+            except ResolverError:
+                outcomes.append(False)
+        return outcomes
+
+    first = run(FakeTokenResolver(**FAKE_RESOLVER_OPTIONS, failure_rate=0.5, seed=42))
+    second = run(FakeTokenResolver(**FAKE_RESOLVER_OPTIONS, failure_rate=0.5, seed=42))
+
+    assert first == second
+    assert True in first and False in first
+
+
+def test_get_resolver_default():
+    assert isinstance(get_resolver(), Pywin32Resolver)
+
+
+def test_get_resolver_from_settings(settings):
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.FakeTokenResolver"
+    settings.WINDOWSAUTHTOKEN_RESOLVER_OPTIONS = FAKE_RESOLVER_OPTIONS
+
+    resolver = get_resolver()
+    assert isinstance(resolver, FakeTokenResolver)
+    assert resolver.tokens == {0x1A: "S-1-5-21-1", 0x2B: "S-1-5-21-2"}
+    assert get_resolver() is resolver
+
+
+def test_get_resolver_invalid_path(settings):
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.NonexistentResolver"
+
+    with pytest.raises(ImproperlyConfigured, match="Cannot import token resolver"):
+        get_resolver()
+
+
+@pytest.mark.django_db
+def test_fake_resolver_full_middleware_stack(settings, client):
+    settings.WINDOWSAUTHTOKEN_RESOLVER = "django_windowsauthtoken.resolvers.FakeTokenResolver"
+    settings.WINDOWSAUTHTOKEN_RESOLVER_OPTIONS = FAKE_RESOLVER_OPTIONS
+
+    response = client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    assert response.wsgi_request.user.get_username() == r"TESTDOMAIN\testuser"
+
+    response = client.get("/", headers={"X-IIS-WindowsAuthToken": "2b"})
+    assert "REMOTE_USER" not in response.wsgi_request.META
+
+
+def test_circuit_breaker_opens_after_failures(mocker):
+    mock_monotonic = mocker.patch("django_windowsauthtoken.resolvers.time.monotonic", return_value=100.0)
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+
+    breaker.record_failure(ResolverError("The RPC server is unavailable."))
+    assert breaker.allow()
+    breaker.record_failure(ResolverError("The RPC server is unavailable."))
+    assert breaker.is_open
+    assert not breaker.allow()
+
+    # After the cool-down, a single trial call is allowed
+    mock_monotonic.return_value = 130.0
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A failing trial call keeps the breaker open for another cool-down
+    breaker.record_failure(ResolverError("The RPC server is unavailable."))
+    mock_monotonic.return_value = 159.0
+    assert not breaker.allow()
+
+    # A successful trial call closes the breaker
+    mock_monotonic.return_value = 160.0
+    assert breaker.allow()
+    breaker.record_success(0.01)
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.failures == 0
+
+
+def test_circuit_breaker_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2)
+
+    breaker.record_failure(ResolverError("The RPC server is unavailable."))
+    breaker.record_success(0.01)
+    breaker.record_failure(ResolverError("The RPC server is unavailable."))
+
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_slow_calls_are_failures():
+    breaker = CircuitBreaker(threshold=2, slow_call=1.0)
+
+    breaker.record_success(0.5)
+    breaker.record_success(1.5)
+    breaker.record_success(2.5)
+
+    assert breaker.is_open
+
+
+def test_circuit_breaker_unknown_accounts_are_successes():
+    breaker = CircuitBreaker(threshold=1)
+
+    breaker.record_failure(ResolverError("No mapping", winerror=1332))
+
+    assert not breaker.is_open
+
+
+def test_get_circuit_breaker(settings):
+    assert get_circuit_breaker() is None
+
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD = 5
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_COOLDOWN = 10
+    breaker = get_circuit_breaker()
+    assert (breaker.threshold, breaker.cooldown, breaker.slow_call) == (5, 10, None)
@@ -0,0 +1,233 @@
+import threading
+
+import pytest
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+
+from django_windowsauthtoken import middleware as middleware_module
+from django_windowsauthtoken.cache import get_persistent_identity_store
+from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+from django_windowsauthtoken.replay import build_resolver_options, replay_trace
+from django_windowsauthtoken.resolvers import get_resolver
+from django_windowsauthtoken.trace import TraceEntry, TraceRecorder, get_trace_recorder, hash_sid, read_trace
+
+
+@pytest.fixture()
+def resolver_options():
+    return {
+        "tokens": {"1a": "S-1-5-21-1", "2b": "S-1-5-21-2", "3c": "S-1-5-21-3"},
+        "accounts": {"S-1-5-21-1": ("testuser", "TESTDOMAIN"), "S-1-5-21-3": ("nodomain", "")},
+    }
+
+
+@pytest.fixture()
+def trace_file(tmp_path):
+    return tmp_path / "trace.csv"
+
+
+def entry(timestamp, sid="", outcome="success", token=True):
+    return TraceEntry(timestamp=timestamp, token=token, sid=sid, outcome=outcome, duration=0.001)
+
+
+def test_hash_sid():
+    assert hash_sid("S-1-5-21-1") == hash_sid("S-1-5-21-1")
+    assert hash_sid("S-1-5-21-1") != hash_sid("S-1-5-21-2")
+    assert len(hash_sid("S-1-5-21-1")) == 16
+    assert "S-1-5-21-1" not in hash_sid("S-1-5-21-1")
+
+
+def test_trace_recorder_round_trip(trace_file):
+    recorder = TraceRecorder(str(trace_file), flush_size=2)
+    recorder.write(entry(2.5, sid="abc"))
+    assert not trace_file.exists()
+    recorder.write(entry(1.5, outcome="no_token", token=False))
+    recorder.write(entry(3.5, outcome=None))
+    recorder.flush()
+    recorder.flush()
+
+    lines = trace_file.read_text().splitlines()
+    assert lines[0] == "timestamp,token,sid,outcome,duration"
+    assert len(lines) == 4
+
+    entries = read_trace(str(trace_file))
+    assert [(e.timestamp, e.token, e.sid, e.outcome) for e in entries] == [
+        (1.5, False, "", "no_token"),
+        (2.5, True, "abc", "success"),
+        (3.5, True, "", None),
+    ]
+
+
+def test_trace_recorder_writes_behind(trace_file):
+    recorder = TraceRecorder(str(trace_file), flush_size=2)
+    flush = recorder.flush
+    flush_threads = []
+
+    def record_flush():
+        flush_threads.append(threading.current_thread())
+        flush()
+
+    recorder.flush = record_flush
+    recorder.write(entry(1.5))
+    recorder.write(entry(2.5))
+    for thread in threading.enumerate():
+        if thread.name == "windowsauthtoken-trace":
+            thread.join()
+
+    assert len(read_trace(str(trace_file))) == 2
+    assert flush_threads and threading.current_thread() not in flush_threads
+
+
+def test_trace_recording_disabled_by_default():
+    assert get_trace_recorder() is None
+
+
+def test_middleware_records_trace(mocker, settings, rf, fake_resolver, trace_file):
+    settings.WINDOWSAUTHTOKEN_TRACE_FILE = trace_file
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    for token in ("1a", "1a", "2b", "-1a", "3c", None):
+        headers = {"X-IIS-WindowsAuthToken": token} if token else {}
+        middleware(rf.get("/", headers=headers))
+    get_trace_recorder().flush()
+
+    entries = read_trace(str(trace_file))
+    assert [entry.outcome for entry in entries] == [
+        "success",
+        "success",
+        "lookup_failure",
+        "invalid_token",
+        "formatting_error",
+        "no_token",
+    ]
+    assert [entry.token for entry in entries] == [True] * 5 + [False]
+    assert entries[0].sid == entries[1].sid == hash_sid("S-1-5-21-1")
+    assert entries[3].sid == ""
+    assert all(entry.duration > 0 for entry in entries)
+    assert "testuser" not in trace_file.read_text()
+
+
+@pytest.mark.asyncio
+async def test_middleware_records_trace_async(mocker, settings, async_rf, fake_resolver, trace_file):
+    settings.WINDOWSAUTHTOKEN_TRACE_FILE = trace_file
+
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    await middleware(async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    get_trace_recorder().flush()
+
+    (recorded,) = read_trace(str(trace_file))
+    assert recorded.outcome == "success"
+    assert recorded.sid == hash_sid("S-1-5-21-1")
+
+
+def test_build_resolver_options():
+    options, handles = build_resolver_options(
+        [
+            entry(1, sid="aaa", outcome="lookup_failure"),
+            entry(2, sid="aaa"),
+            entry(3, sid="bbb", outcome="formatting_error"),
+            entry(4, sid="ccc", outcome="lookup_failure"),
+        ]
+    )
+
+    assert handles == {"aaa": "1", "bbb": "2", "ccc": "3"}
+    assert options["tokens"] == {"1": "S-1-5-21-1", "2": "S-1-5-21-2", "3": "S-1-5-21-3"}
+    assert options["accounts"] == {"S-1-5-21-1": ("user1", "REPLAY"), "S-1-5-21-2": ("user2", "")}
+
+
+TRACE = [
+    entry(100.0, sid="aaa"),
+    entry(100.01, outcome="no_token", token=False),
+    entry(100.02, sid="aaa"),
+    entry(100.03, sid="bbb", outcome="lookup_failure"),
+    entry(100.04, outcome="invalid_token"),
+    entry(100.05, sid="ccc", outcome="formatting_error"),
+    entry(100.06, outcome="bypassed"),
+]
+
+
+@pytest.mark.parametrize("mode", ["threads", "asyncio"])
+def test_replay_trace(mode):
+    report = replay_trace(TRACE, speed=10, workers=2, mode=mode)
+
+    assert report.requests == 7
+    assert report.outcomes == {
+        "no_token": 1,
+        "bypassed": 1,
+        "invalid_token": 1,
+        "lookup_failure": 1,
+        "formatting_error": 1,
+        "success": 2,
+    }
+    assert report.throughput > 0
+    assert 0 < report.percentile(50) <= report.percentile(99) <= max(report.latencies)
+
+
+def test_replay_trace_respects_timing():
+    report = replay_trace([entry(0.0, sid="aaa"), entry(0.1, sid="aaa")], speed=1, workers=1)
+    assert report.elapsed >= 0.1
+
+    report = replay_trace([entry(0.0, sid="aaa"), entry(10.0, sid="aaa")], speed=0, workers=1)
+    assert report.elapsed < 1
+
+
+def test_replay_trace_invalid_mode():
+    with pytest.raises(ValueError, match="Unknown replay mode 'processes'"):
+        replay_trace(TRACE, mode="processes")
+
+
+def test_replay_trace_restores_settings(settings):
+    replay_trace(TRACE, speed=0)
+
+    assert get_trace_recorder() is None
+    assert type(get_resolver()).__name__ == "Pywin32Resolver"
+
+
+def test_replay_trace_leaves_project_caches_alone(settings, tmp_path, shared_cache):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = str(tmp_path / "identities.sqlite3")
+
+    replay_trace(TRACE, speed=0)
+
+    assert len(shared_cache.cache._cache) == 0
+    assert get_persistent_identity_store().load() == {}
+
+
+def test_replay_trace_leaves_project_warmup_and_tracing_alone(mocker, settings):
+    settings.WINDOWSAUTHTOKEN_WARMUP = True
+    settings.WINDOWSAUTHTOKEN_TRACER = "django_windowsauthtoken.tracing.MemoryTracer"
+    settings.WINDOWSAUTHTOKEN_TRACING = True
+    mock_start_warmup = mocker.patch("django_windowsauthtoken.warmup.start_warmup")
+    spy_tracing_request = mocker.spy(middleware_module, "tracing_request")
+
+    replay_trace(TRACE, speed=0)
+
+    mock_start_warmup.assert_not_called()
+    spy_tracing_request.assert_not_called()
+
+
+def test_replay_trace_command(trace_file, capsys):
+    recorder = TraceRecorder(str(trace_file))
+    for recorded in TRACE:
+        recorder.write(recorded)
+    recorder.flush()
+
+    call_command("windowsauthtoken_replay_trace", str(trace_file), "--speed", "0", "--mode", "asyncio")
+
+    out = capsys.readouterr().out
+    assert "Requests:   7\n" in out
+    assert "Throughput:" in out
+    assert "p99:" in out
+    assert "Outcome success: 2\n" in out
+
+
+def test_replay_trace_command_missing_file(tmp_path):
+    with pytest.raises(CommandError, match="Cannot read trace file"):
+        call_command("windowsauthtoken_replay_trace", str(tmp_path / "missing.csv"))
+
+
+def test_replay_trace_command_empty_file(trace_file):
+    trace_file.write_text("timestamp,token,sid,outcome,duration\n")
+    with pytest.raises(CommandError, match="contains no requests"):
+        call_command("windowsauthtoken_replay_trace", str(trace_file))
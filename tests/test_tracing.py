@@ -0,0 +1,214 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+
+from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+from django_windowsauthtoken.tracing import (
+    MemoryTracer,
+    OpenTelemetryTracer,
+    SpanTimings,
+    get_tracer,
+    sampled,
+)
+
+
+@pytest.fixture()
+def resolver_options():
+    return {
+        "tokens": {"1a": "S-1-5-21-1", "2b": "S-1-5-21-2"},
+        "accounts": {"S-1-5-21-1": ("testuser", "TESTDOMAIN"), "S-1-5-21-2": ("otheruser", "")},
+    }
+
+
+@pytest.fixture()
+def tracer(settings):
+    settings.WINDOWSAUTHTOKEN_TRACER = "django_windowsauthtoken.tracing.MemoryTracer"
+    settings.WINDOWSAUTHTOKEN_TRACING = True
+    return get_tracer()
+
+
+def spans_by_name(tracer):
+    return {span.name: span for span in tracer.spans}
+
+
+def test_get_tracer_disabled_by_default():
+    assert get_tracer() is None
+
+
+def test_get_tracer_import_error(mocker):
+    # Patch the settings directly, overriding them would notify middleware instances of other tests
+    mocker.patch(
+        "django_windowsauthtoken.tracing.settings",
+        WINDOWSAUTHTOKEN_TRACING=True,
+        WINDOWSAUTHTOKEN_TRACER="django_windowsauthtoken.tracing.NoSuchTracer",
+    )
+
+    with pytest.raises(ImproperlyConfigured, match="Cannot import tracer"):
+        get_tracer()
+
+
+def test_tracing_spans(rf, fake_resolver, tracer):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    spans = spans_by_name(tracer)
+    assert list(spans) == [
+        "windowsauthtoken.token_inspection",
+        "windowsauthtoken.sid_lookup",
+        "windowsauthtoken.format_username",
+        "windowsauthtoken.resolve",
+    ]
+    request_span = spans["windowsauthtoken.resolve"]
+    assert request_span.attributes == {
+        "windowsauthtoken.outcome": "success",
+        "windowsauthtoken.identity_source": "lookup",
+        "windowsauthtoken.cache_hit": False,
+    }
+    for span in list(tracer.spans)[:-1]:
+        assert span.parent is request_span
+        assert request_span.start_time <= span.start_time <= span.end_time <= request_span.end_time
+
+
+def test_tracing_cache_hit(rf, fake_resolver, tracer):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    tracer.spans.clear()
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    spans = spans_by_name(tracer)
+    assert "windowsauthtoken.sid_lookup" not in spans
+    assert spans["windowsauthtoken.resolve"].attributes["windowsauthtoken.identity_source"] == "cache"
+    assert spans["windowsauthtoken.resolve"].attributes["windowsauthtoken.cache_hit"] is True
+
+
+def test_tracing_formatting_error(rf, fake_resolver, tracer):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "2b"}))
+
+    spans = spans_by_name(tracer)
+    assert "windowsauthtoken.format_username" in spans
+    assert spans["windowsauthtoken.resolve"].attributes["windowsauthtoken.outcome"] == "formatting_error"
+
+
+def test_tracing_no_token(rf, tracer):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    middleware(rf.get("/"))
+
+    assert [span.name for span in tracer.spans] == ["windowsauthtoken.resolve"]
+    assert tracer.spans[0].attributes == {"windowsauthtoken.outcome": "no_token"}
+
+
+@pytest.mark.asyncio
+async def test_tracing_spans_async(async_rf, fake_resolver, tracer):
+    async def get_response(request):
+        return HttpResponse()
+
+    middleware = WindowsAuthTokenMiddleware(get_response)
+    await middleware(async_rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    spans = spans_by_name(tracer)
+    assert "windowsauthtoken.sid_lookup" in spans
+    assert spans["windowsauthtoken.resolve"].attributes["windowsauthtoken.outcome"] == "success"
+
+
+def test_tracing_with_server_timing(settings, rf, fake_resolver, tracer):
+    settings.WINDOWSAUTHTOKEN_SERVER_TIMING = True
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    response = middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    assert response["Server-Timing"].endswith('windowsauthtoken-source;desc="lookup"')
+    assert "windowsauthtoken.resolve" in spans_by_name(tracer)
+
+
+def test_tracing_sampling(mocker, settings, rf, fake_resolver, tracer):
+    settings.WINDOWSAUTHTOKEN_TRACING_SAMPLE_RATE = 0.5
+    mocker.patch("random.random", side_effect=[0.7, 0.2])
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert list(tracer.spans) == []
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+    assert "windowsauthtoken.resolve" in spans_by_name(tracer)
+
+
+@pytest.mark.parametrize(("sample_rate", "expected"), [(0.0, False), (1.0, True)])
+def test_sampled_bounds(mocker, sample_rate, expected):
+    mocker.patch("random.random", return_value=0.0 if expected else 0.999)
+    assert sampled(sample_rate) is expected
+
+
+def test_tracing_invalid_sample_rate(tracer, mocker):
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+    # Patch the settings directly, overriding them would notify middleware instances of other tests
+    mocker.patch("django_windowsauthtoken.middleware.settings", SimpleNamespace(WINDOWSAUTHTOKEN_TRACING_SAMPLE_RATE=2))
+
+    with pytest.raises(ImproperlyConfigured, match="must be between 0 and 1"):
+        middleware.load_tracing()
+
+
+def test_tracing_disabled_makes_no_tracing_calls(mocker, rf, fake_resolver):
+    mock_tracing_request = mocker.patch("django_windowsauthtoken.middleware.tracing_request")
+    mock_sampled = mocker.patch("django_windowsauthtoken.middleware.sampled")
+    mock_add = mocker.patch.object(SpanTimings, "add")
+    middleware = WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    middleware(rf.get("/", headers={"X-IIS-WindowsAuthToken": "1a"}))
+
+    mock_tracing_request.assert_not_called()
+    mock_sampled.assert_not_called()
+    mock_add.assert_not_called()
+
+
+def test_opentelemetry_tracer(mocker):
+    mock_opentelemetry = mocker.MagicMock()
+    mocker.patch.dict(sys.modules, {"opentelemetry": mock_opentelemetry})
+    mock_trace = mock_opentelemetry.trace
+
+    tracer = OpenTelemetryTracer()
+    parent = tracer.start_span("windowsauthtoken.resolve")
+    child = tracer.start_span("windowsauthtoken.sid_lookup", parent=parent, start_time=1.5)
+    child.set_attribute("windowsauthtoken.cache_hit", False)
+    child.end(end_time=2.0)
+
+    mock_trace.get_tracer.assert_called_once_with("django_windowsauthtoken")
+    otel_tracer = mock_trace.get_tracer.return_value
+    otel_tracer.start_span.assert_any_call("windowsauthtoken.resolve", context=None, start_time=None)
+    mock_trace.set_span_in_context.assert_called_once_with(parent.span)
+    otel_tracer.start_span.assert_called_with(
+        "windowsauthtoken.sid_lookup", context=mock_trace.set_span_in_context.return_value, start_time=1_500_000_000
+    )
+    child.span.set_attribute.assert_called_once_with("windowsauthtoken.cache_hit", False)
+    child.span.end.assert_called_once_with(end_time=2_000_000_000)
+
+
+def test_opentelemetry_tracer_not_installed(mocker):
+    mocker.patch.dict(sys.modules, {"opentelemetry": None})
+
+    with pytest.raises(ImproperlyConfigured, match="opentelemetry-api is required for tracing"):
+        OpenTelemetryTracer()
+
+
+def test_memory_tracer():
+    tracer = MemoryTracer()
+    span = tracer.start_span("test", start_time=1.0)
+    assert list(tracer.spans) == []
+
+    span.end(end_time=2.0)
+    assert list(tracer.spans) == [span]
+    assert (span.start_time, span.end_time) == (1.0, 2.0)
+
+
+def test_memory_tracer_is_bounded():
+    tracer = MemoryTracer(max_spans=2)
+    for name in ("first", "second", "third"):
+        tracer.start_span(name).end()
+
+    assert [span.name for span in tracer.spans] == ["second", "third"]
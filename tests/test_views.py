@@ -1,4 +1,10 @@
+import sys
+
 import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+
+from django_windowsauthtoken.diagnostics import cache_diagnostics
 
 
 @pytest.mark.django_db
@@ -53,3 +59,112 @@ def test_debug_view_not_debug(client, settings):
 
     data = response.json()
     assert data == {"error": "This view is only available in DEBUG mode."}
+
+
+def test_metrics_view_disabled(client):
+    response = client.get("/metrics/")
+    assert response.status_code == 404
+
+
+def test_metrics_view(client, settings):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+
+    client.get("/")
+    response = client.get("/metrics/")
+
+    assert response.status_code == 200
+    assert response["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+    # The request for the metrics itself is counted too
+    assert 'windowsauthtoken_requests_total{outcome="no_token"} 2\n' in response.content.decode()
+
+
+def test_metrics_view_handles(client, settings):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    settings.WINDOWSAUTHTOKEN_HANDLE_TRACKING = True
+
+    response = client.get("/metrics/")
+
+    content = response.content.decode()
+    assert "# TYPE windowsauthtoken_handles_in_flight gauge\n" in content
+    assert "windowsauthtoken_handles_opened_total 0\n" in content
+    assert "windowsauthtoken_handle_held_seconds_max 0.0\n" in content
+
+
+def test_diagnostics_view_anonymous(client):
+    response = client.get("/diagnostics/")
+    assert response.status_code == 403
+
+
+@pytest.fixture()
+def model_backend(settings):
+    # Users logged in with RemoteUserBackend are logged out on requests without a token
+    settings.AUTHENTICATION_BACKENDS = [
+        "django.contrib.auth.backends.RemoteUserBackend",
+        "django.contrib.auth.backends.ModelBackend",
+    ]
+    return "django.contrib.auth.backends.ModelBackend"
+
+
+@pytest.mark.django_db
+def test_diagnostics_view_without_permission(client, settings, model_backend):
+    settings.WINDOWSAUTHTOKEN_DIAGNOSTICS_PERMISSION = "auth.view_user"
+    client.force_login(get_user_model().objects.create_user("testuser", is_staff=True), backend=model_backend)
+
+    response = client.get("/diagnostics/")
+    assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_diagnostics_view_with_permission(client, settings, model_backend):
+    settings.WINDOWSAUTHTOKEN_DIAGNOSTICS_PERMISSION = "auth.view_user"
+    user = get_user_model().objects.create_user("testuser")
+    user.user_permissions.add(Permission.objects.get(codename="view_user"))
+    client.force_login(user, backend=model_backend)
+
+    response = client.get("/diagnostics/")
+
+    assert response.status_code == 200
+    assert "no-cache" in response["Cache-Control"]
+    data = response.json()
+    assert data["formatter"] == "django_windowsauthtoken.formatters.format_domain_user"
+    assert data["resolver"] == "django_windowsauthtoken.resolvers.Pywin32Resolver"
+    assert data["authentication_backends"] == [
+        "django.contrib.auth.backends.RemoteUserBackend",
+        "django.contrib.auth.backends.ModelBackend",
+    ]
+    # Disabled features are reported as null
+    assert data["outcomes"] is None
+    assert data["latency"] is None
+    assert data["circuit_breaker"] is None
+    assert data["handles"] is None
+    assert set(data["caches"]) == {"identities", "negative_identities", "groups", "users"}
+
+
+def test_cache_diagnostics_without_backend_loaded(mocker):
+    mocker.patch.dict(sys.modules, {"django_windowsauthtoken.backends": None})
+
+    assert set(cache_diagnostics()) == {"identities", "negative_identities", "groups"}
+
+
+@pytest.mark.django_db
+def test_diagnostics_view_superuser(client, settings, mocker, model_backend):
+    settings.WINDOWSAUTHTOKEN_METRICS = True
+    settings.WINDOWSAUTHTOKEN_HANDLE_TRACKING = True
+    settings.WINDOWSAUTHTOKEN_CIRCUIT_BREAKER_THRESHOLD = 5
+    mocker.patch(
+        "django_windowsauthtoken.middleware.WindowsAuthTokenMiddleware.retrieve_auth_user_details",
+        return_value=("testuser", "TESTDOMAIN"),
+    )
+    client.get("/", headers={"X-IIS-WindowsAuthToken": "1a"})
+    client.force_login(get_user_model().objects.create_superuser("admin"), backend=model_backend)
+
+    response = client.get("/diagnostics/")
+
+    data = response.json()
+    assert data["outcomes"]["success"] == 1
+    assert data["latency"]["format_username"]["count"] == 1
+    assert data["latency"]["format_username"]["p50"] > 0
+    assert data["latency"]["lookup_account_sid"] == {"count": 0, "p50": None, "p90": None, "p99": None}
+    assert data["circuit_breaker"] == {"open": False, "failures": 0}
+    assert data["handles"]["in_flight"] == 0
+    assert data["caches"]["identities"]["hit_ratio"] is None
@@ -0,0 +1,146 @@
+from datetime import timedelta
+
+import pytest
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.utils import timezone
+
+from django_windowsauthtoken.cache import get_identity_cache, get_persistent_identity_store, get_shared_identity_cache
+from django_windowsauthtoken.invalidation import get_invalidation_log, get_invalidation_watcher
+from django_windowsauthtoken.middleware import WindowsAuthTokenMiddleware
+from django_windowsauthtoken.warmup import (
+    recently_active_usernames,
+    resolve_account_name,
+    start_warmup,
+    warm_identity_cache,
+)
+
+
+@pytest.fixture()
+def resolver_options():
+    return {
+        "accounts": {
+            "S-1-5-21-1": ("testuser", "TESTDOMAIN"),
+            "S-1-5-21-2": ("otheruser", "TESTDOMAIN"),
+        },
+    }
+
+
+@pytest.fixture()
+def users(db):
+    now = timezone.now()
+    user_model = get_user_model()
+    user_model.objects.create(username=r"TESTDOMAIN\testuser", last_login=now - timedelta(hours=1))
+    user_model.objects.create(username="otheruser@testdomain", last_login=now)
+    user_model.objects.create(username=r"TESTDOMAIN\inactive", last_login=now - timedelta(days=30))
+    user_model.objects.create(username=r"TESTDOMAIN\neverloggedin")
+
+
+def test_recently_active_usernames(users):
+    assert recently_active_usernames(days=7) == ["otheruser@testdomain", r"TESTDOMAIN\testuser"]
+    assert recently_active_usernames(days=7, limit=1) == ["otheruser@testdomain"]
+
+
+@pytest.mark.parametrize("account_name", [r"TESTDOMAIN\testuser", "testuser@testdomain", "TESTUSER"])
+def test_resolve_account_name(fake_resolver, account_name):
+    assert resolve_account_name(account_name) == ("S-1-5-21-1", ("testuser", "TESTDOMAIN"))
+
+
+def test_resolve_account_name_unknown(fake_resolver):
+    assert resolve_account_name(r"TESTDOMAIN\unknown") is None
+
+
+def test_warm_identity_cache(fake_resolver, users):
+    assert warm_identity_cache(batch_size=1) == 2
+
+    identity_cache = get_identity_cache()
+    assert identity_cache.get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+    assert identity_cache.get("S-1-5-21-2") == ("otheruser", "TESTDOMAIN")
+
+
+def test_warm_identity_cache_usernames(fake_resolver):
+    assert warm_identity_cache([r"TESTDOMAIN\testuser", r"TESTDOMAIN\unknown"]) == 1
+    assert len(get_identity_cache()) == 1
+
+
+def test_warm_identity_cache_fills_shared_cache(mocker, fake_resolver, shared_cache):
+    spy = mocker.spy(shared_cache, "set_many")
+
+    warm_identity_cache([r"TESTDOMAIN\testuser", r"TESTDOMAIN\otheruser"])
+
+    assert spy.call_count == 1
+    assert shared_cache.get("S-1-5-21-2") == ("otheruser", "TESTDOMAIN")
+
+
+def test_warm_identity_cache_after_flush(fake_resolver, shared_cache):
+    get_invalidation_log().publish("all")
+
+    warm_identity_cache([r"TESTDOMAIN\testuser"])
+
+    # Another worker, that reads the namespace from the shared cache
+    get_shared_identity_cache.cache_clear()
+    get_invalidation_watcher().refresh()
+    assert get_shared_identity_cache().get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+
+def test_warm_identity_cache_fills_persistent_store(settings, tmp_path, fake_resolver):
+    settings.WINDOWSAUTHTOKEN_PERSISTENT_CACHE = tmp_path / "identities.sqlite3"
+
+    warm_identity_cache([r"TESTDOMAIN\testuser"])
+
+    assert list(get_persistent_identity_store().load()) == ["S-1-5-21-1"]
+
+
+def test_start_warmup_database_error(mocker, caplog):
+    mocker.patch("django_windowsauthtoken.warmup.recently_active_usernames", side_effect=DatabaseError("no such table"))
+
+    start_warmup().join()
+
+    assert "Cannot warm identity cache: no such table" in caplog.text
+
+
+def test_start_warmup_unexpected_error(mocker, caplog):
+    mocker.patch("django_windowsauthtoken.warmup.recently_active_usernames", side_effect=RuntimeError("Unavailable"))
+    mock_connection = mocker.patch("django_windowsauthtoken.warmup.connection")
+
+    start_warmup().join()
+
+    assert "Cannot warm identity cache" in caplog.text
+    assert "RuntimeError: Unavailable" in caplog.text
+    mock_connection.close.assert_called_once_with()
+
+
+def test_warm_cache_command(fake_resolver, users, capsys):
+    call_command("windowsauthtoken_warm_cache", "--days", "60")
+
+    assert "Warmed 2 identities." in capsys.readouterr().out
+
+
+def test_warm_cache_command_usernames(fake_resolver, capsys):
+    call_command("windowsauthtoken_warm_cache", r"TESTDOMAIN\testuser")
+
+    assert "Warmed 1 identities." in capsys.readouterr().out
+    assert get_identity_cache().get("S-1-5-21-1") == ("testuser", "TESTDOMAIN")
+
+
+@pytest.mark.parametrize("warmup", [False, True])
+def test_middleware_starts_warmup_once(mocker, settings, warmup):
+    settings.WINDOWSAUTHTOKEN_WARMUP = warmup
+    mock_start_warmup = mocker.patch("django_windowsauthtoken.warmup.start_warmup")
+
+    for _ in range(2):
+        WindowsAuthTokenMiddleware(lambda request: HttpResponse())
+
+    assert mock_start_warmup.call_count == int(warmup)
+
+
+def test_app_ready_doesnt_start_warmup(mocker, settings):
+    settings.WINDOWSAUTHTOKEN_WARMUP = True
+    mock_start_warmup = mocker.patch("django_windowsauthtoken.warmup.start_warmup")
+
+    apps.get_app_config("django_windowsauthtoken").ready()
+
+    mock_start_warmup.assert_not_called()
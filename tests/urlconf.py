@@ -3,7 +3,7 @@
 from django.http import HttpResponse
 from django.urls import path
 
-from django_windowsauthtoken.views import debug_view
+from django_windowsauthtoken.views import debug_view, diagnostics_view, metrics_view
 
 
 def hello_world(request):
@@ -12,5 +12,7 @@ def hello_world(request):
 
 urlpatterns = [
     path("debug/", debug_view, name="debug"),
+    path("metrics/", metrics_view, name="metrics"),
+    path("diagnostics/", diagnostics_view, name="diagnostics"),
     path("", hello_world, name="home"),
 ]